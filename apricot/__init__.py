@@ -14,3 +14,17 @@ def _jupyter_labextension_paths():
         "src": "labextension",
         "dest": "apricot"
     }]
+
+
+def _jupyter_server_extension_points():
+    return [{
+        "module": "apricot"
+    }]
+
+
+def _load_jupyter_server_extension(server_app):
+    """Register the REST API used by the JupyterLab panel."""
+    from .handlers import setup_handlers
+
+    setup_handlers(server_app.web_app)
+    server_app.log.info("Registered apricot server extension")
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import threading
+import time
+
+import tornado
+from jupyter_server.base.handlers import APIHandler
+from jupyter_server.utils import url_path_join
+from tornado.ioloop import IOLoop
+
+from apricot_magics.cache import ResponseCache, CACHE_NAME
+from apricot_magics.radl import RADLCache, vm_address
+from apricot_magics.session import IMSessionPool, IM_ENDPOINTS
+from apricot_magics.store import STATE_DIR, open_store
+from apricot_magics.tokens import TokenManager
+from apricot_magics.validate import RecipeValidator, RecipeValidationError
+
+# How long IM answers are served from the in-memory cache before asking again.
+CACHE_TTL = {"state": 10, "ip": 60}
+
+
+class IMService:
+    """
+    In-process access to the IM shared by every request of the server.
+
+    One `IMSession` per IM endpoint serves all calls, so the IM clients and
+    the authfile are only loaded again when the panel rewrites the
+    authfile. Calls go to the endpoint recorded for each infrastructure,
+    and the endpoints and routing policy are those set by the magics. Read-only
+    answers are cached for `CACHE_TTL` seconds, and image catalogs in the
+    disk cache shared with the magics; blocking IM calls run on the
+    server's thread pool so they never stall the event loop. An expiring
+    access token is refreshed with the refresh token stored by the magics.
+    """
+
+    def __init__(self, endpoints=IM_ENDPOINTS, state_dir=STATE_DIR):
+        self.tokens = TokenManager(
+            state_dir / "authfile", lambda: self.store.get_setting("refresh_token")
+        )
+        self.pool = IMSessionPool(
+            endpoints,
+            state_dir / "authfile",
+            refresh=self.tokens.ensure_fresh,
+            lookup=self.recorded_endpoint,
+        )
+        self.state_dir = state_dir
+        self.radl_cache = RADLCache()
+        self.validator = RecipeValidator()
+        self._store = None
+        self._disk_cache = None
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @property
+    def store(self):
+        if self._store is None:
+            store = open_store(self.state_dir)
+            endpoints = store.get_setting("im_endpoints")
+            if endpoints:
+                self.pool.endpoints = json.loads(endpoints)
+            self.pool.policy = store.get_setting("im_routing", self.pool.policy)
+            self._store = store
+        return self._store
+
+    def recorded_endpoint(self, inf_id):
+        record = self.store.get(inf_id)
+        return record.get("imEndpoint") if record is not None else None
+
+    @property
+    def disk_cache(self):
+        if self._disk_cache is None:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_cache = ResponseCache(self.state_dir / CACHE_NAME)
+        return self._disk_cache
+
+    def _cached(self, kind, key, fetch):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get((kind, key))
+        if entry is not None and now - entry[0] < CACHE_TTL[kind]:
+            return entry[1]
+
+        value = fetch()
+        with self._lock:
+            self._cache[(kind, key)] = (now, value)
+        return value
+
+    def forget(self, inf_id):
+        with self._lock:
+            for kind in ("state", "ip"):
+                self._cache.pop((kind, inf_id), None)
+        self.radl_cache.invalidate(inf_id)
+
+    def _call(self, method, *args, **kwargs):
+        # Loads the endpoint settings before the first call is routed.
+        self.store
+        client = self.pool.client
+        success, data = getattr(client, method)(*args, **kwargs)
+        if not success:
+            raise RuntimeError(str(data).strip())
+        return data
+
+    def list_infrastructures(self):
+        infrastructures = self.store.list()
+        self.pool.bind_records(infrastructures)
+        return infrastructures
+
+    def get_state(self, inf_id):
+        def fetch():
+            return self._call("get_infra_property", inf_id, "state").get("state")
+
+        return self._cached("state", inf_id, fetch)
+
+    def get_ip(self, inf_id):
+        def fetch():
+            radl = self._call("getvminfo", inf_id, "0")
+            return vm_address(self.radl_cache.parse(inf_id, "0", radl))[0]
+
+        return self._cached("ip", inf_id, fetch)
+
+    def get_images(self, cloud_id):
+        # Images depend on the credentials, which the panel writes to the authfile.
+        with open(self.pool.authfile_path, "rb") as f:
+            credentials = hashlib.sha256(f.read()).hexdigest()
+        return self.disk_cache.fetch(
+            "images", f"{cloud_id}:{credentials}", lambda: self._call("get_cloud_images", cloud_id)
+        )
+
+    def create(self, recipe, desc_type, endpoint=None, record=None):
+        """
+        Create an infrastructure and add it to the store.
+
+        `record` holds the details the panel keeps about it (name,
+        credentials); the stored record, with the ID and the IM endpoint
+        it went to, is returned.
+        """
+        inf_id = self._call("create", recipe, desc_type, asyncr=True, endpoint=endpoint)
+        endpoint = self.pool.endpoint_of(inf_id)
+        record = dict(record or {}, infrastructureID=inf_id.strip(), imEndpoint=endpoint)
+        self.store.add(record)
+        return record
+
+    def destroy(self, inf_id):
+        self._call("destroy", inf_id)
+        self.forget(inf_id)
+        self.disk_cache.invalidate(inf_id)
+        self.store.remove(inf_id)
+        self.pool.forget(inf_id)
+
+
+class BaseHandler(APIHandler):
+    @property
+    def im(self):
+        return self.settings["apricot_im_service"]
+
+    async def run_blocking(self, func, *args):
+        """Run an IM call on the thread pool, answering 502 if the IM fails."""
+        try:
+            return await IOLoop.current().run_in_executor(None, func, *args)
+        except Exception as e:
+            # Passed as the format string of the log message, so escape `%`.
+            raise tornado.web.HTTPError(502, str(e).replace("%", "%%")) from e
+
+
+class InfrastructuresHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self):
+        infrastructures = await self.run_blocking(self.im.list_infrastructures)
+        self.finish(json.dumps({"infrastructures": infrastructures}))
+
+    @tornado.web.authenticated
+    async def post(self):
+        body = self.get_json_body() or {}
+        recipe = body.get("recipe")
+        if not recipe:
+            raise tornado.web.HTTPError(400, "Missing recipe")
+
+        # Bad recipes are rejected here, before any IM call.
+        desc_type = body.get("format", "yaml")
+        try:
+            self.im.validator.check(recipe, desc_type)
+        except RecipeValidationError as e:
+            raise tornado.web.HTTPError(400, str(e).replace("%", "%%")) from e
+
+        record = body.get("record") or {}
+        if not isinstance(record, dict):
+            raise tornado.web.HTTPError(400, "The record must be an object")
+
+        record = await self.run_blocking(
+            self.im.create, recipe, desc_type, body.get("endpoint"), record
+        )
+        self.set_status(201)
+        self.finish(json.dumps(record))
+
+
+class InfrastructureHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def delete(self, inf_id):
+        await self.run_blocking(self.im.destroy, inf_id)
+        self.finish(json.dumps({"infrastructureID": inf_id}))
+
+
+class InfrastructureStateHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self, inf_id):
+        state = await self.run_blocking(self.im.get_state, inf_id)
+        self.finish(json.dumps({"infrastructureID": inf_id, "state": state}))
+
+
+class InfrastructureIPHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self, inf_id):
+        ip = await self.run_blocking(self.im.get_ip, inf_id)
+        self.finish(json.dumps({"infrastructureID": inf_id, "ip": ip}))
+
+
+class ImagesHandler(BaseHandler):
+    @tornado.web.authenticated
+    async def get(self, cloud_id):
+        images = await self.run_blocking(self.im.get_images, cloud_id)
+        self.finish(json.dumps({"images": images}))
+
+
+def setup_handlers(web_app):
+    host_pattern = ".*$"
+    base_url = url_path_join(web_app.settings["base_url"], "apricot")
+    inf_id = r"(?P<inf_id>[^/]+)"
+
+    web_app.settings["apricot_im_service"] = IMService()
+    handlers = [
+        (url_path_join(base_url, "infrastructures"), InfrastructuresHandler),
+        (url_path_join(base_url, "infrastructures", inf_id), InfrastructureHandler),
+        (url_path_join(base_url, "infrastructures", inf_id, "state"), InfrastructureStateHandler),
+        (url_path_join(base_url, "infrastructures", inf_id, "ip"), InfrastructureIPHandler),
+        (url_path_join(base_url, "images", r"(?P<cloud_id>[^/]+)"), ImagesHandler),
+    ]
+    web_app.add_handlers(host_pattern, handlers)
@@ -1,19 +1,209 @@
-from tabulate import tabulate
 from IPython.core.magic import Magics, line_magic, line_cell_magic, magics_class
-from subprocess import run, PIPE, CalledProcessError
+from subprocess import run, Popen, PIPE, DEVNULL, CalledProcessError
 from pathlib import Path
-from imclient import IMClient
+from collections import Counter, namedtuple
+from io import StringIO
+
+from .cache import ResponseCache, CACHE_NAME
+from .cell import BARRIER, RoutedStream, capture_line_output, output_lines, plan_cell
+from .concurrency import fan_out, map_ordered, RateLimiter, DEFAULT_MAX_WORKERS
+from .logs import LogCursor, LOG_MIN_INTERVAL, LOG_MAX_INTERVAL
+from .session import IMSessionPool, IM_ENDPOINTS, ROUTING_POLICIES
+from .slurm import SlurmTracker, JOB_FAILED_STATES, JOB_SETTLED_STATES, submission_of
+from .radl import (
+    MEMORY_UNITS,
+    RADLCache,
+    RADLSyntaxError,
+    format_property,
+    format_size,
+    is_property_pattern,
+    select_properties,
+    vm_address,
+)
+from .scale import (
+    Autoscaler, ScalePolicy, AUTOSCALE_INTERVAL, SCALE_UP_COOLDOWN, SCALE_DOWN_COOLDOWN,
+    IDLE_TIME, node_name, parse_queue, queue_script, scale_radl,
+)
+from .ssh import SSHConnectionManager
+from .stats import Stats
+from .tokens import TokenManager, TokenRefreshError
+from .store import open_store
+from .transfer import TransferEngine, DEFAULT_STREAMS, TRANSFER_MODES
+from .validate import RecipeValidator
+from .watcher import InfrastructureWatcher, FAILED_STATES, SETTLED_STATES, parse_duration
 
-import requests
-import jwt
 import time
+import re
 import os
 import json
 import sys
-import shutil
-import re
+import codecs
+import selectors
+import itertools
+import functools
+import sqlite3
+import threading
+
+SSH_CONTEXT_TTL = 300
+STREAM_CHUNK_SIZE = 64 * 1024
+# VMs shown per page by %apricot_info and %apricot_radl, and rows per printed table.
+INFO_PAGE_SIZE = 50
+INFO_TABLE_ROWS = 10
+
+SSHContext = namedtuple(
+    "SSHContext", ["user", "private_key", "host", "public", "system"]
+)
+
+
+def tabulate(*args, **kwargs):
+    # Imported on first use to keep `%load_ext apricot_magics` fast.
+    from tabulate import tabulate
+
+    return tabulate(*args, **kwargs)
+
+
+def traced(magic):
+    """Print the span breakdown of a magic after it runs, while tracing is on."""
+
+    @functools.wraps(magic)
+    def wrapper(self, *args, **kwargs):
+        # Commands run from a traced `%%apricot` cell are part of its trace.
+        if not self.stats.tracing or self.stats.current_trace() is not None:
+            return magic(self, *args, **kwargs)
+
+        with self.stats.trace() as trace:
+            result = magic(self, *args, **kwargs)
+        self.print_trace(trace)
+        return result
+
+    return wrapper
+
+
+def select_vm_ids(selector, vm_ids):
+    """
+    Return the VM IDs matched by a selector, keeping the order of `vm_ids`.
+
+    A selector is `all` or a comma separated list of IDs and ranges,
+    e.g. `0`, `1,3` or `0,2-5`.
+    """
+    if selector == "all":
+        return list(vm_ids)
+
+    selected = set()
+    for part in selector.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = (int(value) for value in part.split("-", 1))
+            selected.update(str(value) for value in range(start, end + 1))
+        elif part:
+            selected.add(str(int(part)))
+
+    return [vm_id for vm_id in vm_ids if vm_id in selected]
+
+
+def parse_exec_options(words, options):
+    """
+    Split leading `--name value` / `--flag` options from an exec command.
+
+    `options` maps each accepted option name to its default value; options
+    whose default is a boolean are flags and take no value.
+    """
+    values = dict(options)
+    index = 0
+
+    while index < len(words) and words[index].startswith("--"):
+        name = words[index][2:]
+        if name not in options:
+            break
+        if isinstance(options[name], bool):
+            values[name] = True
+            index += 1
+        else:
+            if index + 1 >= len(words):
+                raise ValueError(f"Missing value for option --{name}")
+            values[name] = words[index + 1]
+            index += 2
+
+    return values, words[index:]
+
+
+def parse_line_options(words, options):
+    """
+    Like `parse_exec_options`, but options may appear anywhere in the line.
+
+    Options whose default is a list may be repeated; their values are collected.
+    """
+    values = {
+        name: list(default) if isinstance(default, list) else default
+        for name, default in options.items()
+    }
+    args = []
+    index = 0
+
+    while index < len(words):
+        name = words[index][2:] if words[index].startswith("--") else None
+        if name not in options:
+            args.append(words[index])
+            index += 1
+        elif isinstance(options[name], bool):
+            values[name] = True
+            index += 1
+        else:
+            if index + 1 >= len(words):
+                raise ValueError(f"Missing value for option --{name}")
+            if isinstance(options[name], list):
+                values[name].append(words[index + 1])
+            else:
+                values[name] = words[index + 1]
+            index += 2
+
+    return values, args
+
+
+RECIPE_TYPE_NAMES = {"yaml": "TOSCA", "radl": "RADL", "json": "JSON"}
+
+
+def detect_recipe_type(inf_desc):
+    """Guess the IM description type of a recipe: `json`, `yaml` (TOSCA) or `radl`."""
+    if inf_desc.startswith("[") or inf_desc.startswith("{"):
+        return "json"
+    elif "tosca_definitions_version" in inf_desc:
+        return "yaml"
+    return "radl"
+
+
+def expand_parameter_matrix(assignments):
+    """
+    Expand `name=v1,v2` assignments into the cartesian product of their values.
+
+    Values are parsed as YAML scalars, so `4` becomes an integer and `true` a boolean.
+    """
+    import yaml
+
+    names, values = [], []
+    for assignment in assignments:
+        name, _, raw_values = assignment.partition("=")
+        if not name or not raw_values:
+            raise ValueError(f"Invalid parameter '{assignment}', expected name=v1,v2,...")
+        names.append(name)
+        values.append([yaml.safe_load(value) for value in raw_values.split(",")])
+
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def render_tosca_template(template, parameters):
+    """Return a TOSCA template with the defaults of the given inputs replaced."""
+    import yaml
+
+    data = yaml.safe_load(template)
+    inputs = (data.get("topology_template") or {}).get("inputs") or {}
 
-IM_ENDPOINT = "https://im.egi.eu/im"
+    for name, value in parameters.items():
+        if name not in inputs:
+            raise ValueError(f"Unknown input '{name}'")
+        inputs[name]["default"] = value
+
+    return yaml.safe_dump(data, sort_keys=False)
 
 
 @magics_class
@@ -21,48 +211,66 @@ class Apricot_Magics(Magics):
 
     def __init__(self, shell):
         super().__init__(shell)
-        self.load_paths()
+        # Nothing here touches the disk or the network: the state directory,
+        # the IM client and the token refresh are all set up on first use.
+        state_dir = Path.home() / "apricotlab_state"
+        self.state_dir = state_dir
+        self.deployed_template_path = state_dir / "deployed-template.yaml"
+        self.authfile_path = state_dir / "authfile"
 
-        data = self.load_json(self.inf_list_path)
-        access_token = data.get("access_token", "")
-        refresh_token = data.get("refresh_token", "")
+        self.stats = Stats()
+        self.tokens = TokenManager(
+            self.authfile_path,
+            lambda: self.store.get_setting("refresh_token"),
+            stats=self.stats,
+        )
+        self.im_pool = IMSessionPool(
+            IM_ENDPOINTS,
+            self.authfile_path,
+            refresh=self.tokens.ensure_fresh,
+            stats=self.stats,
+            lookup=self.recorded_endpoint,
+        )
+        self.radl_cache = RADLCache()
+        self.validator = RecipeValidator(stats=self.stats)
+        self.ssh = SSHConnectionManager(stats=self.stats)
+        self.watcher = InfrastructureWatcher(self.fetch_infrastructure_status)
+        self.slurm = SlurmTracker(
+            lambda inf_id, command: self.run_remote_command(inf_id, "0", command),
+            stats=self.stats,
+        )
+        self.autoscalers = {}
         self.client = None
 
-        if access_token:
-            auth = f"""
-                type = InfrastructureManager; token = {access_token}
-            """
-            self.client = IMClient.init_client(IM_ENDPOINT, auth)
-        elif refresh_token:
-            self.generate_new_access_token(refresh_token)
-            self.initialize_im_client()
+        self._store = None
+        self._cache = None
+        self._refresh_scheduled = False
+        self._state_lock = threading.Lock()
 
     ########################
     #  Auxiliar functions  #
     ########################
 
-    def load_paths(self):
-        state_dir = Path.home() / "apricotlab_state"
-        state_dir.mkdir(exist_ok=True)
+    @property
+    def store(self):
+        return self.load_state()
 
-        for legacy_dir in (
-            Path.cwd() / "apricotlab_state",
-            Path.cwd().parent / "apricotlab_state",
-        ):
-            if legacy_dir.exists() and legacy_dir.resolve() != state_dir.resolve():
-                for legacy_file in legacy_dir.iterdir():
-                    target = state_dir / legacy_file.name
-                    if legacy_file.is_file() and not target.exists():
-                        shutil.copy2(legacy_file, target)
+    @property
+    def cache(self):
+        self.load_state()
+        return self._cache
 
-        self.inf_list_path = state_dir / "infrastructuresList.json"
-        self.deployed_template_path = state_dir / "deployed-template.yaml"
-        self.authfile_path = state_dir / "authfile"
+    def load_state(self):
+        """Open the infrastructure store and create the state files on first use."""
+        with self._state_lock:
+            if self._store is None:
+                self.load_paths()
+        return self._store
 
-        if not self.inf_list_path.exists():
-            self.inf_list_path.write_text(
-                json.dumps({"refresh_token": "", "infrastructures": []}, indent=4)
-            )
+    def load_paths(self):
+        """Create the state directory and its files, migrating legacy state once."""
+        self._store = open_store(self.state_dir)
+        self._cache = ResponseCache(self.state_dir / CACHE_NAME)
 
         if not self.deployed_template_path.exists():
             self.deployed_template_path.touch()
@@ -72,24 +280,35 @@ class Apricot_Magics(Magics):
                 "id = im; type = InfrastructureManager; token = <token>\n"
             )
 
-    def load_json(self, path):
-        """Load a JSON file and handle errors."""
-        try:
-            with open(path) as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            raise ValueError(f"Error loading JSON from {path}: {e}")
+        endpoints = self._store.get_setting("im_endpoints")
+        if endpoints:
+            self.im_pool.endpoints = json.loads(endpoints)
+        self.im_pool.policy = self._store.get_setting("im_routing", self.im_pool.policy)
+
+    def recorded_endpoint(self, inf_id):
+        """Return the IM endpoint stored for an infrastructure, or None for the default one."""
+        record = self.store.get(inf_id)
+        return record.get("imEndpoint") if record is not None else None
 
     def initialize_im_client(self):
-        """Ensure access token is valid in auth-file, then initialize IMClient."""
-        self.check_token()
-        auth_content = IMClient.read_auth_data(self.authfile_path)
-        self.client = IMClient.init_client(IM_ENDPOINT, auth_content)
+        """
+        Get the IM client, refreshing the access token if it is about to expire.
+
+        The client sends every call to the IM endpoint of its infrastructure.
+        """
+        self.load_state()
+
+        if not self._refresh_scheduled:
+            self._refresh_scheduled = True
+            # Refreshes in the background, right away if the token has already expired.
+            self.tokens.schedule()
+
+        error = self.tokens.pop_error()
+        if error is not None:
+            print(f"Warning: the access token could not be refreshed: {error}")
 
-    def cleanup_files(self, *files):
-        for file in files:
-            if os.path.exists(file):
-                os.remove(file)
+        self.im_pool.get_client()
+        self.client = self.im_pool.client
 
     def execute_command(self, cmd):
         """Execute a command and return stdout, or handle the output differently."""
@@ -102,116 +321,436 @@ class Apricot_Magics(Magics):
         except CalledProcessError as e:
             print(f"Error: {e.stderr}")
 
-    def generate_key(self, inf_id, vm_id):
-        """Generates private key and host IP from infrastructure and VM info."""
+    def resolve_ssh_context(self, inf_id, vm_id="0"):
+        """
+        Return the SSH user, private key and host IP of a VM.
+
+        All three come from the parsed `getvminfo` RADL of the VM, which is
+        shared with `%apricot_info` and reused for `SSH_CONTEXT_TTL` seconds.
+        """
+        vm_info = self.get_vm_info(inf_id, vm_id, max_age=SSH_CONTEXT_TTL)
+        if vm_info is None:
+            return None
+
+        host, public = vm_address(vm_info)
+        return SSHContext(
+            user=vm_info.user,
+            private_key=vm_info.private_key,
+            host=host,
+            public=public,
+            system=vm_info.system,
+        )
+
+    def get_vm_info(self, inf_id, vm_id="0", max_age=0):
+        """Return the parsed RADL of a VM, fetching it unless a parse younger than `max_age` exists."""
+        vm_info = self.radl_cache.get(inf_id, vm_id, max_age)
+        if vm_info is not None:
+            return vm_info
+
+        # The RADL of a settled infrastructure may be on disk from an earlier session.
+        if max_age:
+            cached = self.cache.get("radl", inf_id)
+            if cached is not None and cached[1] <= self.cache.ttls["radl"]:
+                for cached_vm_id, success, radl in cached[0]:
+                    if str(cached_vm_id) == str(vm_id) and success:
+                        return self.radl_cache.parse(inf_id, vm_id, radl)
+
         try:
             self.initialize_im_client()
-            success, inf_key = self.client.getinfo(
-                inf_id, "disk.0.os.credentials.private_key"
-            )
-
+            success, radl = self.client.getvminfo(inf_id, str(vm_id))
+            if not success:
+                print(f"Error: {radl}")
+                return None
+            return self.radl_cache.parse(inf_id, vm_id, radl)
         except Exception as e:
             print(f"Error: {e}")
-            return "Failed"
+            return None
 
-        private_key_content = list(inf_key)[0][2]
+    def invalidate_ssh_context(self, inf_id):
+        """Drop the parsed RADL, and so the SSH contexts, of every VM of an infrastructure."""
+        self.radl_cache.invalidate(inf_id)
+
+    def stream_command(self, cmd, tee_path=None):
+        """
+        Run a command forwarding its output to the notebook as it arrives.
+
+        Output is read in chunks of at most `STREAM_CHUNK_SIZE` bytes and never
+        accumulated; it is optionally appended to `tee_path` as well. A kernel
+        interrupt terminates the command. Returns the exit code.
+        """
+        process = Popen(cmd, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+        selector = selectors.DefaultSelector()
+        selector.register(process.stdout, selectors.EVENT_READ, sys.stdout)
+        selector.register(process.stderr, selectors.EVENT_READ, sys.stderr)
+        decoders = {
+            process.stdout: codecs.getincrementaldecoder("utf-8")("replace"),
+            process.stderr: codecs.getincrementaldecoder("utf-8")("replace"),
+        }
+        tee = open(tee_path, "ab") if tee_path else None
 
-        if private_key_content:
-            with open("key.pem", "w") as key_file:
-                key_file.write(private_key_content)
-            os.chmod("key.pem", 0o600)
+        try:
+            while selector.get_map():
+                for key, _ in selector.select():
+                    chunk = os.read(key.fd, STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        continue
 
-        return private_key_content
+                    if tee:
+                        tee.write(chunk)
 
-    def resolve_ssh_user(self, inf_id):
-        try:
-            self.initialize_im_client()
-            success, inf_info = self.client.getinfo(
-                inf_id, "disk.0.os.credentials.username"
+                    text = decoders[key.fileobj].decode(chunk)
+                    key.data.write(text.replace("\r\n", "\n"))
+                    key.data.flush()
+
+            return process.wait()
+
+        except KeyboardInterrupt:
+            process.terminate()
+            try:
+                process.wait(timeout=5)
+            except Exception:
+                process.kill()
+            print("\nInterrupted.")
+            return 130
+
+        finally:
+            selector.close()
+            process.stdout.close()
+            process.stderr.close()
+            if tee:
+                tee.close()
+
+    def get_ssh_connection(self, inf_id, vm_id="0"):
+        """Return the multiplexed SSH connection to a VM, or None if it cannot be resolved."""
+        context = self.resolve_ssh_context(inf_id, vm_id)
+        if context is None:
+            return None
+
+        if not context.user:
+            print(f"Error: Unable to resolve SSH user for infrastructure {inf_id}.")
+            return None
+
+        if not context.private_key:
+            print(
+                "Error: Unable to generate private key. Missing infrastructure ID or VM ID."
             )
+            return None
 
-        except Exception as e:
-            print(f"Error: {e}")
-            return "Failed"
+        if not context.host:
+            print(f"Error: Unable to resolve IP user for infrastructure {inf_id}.")
+            return None
+
+        # VMs without a public IP are reached through the front-end (VM 0).
+        proxy = None
+        if not context.public and str(vm_id) != "0":
+            proxy = self.get_ssh_connection(inf_id, "0")
+            if proxy is None:
+                return None
+
+        return self.ssh.get(
+            inf_id, vm_id, context.user, context.host, context.private_key, proxy
+        )
+
+    def list_vm_ids(self, inf_id):
+        """Return the IDs of the VMs of an infrastructure, in numeric order."""
+        self.initialize_im_client()
+        success, state_info = self.client.get_infra_property(inf_id, "state")
+        if not success:
+            raise RuntimeError(state_info)
+
+        vm_ids = [str(vm_id) for vm_id in (state_info.get("vm_states") or {})]
+        return sorted(vm_ids, key=lambda vm_id: int(vm_id) if vm_id.isdigit() else vm_id)
+
+    def resolve_vm_selector(self, inf_id, selector, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Return the VM IDs of an infrastructure matched by `selector`.
+
+        Besides the forms accepted by `select_vm_ids`, `role:<system>` selects
+        the VMs deployed from a given RADL system (e.g. `role:wn`).
+        """
+        if not selector.startswith("role:") and selector != "all" and "-" not in selector:
+            return [str(int(vm_id)) for vm_id in selector.split(",") if vm_id.strip()]
+
+        vm_ids = self.list_vm_ids(inf_id)
+
+        if not selector.startswith("role:"):
+            return select_vm_ids(selector, vm_ids)
+
+        role = selector[len("role:"):]
+        # Resolving the contexts here also warms the cache used by exec.
+        contexts = fan_out(
+            lambda vm_id: self.resolve_ssh_context(inf_id, vm_id),
+            vm_ids,
+            max_workers=max_workers,
+        )
+        return [
+            vm_id
+            for vm_id, context, _ in contexts
+            if context is not None and context.system == role
+        ]
+
+    def run_remote_command(self, inf_id, vm_id, command):
+        """Run a command on one VM and return `(exit_code, stdout, stderr)`."""
+        connection = self.get_ssh_connection(inf_id, vm_id)
+        if connection is None:
+            return 255, "", f"Unable to connect to VM {vm_id}"
+
+        with self.stats.span("ssh.exec", inf_id) as command_span:
+            result = run(connection.ssh_command(command), stdout=PIPE, stderr=PIPE, text=True)
+            command_span.error = result.returncode != 0
+        return result.returncode, result.stdout, result.stderr
+
+    def exec_on_vms(self, inf_id, vm_ids, command, max_workers=DEFAULT_MAX_WORKERS):
+        """Run a command concurrently on several VMs and print per-VM output."""
+        results = fan_out(
+            lambda vm_id: self.run_remote_command(inf_id, vm_id, command),
+            vm_ids,
+            max_workers=max_workers,
+        )
+
+        summary = []
+        failed = False
+
+        for vm_id, result, error in results:
+            if error is not None:
+                exit_code, stdout, stderr = 255, "", str(error)
+            else:
+                exit_code, stdout, stderr = result
+
+            failed = failed or exit_code != 0
+            vm_info = self.radl_cache.get(inf_id, vm_id, SSH_CONTEXT_TTL)
+            host = vm_address(vm_info)[0] if vm_info is not None else ""
 
-        ssh_username = list(inf_info)[0][2]
+            for stream in (stdout, stderr):
+                for output_line in stream.splitlines():
+                    print(f"{vm_id} ({host}): {output_line}")
 
-        return ssh_username
+            summary.append([vm_id, host, exit_code])
 
-    def apricot_transfer(self, inf_id, vm_id, files, destination, transfer_type):
-        """Handle SCP upload and download."""
+        print(tabulate(summary, headers=["VM ID", "Host", "Exit code"], tablefmt="grid"))
+
+        return "Failed" if failed else None
+
+    def copy_directories(self, connection, directories, destination, transfer_type):
+        """Copy whole directories with `scp -r`."""
+        cmd_scp = connection.scp_command() + ["-r"]
+
+        if transfer_type == "upload":
+            cmd_scp.extend(directories)
+            cmd_scp.append(f"{connection.target}:{destination}")
+        else:
+            for directory in directories:
+                cmd_scp.append(f"{connection.target}:{directory}")
+            cmd_scp.append(destination)
+
+        with self.stats.span("transfer.directory", connection.inf_id) as copy_span:
+            output = self.execute_command(cmd_scp)
+            copy_span.error = output is None
+        if output:
+            print(output)
+
+    def apricot_transfer(self, inf_id, vm_selector, files, destination, transfer_type,
+                         max_streams=DEFAULT_STREAMS, mode="auto"):
+        """
+        Upload files to or download files from one or more VMs.
+
+        Directories and many small files are streamed as a compressed tar
+        archive, regular files go through the chunked `TransferEngine`, and
+        directories left out of the archive by `mode` are copied with
+        `scp -r`. Downloads from several VMs are gathered into one
+        subdirectory per VM under `destination`.
+        """
         try:
             self.authfile_path
         except ValueError as e:
             print(e)
             return "Failed"
 
-        # Generate private key content and host IP
-        private_key_content = self.generate_key(inf_id, vm_id)
-        if not private_key_content:
-            print("Error: Unable to generate private key.")
+        try:
+            vm_ids = self.resolve_vm_selector(inf_id, vm_selector)
+        except Exception as e:
+            print(f"Error: {e}")
             return "Failed"
 
-        ssh_user = self.resolve_ssh_user(inf_id)
-        if not ssh_user:
-            print(f"Error: Unable to resolve SSH user for infrastructure {inf_id}.")
+        if not vm_ids:
+            print(f"Error: No VM matches '{vm_selector}' in infrastructure {inf_id}.")
             return "Failed"
 
-        host_ip = self.get_vm_ip(inf_id)
-        if not host_ip:
-            print(f"Error: Unable to resolve IP user for infrastructure {inf_id}.")
-            return "Failed"
+        connections = {}
+        for vm_id in vm_ids:
+            connection = self.get_ssh_connection(inf_id, vm_id)
+            if connection is None:
+                return "Failed"
+            connections[vm_id] = connection
+
+        engine = TransferEngine(max_streams=max_streams, stats=self.stats, mode=mode)
+
+        def plan(vm_id):
+            connection = connections[vm_id]
+            if transfer_type == "upload":
+                return engine.plan_upload(connection, files, destination)
+            target = destination
+            if len(vm_ids) > 1:
+                target = os.path.join(destination, vm_id)
+                os.makedirs(target, exist_ok=True)
+            return engine.plan_download(connection, files, target)
+
+        plans, archives = [], []
+        for vm_id, result, error in fan_out(plan, vm_ids, max_workers=max_streams):
+            if error is not None:
+                print(f"Error: VM {vm_id}: {error}")
+                return "Failed"
 
-        # Construct the SCP command
-        cmd_scp = [
-            "scp",
-            "-i",
-            "key.pem",
-            "-o",
-            "StrictHostKeyChecking=no",
-            "-o",
-            "UserKnownHostsFile=/dev/null",
-        ]
+            vm_plans, directories, archive = result
+            plans.extend(vm_plans)
+            if archive is not None:
+                archives.append(archive)
+            if directories:
+                target = destination
+                if transfer_type == "download" and len(vm_ids) > 1:
+                    target = os.path.join(destination, vm_id)
+                self.copy_directories(
+                    connections[vm_id], directories, target, transfer_type
+                )
 
-        # Add file paths based on the transfer type
-        if transfer_type == "upload":
-            # Add local files and remote destination
-            cmd_scp.extend(files)
-            cmd_scp.append(f"{ssh_user}@{host_ip}:{destination}")
-        else:
-            # Add remote files and local destination
-            for file in files:
-                cmd_scp.append(f"{ssh_user}@{host_ip}:{file}")
-            cmd_scp.append(destination)
+        verb = "Uploaded" if transfer_type == "upload" else "Downloaded"
+        errors = []
+
+        if archives:
+            progress, compressors, archive_errors = engine.transfer_archives(
+                archives, transfer_type
+            )
+            errors += archive_errors
+            elapsed = time.monotonic() - progress.start
+            print(
+                f"{verb} {sum(archive.files for archive in archives)} file(s) as "
+                f"{len(archives)} archive(s) ({', '.join(sorted(set(compressors))) or 'none'}), "
+                f"{progress.done / 1e6:.1f} MB in {elapsed:.1f}s ({progress.rate() / 1e6:.1f} MB/s)."
+            )
 
-        # Execute the SCP command using execute_command
-        output = self.execute_command(cmd_scp)
-        print(output)
+        if plans or not archives:
+            progress, file_errors = engine.transfer(plans, transfer_type)
+            errors += file_errors
+            copied = [plan for plan in plans if plan.chunks or plan.size != plan.remote_size]
+            elapsed = time.monotonic() - progress.start
+            print(
+                f"{verb} {len(copied)} file(s), {progress.done / 1e6:.1f} MB in {elapsed:.1f}s "
+                f"({progress.rate() / 1e6:.1f} MB/s); "
+                f"{len(plans) - len(copied)} already up to date."
+            )
 
-        self.cleanup_files("key.pem")
+        for path, error in errors:
+            print(f"Error: {path}: {error}")
 
-        return "Done"
+        return "Failed" if errors else "Done"
+
+    def parse_transfer_line(self, line, usage):
+        """
+        Parse `<infrastructure-id> [--vm selector] [--streams N] [--mode auto|archive|files]
+        <paths...> <destination>`.
+        """
+        words = line.split()
+        if len(words) < 3:
+            print(usage)
+            return None
 
-    def remove_infrastructure_from_list(self, inf_id):
-        # Load infrastructure list from JSON file
         try:
-            data = self.load_json(self.inf_list_path)
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            print(f"Error loading infrastructure list: {e}")
-            return "Failed"
+            options, paths = parse_exec_options(
+                words[1:], {"vm": "0", "streams": str(DEFAULT_STREAMS), "mode": "auto"}
+            )
+            streams = int(options["streams"])
+        except ValueError as e:
+            print(f"Error: {e}")
+            return None
 
-        # Find and remove the infrastructure with the specified ID
-        for infrastructure in data["infrastructures"]:
-            if infrastructure["infrastructureID"] == inf_id:
-                data["infrastructures"].remove(infrastructure)
-                break
+        if len(paths) < 2 or options["mode"] not in TRANSFER_MODES:
+            print(usage)
+            return None
+
+        return words[0], options["vm"], paths[:-1], paths[-1], streams, options["mode"]
+
+    def worker_vms(self, inf_id, system=None):
+        """
+        Return `(system, {vm_id: VMInfo})` for the worker VMs of an infrastructure.
+
+        Without `system`, the workers are the VMs of the only RADL system
+        other than the front-end's (VM 0).
+        """
+        vm_ids = self.list_vm_ids(inf_id)
+        vm_infos = {
+            vm_id: vm_info
+            for vm_id, vm_info, _ in fan_out(
+                lambda vm_id: self.get_vm_info(inf_id, vm_id, max_age=SSH_CONTEXT_TTL), vm_ids
+            )
+            if vm_info is not None
+        }
+
+        if system is None:
+            front_end = vm_infos["0"].system if "0" in vm_infos else None
+            systems = {vm_info.system for vm_info in vm_infos.values()} - {front_end}
+            if len(systems) != 1:
+                raise ValueError(
+                    f"Cannot tell the worker system of infrastructure {inf_id}"
+                    f" (systems: {', '.join(sorted(filter(None, systems))) or 'none'}); use --system."
+                )
+            system = systems.pop()
+
+        return system, {
+            vm_id: vm_info for vm_id, vm_info in vm_infos.items() if vm_info.system == system
+        }
+
+    def scale_infrastructure(self, inf_id, system, add=0, remove=()):
+        """
+        Add `add` VMs of `system` and remove the VMs in `remove`.
 
-        # Write the updated infrastructure list back to the JSON file
+        Each direction is a single IM request, whatever the number of VMs.
+        Returns the IDs of the added VMs.
+        """
+        self.initialize_im_client()
+        added = []
         try:
-            with open(self.inf_list_path, "w") as f:
-                json.dump(data, f, indent=4)
-        except IOError as e:
-            print(f"Error writing to file {self.inf_list_path}: {e}")
+            if add:
+                success, added = self.client.addresource(inf_id, scale_radl(system, add))
+                if not success:
+                    raise RuntimeError(added)
+            if remove:
+                success, result = self.client.removeresource(inf_id, list(remove))
+                if not success or "error" in str(result).lower():
+                    raise RuntimeError(result)
+        finally:
+            # The RADL, VM list and state of the infrastructure all change.
+            self.cache.invalidate(inf_id)
+            self.invalidate_ssh_context(inf_id)
+            self.watcher.watch(inf_id, fast=True)
+        return added
+
+    def queue_state(self, inf_id):
+        """Return the `QueueState` of the SLURM cluster of an infrastructure."""
+        exit_code, stdout, stderr = self.run_remote_command(inf_id, "0", [queue_script()])
+        if exit_code != 0:
+            raise RuntimeError(stderr.strip() or f"ssh exited with {exit_code}")
+        return parse_queue(stdout)
+
+    def forget_infrastructure(self, inf_id):
+        """Drop every cached resource of a destroyed infrastructure."""
+        self.cache.invalidate(inf_id)
+        self.invalidate_ssh_context(inf_id)
+        self.ssh.close(inf_id)
+        self.watcher.unwatch(inf_id)
+        self.slurm.forget(inf_id)
+        self.im_pool.forget(inf_id)
+        autoscaler = self.autoscalers.pop(inf_id, None)
+        if autoscaler is not None:
+            autoscaler.stop()
+
+    def remove_infrastructure_from_list(self, inf_id):
+        inf_ids = [inf_id] if isinstance(inf_id, str) else list(inf_id)
+
+        try:
+            self.store.remove(*inf_ids)
+        except sqlite3.Error as e:
+            print(f"Error updating the infrastructure list: {e}")
             return "Failed"
 
     def get_infrastructure_state(self, inf_id):
@@ -226,17 +765,42 @@ class Apricot_Magics(Magics):
 
         return state
 
-    def get_vm_ip(self, inf_id):
-        try:
-            self.initialize_im_client()
-            success, inf_info = self.client.get_infra_property(inf_id, "outputs")
-            ip = inf_info.get("node_ip")
+    def print_jobs(self, jobs):
+        print(
+            tabulate(
+                [
+                    [
+                        job.inf_id,
+                        job.job_id,
+                        job.name,
+                        job.state,
+                        "" if job.exit_code is None else job.exit_code,
+                        job.elapsed,
+                        job.nodes or job.reason,
+                    ]
+                    for job in jobs
+                ],
+                headers=["Infrastructure ID", "Job ID", "Name", "State", "Exit", "Elapsed", "Nodes / Reason"],
+                tablefmt="grid",
+            )
+        )
 
-        except Exception as e:
-            print(f"Error: {e}")
-            return "Failed"
+    def print_trace(self, trace):
+        """Print the spans of a traced command grouped by operation."""
+        print(f"Trace: {len(trace)} span(s) in {trace.seconds * 1000:.1f} ms")
+        if not trace:
+            return
 
-        return ip
+        print(
+            tabulate(
+                [
+                    [operation, calls, errors, f"{total * 1000:.1f}", f"{longest * 1000:.1f}"]
+                    for operation, (calls, errors, total, longest) in trace.breakdown().items()
+                ],
+                headers=["Operation", "Calls", "Errors", "Total (ms)", "Max (ms)"],
+                tablefmt="grid",
+            )
+        )
 
     ########################
     #    Manage tokens     #
@@ -244,118 +808,24 @@ class Apricot_Magics(Magics):
 
     def generate_new_access_token(self, refresh_token):
         """Generate a new access token using a refresh token."""
-        refresh_url = "https://aai.egi.eu/auth/realms/egi/protocol/openid-connect/token"
-        payload = {
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token,
-            "client_id": "token-portal",
-            "scope": "openid email profile voperson_id eduperson_entitlement",
-        }
-
-        response = requests.post(refresh_url, data=payload)
-
-        if response.status_code == 200:
-            new_access_token = response.json()["access_token"]
-            if not new_access_token:
-                print("Failed to generate a new access token.")
-                return None
-
-            print("New access token generated successfully.")
-
-            self.save_new_access_token(new_access_token)
-            return new_access_token
-
-        else:
-            print("Error generating access token:")
-            print(response.text)
+        try:
+            new_access_token = self.tokens.refresh(refresh_token)
+        except TokenRefreshError as e:
+            print(e)
             return None
 
-    def save_new_access_token(self, new_access_token):
-        """Save the new access token to the auth-file."""
-        with open(self.authfile_path, "r") as f:
-            lines = f.readlines()
-
-        updated_lines = []
-        for line in lines:
-            if "token =" in line:
-                parts = [part.strip() for part in line.split(";")]
-                updated_parts = []
-                for part in parts:
-                    if part.startswith("token ="):
-                        updated_parts.append(f"token = {new_access_token}")
-                    else:
-                        updated_parts.append(part)
-                updated_line = "; ".join(updated_parts)
-                updated_lines.append(updated_line + "\n")
-            else:
-                updated_lines.append(line)
-
-        with open(self.authfile_path, "w") as f:
-            f.writelines(updated_lines)
-
+        print("New access token generated successfully.")
         return new_access_token
 
-    def check_token(self):
-        """Check if the access token in the authfile is valid. Refresh if expired."""
-        access_token = None
-
-        try:
-            with open(self.authfile_path, "r") as f:
-                for line in f:
-                    if "token =" in line:
-                        parts = [part.strip() for part in line.split(";")]
-                        for part in parts:
-                            if part.startswith("token ="):
-                                access_token = part.split("=", 1)[1].strip()
-                                break
-                    if access_token:
-                        break
-        except FileNotFoundError:
-            print(f"Auth file not found: {self.authfile_path}")
-            return None
-
-        if not access_token:
-            print("No access token provided.")
-            return False
-
-        try:
-            decoded_token = jwt.decode(
-                access_token,
-                options={"verify_signature": False},
-                algorithms=["HS256", "RS256"],
-            )
-            expiry_time = decoded_token.get("exp", 0)
-            current_time = int(time.time())
-
-            if expiry_time > current_time:
-                return None  # Token is still valid
-            else:
-                print("Token has expired.")
-                data = self.load_json(self.inf_list_path)
-                refresh_token = data.get("refresh_token")
-
-                if not refresh_token:
-                    print(
-                        "No refresh token available. Run `%apricot_token <refresh_token>` first."
-                    )
-                    return None
-
-                return self.generate_new_access_token(refresh_token)
-
-        except jwt.DecodeError:
-            print("Invalid token format.")
-            return None
-
     ##################
     #     Magics     #
     ##################
 
     @line_magic
+    @traced
     def apricot_token(self, line):
-        data = self.load_json(self.inf_list_path)
-
         if not line:
-            refresh_token = data.get("refresh_token", "").strip()
+            refresh_token = self.store.get_setting("refresh_token", "").strip()
 
             if not refresh_token:
                 print(
@@ -368,189 +838,716 @@ class Apricot_Magics(Magics):
 
         # If a new token is provided via command line
         refresh_token = line.strip()
-        data["refresh_token"] = refresh_token
-
-        with open(self.inf_list_path, "w") as f:
-            json.dump(data, f, indent=4)
+        self.store.set_setting("refresh_token", refresh_token)
 
         self.generate_new_access_token(refresh_token)
 
-    @line_magic
-    def apricot_log(self, line):
-        if not line:
-            return "Usage: `%apricot_log <infrastructure-id>`\n"
-
-        inf_id = line.split()[0]
+    def set_im_endpoints(self, endpoints):
+        """
+        Replace the IM endpoints, keeping every infrastructure on its own IM.
+
+        Records without an endpoint belong to the default one, so they are
+        given it explicitly before a different endpoint becomes the default.
+        """
+        default = self.im_pool.default
+        if endpoints and endpoints[0].rstrip("/") != default:
+            self.store.add(*[
+                dict(record, imEndpoint=default)
+                for record in self.store.list()
+                if not record.get("imEndpoint")
+            ])
+
+        self.im_pool.endpoints = endpoints
+        self.im_pool.bound.clear()
+        self.store.set_setting("im_endpoints", json.dumps(self.im_pool.endpoints))
 
+    @line_magic
+    @traced
+    def apricot_endpoints(self, line):
+        usage = (
+            "Usage: `%apricot_endpoints [--add URL ...] [--remove URL ...] [--default URL]"
+            f" [--policy {'|'.join(ROUTING_POLICIES)}] [--probe]`"
+        )
         try:
-            self.initialize_im_client()
-            success, inf_info = self.client.get_infra_property(inf_id, "contmsg")
-
-        except Exception as e:
+            options, args = parse_line_options(
+                line.split(),
+                {"add": [], "remove": [], "default": None, "policy": None, "probe": False},
+            )
+        except ValueError as e:
             print(f"Error: {e}")
-            return "Failed"
-
-        print(inf_info)
+            print(usage)
+            return "Fail"
 
-    @line_magic
-    def apricot_ls(self, line):
-        infrastructures_list = []
+        if args:
+            print(usage)
+            return "Fail"
 
-        data = self.load_json(self.inf_list_path)
+        pool = self.im_pool
+        self.load_state()
+        infrastructures = self.store.list()
+        pool.bind_records(infrastructures)
+        counts = Counter(
+            pool.endpoint_of(infrastructure["infrastructureID"])
+            for infrastructure in infrastructures
+        )
 
-        for infrastructure in data.get("infrastructures", []):
-            infrastructure_info = {
-                "Name": infrastructure.get("name", ""),
-                "InfrastructureID": infrastructure.get("infrastructureID", ""),
-                "IP": "",
-                "State": "",
-            }
+        try:
+            endpoints = list(pool.endpoints)
+            for endpoint in options["add"]:
+                if endpoint.rstrip("/") not in endpoints:
+                    endpoints.append(endpoint.rstrip("/"))
+            for endpoint in options["remove"]:
+                endpoint = endpoint.rstrip("/")
+                if endpoint not in endpoints:
+                    raise ValueError(f"Unknown IM endpoint {endpoint}")
+                if counts[endpoint]:
+                    raise ValueError(
+                        f"{counts[endpoint]} infrastructure(s) still use {endpoint}"
+                    )
+                endpoints.remove(endpoint)
+            if options["default"] is not None:
+                default = options["default"].rstrip("/")
+                if default not in endpoints:
+                    raise ValueError(f"Unknown IM endpoint {default}")
+                endpoints.remove(default)
+                endpoints.insert(0, default)
+
+            if endpoints != pool.endpoints:
+                self.set_im_endpoints(endpoints)
+            if options["policy"] is not None:
+                pool.policy = options["policy"]
+                self.store.set_setting("im_routing", pool.policy)
+        except (ValueError, sqlite3.Error) as e:
+            print(f"Error: {e}")
+            return "Failed"
 
+        if options["probe"]:
             try:
-                self.authfile_path
-                infrastructure_info["State"] = self.get_infrastructure_state(
-                    infrastructure_info["InfrastructureID"]
-                )
-                infrastructure_info["IP"] = self.get_vm_ip(
-                    infrastructure_info["InfrastructureID"]
-                )
-
+                self.initialize_im_client()
             except Exception as e:
                 print(f"Error: {e}")
                 return "Failed"
-
-            infrastructures_list.append(infrastructure_info)
-
-        infrastructure_data = [
-            [infra["Name"], infra["InfrastructureID"], infra["IP"], infra["State"]]
-            for infra in infrastructures_list
-        ]
+            fan_out(pool.probe, pool.endpoints)
+
+        rows = []
+        for endpoint in pool.endpoints:
+            latency = pool.latencies.get(endpoint)
+            if latency is None:
+                latency_text = ""
+            elif latency == float("inf"):
+                latency_text = "unreachable"
+            else:
+                latency_text = f"{latency * 1000:.0f}"
+            rows.append([
+                endpoint,
+                "yes" if endpoint == pool.default else "",
+                counts[endpoint],
+                latency_text,
+            ])
 
         print(
             tabulate(
-                infrastructure_data,
-                headers=[
-                    "Infrastructure name",
-                    "Infrastructure ID",
-                    "IP Address",
-                    "Status",
-                ],
+                rows,
+                headers=["IM endpoint", "Default", "Infrastructures", "Latency (ms)"],
                 tablefmt="grid",
             )
         )
+        print(f"New infrastructures are routed by {pool.policy}.")
 
-    def get_raw_infrastructure_info(self, inf_id):
-        try:
-            self.initialize_im_client()
-            success, inf_info = self.client.getinfo(inf_id)
-            return list(inf_info)
+    def fetch_log(self, inf_id, vm_id=None):
+        """Return the contextualization log of an infrastructure, or of one of its VMs."""
+        if vm_id is None:
+            success, log = self.client.get_infra_property(inf_id, "contmsg")
+        else:
+            success, log = self.client.getvminfo(inf_id, vm_id, "contmsg")
 
-        except Exception as e:
-            print(f"Error: {e}")
-            return None
+        if not success:
+            raise RuntimeError(str(log).strip())
+        return log or ""
 
     @line_magic
-    def apricot_radl(self, line):
+    @traced
+    def apricot_log(self, line):
+        usage = (
+            "Usage: `%apricot_log <infrastructure-id> [-f] [--vm selector] [--grep regex]`\n"
+        )
         if not line:
-            return "Usage: `%apricot_radl infrastructure-id`\n"
+            return usage
 
-        inf_id = line.split()[0]
-        inf_info_items = self.get_raw_infrastructure_info(inf_id)
-
-        if inf_info_items is None:
-            return "Failed"
+        words = ["--follow" if word == "-f" else word for word in line.split()]
+        try:
+            options, args = parse_line_options(
+                words, {"follow": False, "vm": None, "grep": None}
+            )
+            pattern = re.compile(options["grep"]) if options["grep"] else None
+        except (ValueError, re.error) as e:
+            print(f"Error: {e}")
+            print(usage)
+            return "Fail"
+
+        if len(args) != 1:
+            print(usage)
+            return "Fail"
+
+        inf_id = args[0]
+
+        try:
+            self.initialize_im_client()
+            vm_ids = [None]
+            if options["vm"] is not None:
+                vm_ids = self.resolve_vm_selector(inf_id, options["vm"])
+        except Exception as e:
+            print(f"Error: {e}")
+            return "Failed"
+
+        if not vm_ids:
+            print(f"Error: No VM matches '{options['vm']}' in infrastructure {inf_id}.")
+            return "Failed"
 
-        for item in inf_info_items:
-            print(*item, sep="\n")
+        cursors = {vm_id: LogCursor(pattern) for vm_id in vm_ids}
+        prefix = len(vm_ids) > 1
+        interval = LOG_MIN_INTERVAL
+
+        try:
+            while True:
+                # Read the state first, so a log fetched after it settled is complete.
+                final = not options["follow"] or (
+                    self.get_infrastructure_state(inf_id) in SETTLED_STATES
+                )
+
+                shown = False
+                for vm_id, log, error in fan_out(
+                    lambda vm_id: self.fetch_log(inf_id, vm_id), vm_ids
+                ):
+                    if error is not None:
+                        print(f"Error: {error}")
+                        return "Failed"
+
+                    for log_line in cursors[vm_id].feed(log, final):
+                        print(f"VM {vm_id}: {log_line}" if prefix else log_line, flush=True)
+                        shown = True
+
+                if final:
+                    return
+
+                # Poll quickly while the log grows, backing off while it is quiet.
+                interval = LOG_MIN_INTERVAL if shown else min(interval * 2, LOG_MAX_INTERVAL)
+                time.sleep(interval)
+
+        except KeyboardInterrupt:
+            print("\nStopped following the log.")
+
+    def fetch_infrastructure_status(self, inf_id):
+        """Return `(state, ip)` for one infrastructure, raising on IM errors."""
+        client = self.im_pool.client
+        success, state_info = client.get_infra_property(inf_id, "state")
+        if not success:
+            raise RuntimeError(state_info)
+
+        success, outputs = client.get_infra_property(inf_id, "outputs")
+        if not success:
+            raise RuntimeError(outputs)
+
+        state = state_info.get("state", "Error getting status info")
+        ip = (outputs or {}).get("node_ip")
+
+        # Recipes without a `node_ip` output: use the front-end's RADL if it was parsed recently.
+        if not ip:
+            vm_info = self.radl_cache.get(inf_id, "0", SSH_CONTEXT_TTL)
+            if vm_info is not None:
+                ip = vm_address(vm_info)[0]
+
+        # Settled statuses are kept on disk so the next session can list them right away.
+        self.cache.update(
+            "status", inf_id, [state, ip], inf_id,
+            cacheable=lambda status: status[0] in SETTLED_STATES,
+        )
+        return state, ip
 
     @line_magic
-    def apricot_info(self, line):
-        if not line:
-            return "Usage: `%apricot_info infrastructure-id`\n"
+    @traced
+    def apricot_ls(self, line):
+        opts, _ = self.parse_options(line, "w:t:r", "workers=", "timeout=", "refresh")
+
+        try:
+            max_workers = int(opts.get("workers", opts.get("w", DEFAULT_MAX_WORKERS)))
+            timeout = opts.get("timeout", opts.get("t"))
+            timeout = float(timeout) if timeout is not None else None
+        except ValueError:
+            print("Usage: `%apricot_ls [--workers N] [--timeout seconds] [--refresh]`")
+            return "Fail"
 
-        inf_id = line.split()[0]
-        inf_info_items = self.get_raw_infrastructure_info(inf_id)
+        refresh = "refresh" in opts or "r" in opts
+
+        infrastructures = self.store.list()
+        self.im_pool.bind_records(infrastructures)
+
+        # Infrastructures still changing are listed from the watcher, and
+        # settled ones from the disk cache. Expired disk entries are still shown
+        # while the watcher fetches them again in the background.
+        statuses = {}
+        if not refresh:
+            for infrastructure in infrastructures:
+                inf_id = infrastructure.get("infrastructureID", "")
+                status = self.watcher.get(inf_id)
+                if status is not None and status.error is None:
+                    statuses[inf_id] = (status.state, status.ip)
+                    continue
+
+                cached = self.cache.get("status", inf_id)
+                if cached is not None:
+                    (state, ip), age = cached
+                    statuses[inf_id] = (state, ip)
+                    if age > self.cache.ttls["status"]:
+                        self.watcher.watch(inf_id)
+
+        to_fetch = [
+            infrastructure
+            for infrastructure in infrastructures
+            if infrastructure.get("infrastructureID", "") not in statuses
+        ]
 
-        if inf_info_items is None:
+        try:
+            if to_fetch:
+                self.initialize_im_client()
+        except Exception as e:
+            print(f"Error: {e}")
             return "Failed"
 
-        vm_info_list = []
+        results = fan_out(
+            lambda infrastructure: self.fetch_infrastructure_status(
+                infrastructure.get("infrastructureID", "")
+            ),
+            to_fetch,
+            max_workers=max_workers,
+            timeout=timeout,
+        )
 
-        def extract_property(output, names, operators=("=", ">=")):
-            for name in names:
-                for operator in operators:
-                    pattern = rf"{re.escape(name)}\s*{re.escape(operator)}\s*'([^']*)'"
-                    match = re.search(pattern, output)
-                    if match:
-                        return match.group(1).split()[0]
+        errors = {}
+        fetched = {}
+        for infrastructure, status, error in results:
+            inf_id = infrastructure.get("infrastructureID", "")
+            if error is not None:
+                errors[inf_id] = error
+            else:
+                fetched[inf_id] = statuses[inf_id] = status
+                if status[0] not in SETTLED_STATES:
+                    self.watcher.record(inf_id, *status)
+                    self.watcher.watch(inf_id)
 
-                    pattern = rf"{re.escape(name)}\s*{re.escape(operator)}\s*([^\s\n]+)"
-                    match = re.search(pattern, output)
-                    if match:
-                        return match.group(1).strip("'")
+        if fetched:
+            self.store.update_status(fetched)
 
-            return "N/A"
+        infrastructure_data = []
+        # With several IMs, show which one each infrastructure belongs to.
+        show_endpoints = len(self.im_pool.endpoints) > 1
 
-        for item in inf_info_items:
-            vm_id = item[0]
-            output_string = item[2] if len(item) > 2 else ""
+        for infrastructure in infrastructures:
+            inf_id = infrastructure.get("infrastructureID", "")
 
-            vm_info_list.append(
-                [
-                    vm_id,
-                    extract_property(
-                        output_string,
-                        ["net_interface.1.ip", "net_interface.0.ip", "node_ip"],
-                    ),
-                    extract_property(output_string, ["provider.type"]),
-                    extract_property(output_string, ["disk.0.size"]),
-                    extract_property(output_string, ["cpu.count"]),
-                    extract_property(output_string, ["memory.size"]),
-                    extract_property(output_string, ["gpu.count"]),
-                ]
-            )
-
-        if not vm_info_list:
-            print("No VM information found.")
-            return
+            if inf_id in errors:
+                state, ip = "Error", ""
+            else:
+                state, ip = statuses[inf_id]
 
-        # Print table
-        print(
-            tabulate(
-                vm_info_list,
-                headers=[
-                    "VM ID",
-                    "IP Address",
-                    "Provider",
-                    "Disk Size",
-                    "CPU Count",
-                    "Memory Size",
-                    "GPU Count",
-                ],
-                tablefmt="grid",
+            row = [infrastructure.get("name", ""), inf_id, ip or "", state]
+            if show_endpoints:
+                row.append(self.im_pool.endpoint_of(inf_id))
+            infrastructure_data.append(row)
+
+        headers = ["Infrastructure name", "Infrastructure ID", "IP Address", "Status"]
+        if show_endpoints:
+            headers.append("IM endpoint")
+        print(tabulate(infrastructure_data, headers=headers, tablefmt="grid"))
+
+        if errors:
+            print(f"Could not get the status of {len(errors)} infrastructure(s):")
+            for inf_id, error in errors.items():
+                print(f"  {inf_id}: {error}")
+
+    @line_magic
+    @traced
+    def apricot_wait(self, line):
+        usage = "Usage: `%apricot_wait <infrastructure-id> [state] [--timeout 30m]`"
+        try:
+            options, args = parse_line_options(line.split(), {"timeout": None})
+            timeout = options["timeout"]
+            timeout = parse_duration(timeout) if timeout is not None else None
+        except ValueError as e:
+            print(f"Error: {e}")
+            print(usage)
+            return "Fail"
+
+        if len(args) not in (1, 2):
+            print(usage)
+            return "Fail"
+
+        inf_id = args[0]
+        target = args[1] if len(args) == 2 else "configured"
+
+        start = time.monotonic()
+        try:
+            status = self.watcher.wait_until(inf_id, {target}, timeout)
+        except TimeoutError:
+            status = self.watcher.get(inf_id)
+            print(
+                f"Timed out waiting for infrastructure {inf_id} to be {target}"
+                f" (last state: {status.state if status else 'unknown'})."
+            )
+            return "Failed"
+
+        elapsed = time.monotonic() - start
+        print(f"Infrastructure {inf_id} is {status.state} (after {elapsed:.0f}s).")
+
+        if status.state != target and status.state in FAILED_STATES:
+            return "Failed"
+
+        return "Done"
+
+    def load_infrastructure_info(self, inf_id):
+        """Return `[vm_id, success, radl]` for every VM of an infrastructure."""
+        self.initialize_im_client()
+        success, inf_info = self.client.getinfo(inf_id)
+        if not success:
+            raise RuntimeError(inf_info)
+        return [list(item) for item in inf_info]
+
+    def infrastructure_info_settled(self, inf_id, items):
+        try:
+            return all(
+                success and self.radl_cache.parse(inf_id, vm_id, radl).state in SETTLED_STATES
+                for vm_id, success, radl in items
+            )
+        except RADLSyntaxError:
+            return False
+
+    def fetch_vm_properties(self, inf_id, vm_id, patterns):
+        """
+        Return the `(name, value)` pairs of the properties of a VM matching `patterns`.
+
+        Plain property names are asked to the IM one by one, so only their
+        values are transferred; patterns with wildcards need the whole RADL,
+        which is dropped once matched.
+        """
+        if any(is_property_pattern(pattern) for pattern in patterns):
+            success, radl = self.client.getvminfo(inf_id, vm_id)
+            if not success:
+                raise RuntimeError(str(radl).strip())
+            return select_properties(self.radl_cache.parse(inf_id, vm_id, radl).properties, patterns)
+
+        properties, errors = [], []
+        for name in patterns:
+            success, value = self.client.getvminfo(inf_id, vm_id, name)
+            if success:
+                properties.append((name, str(value).strip()))
+            else:
+                errors.append(str(value).strip())
+        # The IM answers properties a VM does not have with an error.
+        if errors and not properties:
+            raise RuntimeError(errors[0])
+        return properties
+
+    def iter_infrastructure_info(self, inf_id, selector=None, patterns=None, page=1,
+                                 page_size=INFO_PAGE_SIZE, refresh=False,
+                                 max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Return `(items, total, first)` for the VMs of an infrastructure picked
+        by `selector` and `page`.
+
+        `items` yields `(vm_id, success, value)` in VM order, where `value`
+        is the RADL of the VM or, with `patterns`, its matching
+        `(name, value)` property pairs; `total` is the number of VMs
+        selected and `first` the position of the page's first one.
+
+        A settled infrastructure is answered from the disk cache, expired
+        entries being served while they are fetched again in the background.
+        Otherwise only the VMs of the page are fetched, a few at a time, and
+        yielded as they arrive. Answers covering every VM are kept in the
+        cache once all of them have settled.
+        """
+        if refresh:
+            self.cache.invalidate_entry("radl", inf_id)
+        cached = None if refresh else self.cache.get("radl", inf_id)
+
+        if cached is not None:
+            cached_items, age = cached
+            if age > self.cache.ttls["radl"]:
+                self.cache.revalidate(
+                    "radl",
+                    inf_id,
+                    lambda: self.load_infrastructure_info(inf_id),
+                    inf_id,
+                    cacheable=lambda items: self.infrastructure_info_settled(inf_id, items),
+                )
+            vm_ids = [str(vm_id) for vm_id, _, _ in cached_items]
+        else:
+            vm_ids = self.list_vm_ids(inf_id)
+
+        if selector is None:
+            selected = vm_ids
+        elif selector.startswith("role:") and cached is not None:
+            role = selector[len("role:"):]
+            selected = []
+            for vm_id, success, radl in cached_items:
+                try:
+                    if success and self.radl_cache.parse(inf_id, vm_id, radl).system == role:
+                        selected.append(str(vm_id))
+                except RADLSyntaxError:
+                    pass
+        elif selector.startswith("role:"):
+            selected = self.resolve_vm_selector(inf_id, selector, max_workers)
+        else:
+            selected = select_vm_ids(selector, vm_ids)
+
+        first = (page - 1) * page_size if page_size else 0
+        page_ids = selected[first:first + page_size] if page_size else selected
+
+        def project(vm_id, success, radl):
+            if patterns is None or not success:
+                return vm_id, success, radl
+            try:
+                properties = self.radl_cache.parse(inf_id, vm_id, radl).properties
+            except RADLSyntaxError as e:
+                return vm_id, False, f"Error parsing the RADL: {e}"
+            return vm_id, True, select_properties(properties, patterns)
+
+        if cached is not None:
+            wanted = set(page_ids)
+            items = (
+                project(str(vm_id), success, radl)
+                for vm_id, success, radl in cached_items
+                if str(vm_id) in wanted
+            )
+            return items, len(selected), first
+
+        def fetch(vm_id):
+            if patterns is not None:
+                return True, self.fetch_vm_properties(inf_id, vm_id, patterns)
+            return self.client.getvminfo(inf_id, vm_id)
+
+        # The whole answer is only gathered for the cache when it is being shown whole anyway.
+        complete = patterns is None and page_ids == vm_ids
+
+        def stream():
+            gathered = []
+            for vm_id, result, error in map_ordered(fetch, page_ids, max_workers):
+                success, value = (False, str(error)) if error is not None else result
+                if complete:
+                    gathered.append([vm_id, success, value])
+                yield vm_id, success, value
+
+            if complete and self.infrastructure_info_settled(inf_id, gathered):
+                self.cache.put("radl", inf_id, gathered, inf_id)
+
+        return stream(), len(selected), first
+
+    def parse_info_options(self, line, usage):
+        """Parse the options shared by `%apricot_info` and `%apricot_radl`."""
+        options, args = parse_line_options(
+            line.split(),
+            {
+                "refresh": False,
+                "vm": None,
+                "prop": [],
+                "page": "1",
+                "page-size": str(INFO_PAGE_SIZE),
+                "workers": str(DEFAULT_MAX_WORKERS),
+            },
+        )
+        if len(args) != 1:
+            raise ValueError(usage)
+        options["page"] = int(options["page"])
+        options["page-size"] = int(options["page-size"])
+        options["workers"] = int(options["workers"])
+        if options["page"] < 1 or options["page-size"] < 0:
+            raise ValueError("--page must be 1 or more and --page-size 0 (all) or more")
+        return args[0], options
+
+    def open_info(self, line, usage):
+        """
+        Return `(inf_id, items, total, first, options)` for an info magic, or
+        None after printing why not.
+        """
+        try:
+            inf_id, options = self.parse_info_options(line, usage)
+        except ValueError as e:
+            message = str(e)
+            print(message if message == usage else f"Error: {message}\n{usage}")
+            return None
+
+        try:
+            items, total, first = self.iter_infrastructure_info(
+                inf_id,
+                options["vm"],
+                options["prop"] or None,
+                options["page"],
+                options["page-size"],
+                options["refresh"],
+                options["workers"],
             )
+        except Exception as e:
+            print(f"Error: {e}")
+            return None
+        return inf_id, items, total, first, options
+
+    def print_page_footer(self, total, first, shown, options):
+        """Tell which VMs were shown when the selection spans several pages."""
+        if total <= shown and first == 0:
+            return
+        if not shown:
+            print(f"No VMs on page {options['page']}; {total} VM(s) selected.")
+            return
+
+        print(f"VMs {first + 1}-{first + shown} of {total}.", end="")
+        if first + shown < total:
+            print(f" Use `--page {options['page'] + 1}` for more.", end="")
+        print()
+
+    @line_magic
+    @traced
+    def apricot_radl(self, line):
+        usage = (
+            "Usage: `%apricot_radl infrastructure-id [--vm <selector>] [--prop name ...]"
+            " [--page N] [--page-size N] [--refresh]`\n"
+        )
+        opened = self.open_info(line, usage)
+        if opened is None:
+            return "Failed"
+        inf_id, items, total, first, options = opened
+
+        # Each VM is printed as soon as it arrives and then dropped.
+        shown = 0
+        failed = False
+        for vm_id, success, value in items:
+            shown += 1
+            if not success:
+                failed = True
+                print(f"Error getting the RADL of VM {vm_id}: {value}")
+            elif options["prop"]:
+                for name, property_value in value:
+                    print(f"{vm_id}: {name} = {format_property(name, property_value)}")
+            else:
+                print(vm_id, success, value, sep="\n")
+            sys.stdout.flush()
+
+        if not total:
+            print("No VM information found.")
+        self.print_page_footer(total, first, shown, options)
+        return "Failed" if failed else None
+
+    @line_magic
+    @traced
+    def apricot_info(self, line):
+        usage = (
+            "Usage: `%apricot_info infrastructure-id [--vm <selector>] [--prop name ...]"
+            " [--page N] [--page-size N] [--refresh]`\n"
         )
+        opened = self.open_info(line, usage)
+        if opened is None:
+            return "Failed"
+        inf_id, items, total, first, options = opened
+
+        headers = [
+            "VM ID",
+            "IP Address",
+            "Provider",
+            "Disk Size",
+            "CPU Count",
+            "Memory Size",
+            "GPU Count",
+        ]
 
-        return
+        def row(vm_id, success, value):
+            if not success:
+                print(f"Error getting the RADL of VM {vm_id}: {value}")
+                return {"VM ID": vm_id}
+            if options["prop"]:
+                return {"VM ID": vm_id, **{
+                    name: format_property(name, property_value) for name, property_value in value
+                }}
+
+            try:
+                vm_info = self.radl_cache.parse(inf_id, vm_id, value)
+            except RADLSyntaxError as e:
+                print(f"Error parsing the RADL of VM {vm_id}: {e}")
+                return {"VM ID": vm_id}
+            return dict(zip(headers, [
+                vm_id,
+                vm_address(vm_info)[0] or "N/A",
+                vm_info.provider or "N/A",
+                format_size(vm_info.disks[0].size if vm_info.disks else None),
+                "N/A" if vm_info.cpu_count is None else vm_info.cpu_count,
+                format_size(vm_info.memory_size, MEMORY_UNITS),
+                "N/A" if vm_info.gpu_count is None else vm_info.gpu_count,
+            ]))
+
+        def print_rows(rows):
+            columns = headers
+            if options["prop"]:
+                columns = ["VM ID"]
+                for vm_row in rows:
+                    columns += [name for name in vm_row if name not in columns]
+            print(
+                tabulate(
+                    [[vm_row.get(column, "N/A") for column in columns] for vm_row in rows],
+                    headers=columns,
+                    tablefmt="grid",
+                )
+            )
+            sys.stdout.flush()
+
+        # Rows are printed in small tables as VMs arrive, so the output grows
+        # while the rest are fetched and only a few rows are held at a time.
+        shown = 0
+        rows = []
+        for item in items:
+            rows.append(row(*item))
+            shown += 1
+            if len(rows) == INFO_TABLE_ROWS:
+                print_rows(rows)
+                rows = []
+        if rows:
+            print_rows(rows)
+
+        if not total:
+            print("No VM information found.")
+        self.print_page_footer(total, first, shown, options)
 
     @line_cell_magic
+    @traced
     def apricot_create(self, line):
+        usage = "Usage: `%apricot_create [--endpoint URL] [--no-validate] <recipe>`\n"
+        endpoint = None
+        validate = True
+        while True:
+            words = line.split(None, 1)
+            if words and words[0] == "--no-validate":
+                validate = False
+                line = words[1] if len(words) == 2 else ""
+            elif words and words[0] == "--endpoint":
+                words = line.split(None, 2)
+                if len(words) < 3:
+                    print(usage)
+                    return "Fail"
+                endpoint, line = words[1], words[2]
+            else:
+                break
+
         if not line:
-            print("Usage: `%apricot_create <recipe>`\n")
+            print(usage)
             return "Fail"
 
         inf_desc = line
 
         try:
-            if inf_desc.startswith("[") or inf_desc.startswith("{"):
-                desc_type = "json"
-            elif "tosca_definitions_version" in inf_desc:
-                desc_type = "yaml"
-            else:
-                desc_type = "radl"
+            desc_type = detect_recipe_type(inf_desc)
+            if validate:
+                self.check_recipe(inf_desc, desc_type)
 
             self.initialize_im_client()
-            success, inf_info = self.client.create(inf_desc, desc_type)
+            success, inf_info = self.client.create(
+                inf_desc, desc_type, asyncr=True, endpoint=endpoint
+            )
 
         except Exception as e:
             print(f"Error: {e}")
@@ -560,52 +1557,282 @@ class Apricot_Magics(Magics):
             print(inf_info)
         else:
             print("Infrastructure with ID " + inf_info + " successfully created.")
+            print(f"Run `%apricot_wait {inf_info}` to wait until it is configured.")
+            self.watcher.watch(inf_info, fast=True)
+
+            self.store.add(
+                {"infrastructureID": inf_info, "imEndpoint": self.im_pool.endpoint_of(inf_info)}
+            )
+
+    def check_recipe(self, inf_desc, desc_type):
+        """Validate a recipe locally, printing its warnings and raising if it is invalid."""
+        result = self.validator.check(inf_desc, desc_type)
+        for warning in result.warnings:
+            print(f"Warning: {warning}")
+
+    @line_cell_magic
+    @traced
+    def apricot_validate(self, line, cell=None):
+        usage = "Usage: `%apricot_validate <recipe-file>` or `%%apricot_validate` with the recipe\n"
+        source = (cell if cell is not None else line).strip()
+        if not source:
+            print(usage)
+            return "Fail"
+
+        if cell is None and os.path.isfile(source):
+            try:
+                source = Path(source).read_text()
+            except OSError as e:
+                print(f"Error: {e}")
+                return "Failed"
 
-            data = self.load_json(self.inf_list_path)
+        result = self.validator.validate(source, detect_recipe_type(source))
+        for warning in result.warnings:
+            print(f"Warning: {warning}")
+        if result.errors:
+            print("Invalid recipe:")
+            for error in result.errors:
+                print(f"  - {error}")
+            return "Failed"
 
-            new_infra = {"infrastructureID": inf_info}
-            data["infrastructures"].append(new_infra)
+        print(f"The {RECIPE_TYPE_NAMES[result.desc_type]} recipe is valid.")
+        return "Done"
 
-            with open(self.inf_list_path, "w") as f:
-                json.dump(data, f, indent=4)
+    def load_bulk_recipes(self, source, assignments, name_prefix):
+        """
+        Build the `(name, parameters, recipe)` list of a bulk deployment.
+
+        `source` is either a TOSCA template expanded with the parameter
+        matrix of `assignments`, or a directory with one recipe per file.
+        """
+        if os.path.isdir(source):
+            if assignments:
+                raise ValueError("--set cannot be used with a directory of recipes")
+            recipes = []
+            for path in sorted(Path(source).iterdir()):
+                if path.is_file() and path.suffix in (".yaml", ".yml", ".radl", ".json"):
+                    recipes.append((f"{name_prefix}-{path.stem}", {}, path.read_text()))
+            return recipes
+
+        template = Path(source).read_text()
+        matrix = expand_parameter_matrix(assignments) if assignments else [{}]
+        if matrix != [{}] and detect_recipe_type(template) != "yaml":
+            raise ValueError("--set can only be used with TOSCA templates")
+
+        return [
+            (
+                f"{name_prefix}-{index}",
+                parameters,
+                render_tosca_template(template, parameters) if parameters else template,
+            )
+            for index, parameters in enumerate(matrix)
+        ]
 
     @line_magic
-    def apricot_upload(self, line):
-        if len(line) == 0 or len(line.split()) < 3:
-            print(
-                "Usage: `%apricot_upload <infrastructure-id> <file1> <file2> ... <fileN> <remote-destination-path>`\n"
+    @traced
+    def apricot_bulk_create(self, line):
+        usage = (
+            "Usage: `%apricot_bulk_create <template-or-directory> [--set input=v1,v2 ...]"
+            " [--name prefix] [--group name] [--rate submissions/s] [--workers N]"
+            " [--endpoint URL] [--no-validate]`"
+        )
+
+        try:
+            options, args = parse_line_options(
+                line.split(),
+                {
+                    "set": [],
+                    "name": None,
+                    "group": None,
+                    "rate": "2",
+                    "workers": str(DEFAULT_MAX_WORKERS),
+                    "endpoint": None,
+                    "no-validate": False,
+                },
             )
+            rate = float(options["rate"])
+            max_workers = int(options["workers"])
+        except ValueError as e:
+            print(f"Error: {e}")
+            print(usage)
             return "Fail"
 
-        words = line.split()
-        inf_id = words[0]
-        vm_id = "0"  # words[1]
-        destination = words[-1]
-        files = words[1:-1]
+        if len(args) != 1:
+            print(usage)
+            return "Fail"
+
+        source = args[0]
+        name_prefix = options["name"] or Path(source).stem
+        group = options["group"] or name_prefix
+
+        try:
+            recipes = self.load_bulk_recipes(source, options["set"], name_prefix)
+            self.initialize_im_client()
+        except Exception as e:
+            print(f"Error: {e}")
+            return "Failed"
+
+        if not recipes:
+            print(f"No recipes found in {source}.")
+            return "Fail"
+
+        # Nothing is submitted unless every recipe passes the local checks.
+        if not options["no-validate"]:
+            invalid = []
+            for name, _, recipe in recipes:
+                result = self.validator.validate(recipe, detect_recipe_type(recipe))
+                if result.errors:
+                    invalid.append((name, result))
+            if invalid:
+                for name, result in invalid:
+                    print(f"Invalid recipe {name}:")
+                    for error in result.errors:
+                        print(f"  - {error}")
+                print(f"{len(invalid)} of {len(recipes)} recipe(s) are invalid; nothing was submitted.")
+                return "Failed"
+
+        limiter = RateLimiter(rate)
+
+        def submit(recipe):
+            limiter.acquire()
+            inf_desc = recipe[2]
+            success, inf_info = self.client.create(
+                inf_desc, detect_recipe_type(inf_desc), asyncr=True, endpoint=options["endpoint"]
+            )
+            if not success or "error" in inf_info.lower():
+                raise RuntimeError(inf_info.strip())
+            return inf_info
+
+        print(f"Submitting {len(recipes)} infrastructures...")
+        results = fan_out(submit, recipes, max_workers=max_workers)
+
+        created = []
+        summary = []
+        for (name, parameters, _), inf_id, error in results:
+            parameters_text = ", ".join(f"{k}={v}" for k, v in parameters.items())
+            if error is not None:
+                summary.append([name, parameters_text, "", f"Failed: {error}"])
+            else:
+                summary.append([name, parameters_text, inf_id, "Submitted"])
+                created.append({
+                    "infrastructureID": inf_id,
+                    "name": name,
+                    "group": group,
+                    "imEndpoint": self.im_pool.endpoint_of(inf_id),
+                })
+
+        if created:
+            self.store.add(*created)
+
+            for infrastructure in created:
+                self.watcher.watch(infrastructure["infrastructureID"], fast=True)
+
+        print(
+            tabulate(
+                summary,
+                headers=["Name", "Parameters", "Infrastructure ID", "Result"],
+                tablefmt="grid",
+            )
+        )
+        print(
+            f"{len(created)} of {len(recipes)} infrastructures submitted"
+            f" (group '{group}')."
+        )
+
+        return "Done" if len(created) == len(recipes) else "Failed"
+
+    @line_magic
+    @traced
+    def apricot_bulk_destroy(self, line):
+        usage = "Usage: `%apricot_bulk_destroy <infrastructure-id> ... | --group name [--workers N]`"
+
+        try:
+            options, inf_ids = parse_line_options(
+                line.split(), {"group": None, "workers": str(DEFAULT_MAX_WORKERS)}
+            )
+            max_workers = int(options["workers"])
+        except ValueError as e:
+            print(f"Error: {e}")
+            print(usage)
+            return "Fail"
+
+        if options["group"]:
+            inf_ids += [
+                infrastructure["infrastructureID"]
+                for infrastructure in self.store.list(group=options["group"])
+            ]
+
+        if not inf_ids:
+            print(usage)
+            return "Fail"
+
+        try:
+            self.initialize_im_client()
+        except Exception as e:
+            print(f"Error: {e}")
+            return "Failed"
+
+        def destroy(inf_id):
+            success, inf_info = self.client.destroy(inf_id)
+            if not success:
+                raise RuntimeError(inf_info.strip())
+
+        print(f"Destroying {len(inf_ids)} infrastructures... Please wait.")
+        results = fan_out(destroy, inf_ids, max_workers=max_workers)
+
+        destroyed = [inf_id for inf_id, _, error in results if error is None]
+        if destroyed:
+            self.remove_infrastructure_from_list(destroyed)
+            for inf_id in destroyed:
+                self.forget_infrastructure(inf_id)
+
+        print(
+            tabulate(
+                [
+                    [inf_id, "Destroyed" if error is None else f"Failed: {error}"]
+                    for inf_id, _, error in results
+                ],
+                headers=["Infrastructure ID", "Result"],
+                tablefmt="grid",
+            )
+        )
+
+        return "Done" if len(destroyed) == len(inf_ids) else "Failed"
+
+    @line_magic
+    @traced
+    def apricot_upload(self, line):
+        parsed = self.parse_transfer_line(
+            line,
+            "Usage: `%apricot_upload <infrastructure-id> [--vm selector] [--streams N] [--mode auto|archive|files] <file1> <file2> ... <fileN> <remote-destination-path>`\n",
+        )
+        if parsed is None:
+            return "Fail"
+
+        inf_id, vm_selector, files, destination, streams, mode = parsed
 
         return self.apricot_transfer(
-            inf_id, vm_id, files, destination, transfer_type="upload"
+            inf_id, vm_selector, files, destination, "upload", streams, mode
         )
 
     @line_magic
+    @traced
     def apricot_download(self, line):
-        if len(line) == 0 or len(line.split()) < 3:
-            print(
-                "Usage: `%apricot_download <infrastructure-id> <file1> <file2> ... <fileN> <local-destination-path>`\n"
-            )
+        parsed = self.parse_transfer_line(
+            line,
+            "Usage: `%apricot_download <infrastructure-id> [--vm selector] [--streams N] [--mode auto|archive|files] <file1> <file2> ... <fileN> <local-destination-path>`\n",
+        )
+        if parsed is None:
             return "Fail"
 
-        words = line.split()
-        inf_id = words[0]
-        vm_id = "0"  # words[1]
-        destination = words[-1]
-        files = words[1:-1]
+        inf_id, vm_selector, files, destination, streams, mode = parsed
 
         return self.apricot_transfer(
-            inf_id, vm_id, files, destination, transfer_type="download"
+            inf_id, vm_selector, files, destination, "download", streams, mode
         )
 
     @line_magic
+    @traced
     def apricot_destroy(self, inf_id):
         try:
             self.initialize_im_client()
@@ -625,6 +1852,7 @@ class Apricot_Magics(Magics):
                 sys.stdout.flush()
                 print("Infrastructure with ID " + inf_id + " successfully destroyed.")
                 self.remove_infrastructure_from_list(inf_id)
+                self.forget_infrastructure(inf_id)
 
         except Exception as e:
             print(f"Error: {e}")
@@ -632,10 +1860,463 @@ class Apricot_Magics(Magics):
 
         print(inf_info)
 
+    @line_magic
+    @traced
+    def apricot_slurm(self, line):
+        usage = (
+            "Usage: `%apricot_slurm submit <infrastructure-id> [--array spec] [--as user] <script> ...`\n"
+            "       `%apricot_slurm status [<infrastructure-id> [job-id ...]]`\n"
+            "       `%apricot_slurm wait [<infrastructure-id> [job-id ...]] [--timeout 30m]`\n"
+            "       `%apricot_slurm cancel <infrastructure-id> [--as user] <job-id> ... | --all`"
+        )
+        words = line.split()
+        try:
+            options, args = parse_line_options(
+                words[1:], {"array": None, "as": None, "timeout": None, "all": False}
+            )
+            timeout = options["timeout"]
+            timeout = parse_duration(timeout) if timeout is not None else None
+        except ValueError as e:
+            print(f"Error: {e}")
+            print(usage)
+            return "Fail"
+
+        command = words[0] if words else None
+
+        if command == "submit":
+            if len(args) < 2:
+                print(usage)
+                return "Fail"
+
+            inf_id, scripts = args[0], args[1:]
+            try:
+                submitted = self.slurm.submit(inf_id, scripts, options["array"], options["as"])
+            except Exception as e:
+                print(f"Error: {e}")
+                return "Failed"
+
+            print(
+                tabulate(
+                    [
+                        [script, job_id or "", "Submitted" if error is None else f"Failed: {error}"]
+                        for script, job_id, error in submitted
+                    ],
+                    headers=["Script", "Job ID", "Result"],
+                    tablefmt="grid",
+                )
+            )
+            job_ids = {job_id for _, job_id, error in submitted if error is None}
+            if len(job_ids) < len(submitted):
+                return "Failed"
+            return self.slurm.get([inf_id], job_ids)
+
+        if command in ("status", "wait"):
+            inf_ids = args[:1] or None
+            job_ids = set(args[1:]) or None
+            for job_id in job_ids or ():
+                self.slurm.track(inf_ids[0], job_id)
+
+            if command == "status":
+                _, errors = self.slurm.poll(inf_ids)
+                jobs = self.slurm.get(inf_ids, job_ids)
+            else:
+                def report(jobs, errors):
+                    states = Counter(job.state for job in jobs)
+                    summary = ", ".join(f"{count} {state}" for state, count in sorted(states.items()))
+                    print(f"\r{summary}" + " " * 20, end="", flush=True)
+
+                try:
+                    jobs = self.slurm.wait(inf_ids, job_ids, timeout, progress=report)
+                    errors = {}
+                except TimeoutError as e:
+                    print()
+                    print(f"Timed out: {e}")
+                    return "Failed"
+                except KeyboardInterrupt:
+                    print()
+                    print("Stopped waiting.")
+                    return self.slurm.get(inf_ids, job_ids)
+                print()
+
+            for inf_id, error in errors.items():
+                print(f"Error: could not poll {inf_id}: {error}")
+
+            if not jobs:
+                print("No SLURM jobs tracked.")
+                return "Failed" if errors else jobs
+
+            if command == "status":
+                self.print_jobs(jobs)
+            else:
+                failed = [job for job in jobs if job.state in JOB_FAILED_STATES]
+                print(f"{len(jobs) - len(failed)} of {len(jobs)} job(s) finished without errors.")
+                if failed:
+                    self.print_jobs(failed)
+            return jobs
+
+        if command == "cancel":
+            if not args or (len(args) == 1) != options["all"]:
+                print(usage)
+                return "Fail"
+
+            inf_id = args[0]
+            job_ids = args[1:] or sorted({
+                submission_of(job.job_id)
+                for job in self.slurm.get([inf_id])
+                if job.state not in JOB_SETTLED_STATES
+            })
+            if not job_ids:
+                print(f"No running SLURM jobs tracked in infrastructure {inf_id}.")
+                return "Done"
+
+            try:
+                self.slurm.cancel(inf_id, job_ids, options["as"])
+            except Exception as e:
+                print(f"Error: {e}")
+                return "Failed"
+
+            print(f"Cancelled {len(job_ids)} job(s) in infrastructure {inf_id}.")
+            return "Done"
+
+        print(usage)
+        return "Fail"
+
+    @line_magic
+    @traced
+    def apricot_scale(self, line):
+        usage = (
+            "Usage: `%apricot_scale <infrastructure-id> [+N | -N | N] [--vm ids] [--system name]`\n"
+            "       `%apricot_scale <infrastructure-id> --auto on|off [--min N] [--max N] [--jobs-per-worker N]"
+            " [--interval 60s] [--up-cooldown 5m] [--down-cooldown 10m] [--idle 10m] [--system name]`"
+        )
+        try:
+            options, args = parse_line_options(
+                line.split(),
+                {
+                    "vm": None,
+                    "system": None,
+                    "auto": None,
+                    "min": "0",
+                    "max": None,
+                    "jobs-per-worker": "1",
+                    "interval": str(AUTOSCALE_INTERVAL),
+                    "up-cooldown": str(SCALE_UP_COOLDOWN),
+                    "down-cooldown": str(SCALE_DOWN_COOLDOWN),
+                    "idle": str(IDLE_TIME),
+                },
+            )
+            if len(args) not in (1, 2) or options["auto"] not in (None, "on", "off"):
+                raise ValueError("wrong arguments")
+            count = args[1] if len(args) == 2 else None
+            if count is not None and not re.fullmatch(r"[+-]?\d+", count):
+                raise ValueError(f"Invalid VM count: '{count}'")
+            policy = ScalePolicy(
+                int(options["min"]),
+                int(options["max"]) if options["max"] is not None else int(options["min"]),
+                int(options["jobs-per-worker"]),
+                parse_duration(options["up-cooldown"]),
+                parse_duration(options["down-cooldown"]),
+                parse_duration(options["idle"]),
+            )
+            interval = parse_duration(options["interval"])
+        except ValueError as e:
+            print(f"Error: {e}")
+            print(usage)
+            return "Fail"
+
+        inf_id = args[0]
+
+        if options["auto"] == "off":
+            autoscaler = self.autoscalers.pop(inf_id, None)
+            if autoscaler is None:
+                print(f"Infrastructure {inf_id} is not being autoscaled.")
+                return "Fail"
+            autoscaler.stop()
+            print(f"Stopped autoscaling infrastructure {inf_id}.")
+            return "Done"
+
+        try:
+            system, workers = self.worker_vms(inf_id, options["system"])
+        except Exception as e:
+            print(f"Error: {e}")
+            return "Failed"
+
+        if options["auto"] == "on":
+            if options["max"] is None or policy.max_workers < policy.min_workers:
+                print("Error: autoscaling needs --max, no lower than --min.")
+                return "Fail"
+
+            def current_workers():
+                _, vm_infos = self.worker_vms(inf_id, system)
+                return {vm_id: node_name(vm_info) for vm_id, vm_info in vm_infos.items()}
+
+            previous = self.autoscalers.pop(inf_id, None)
+            if previous is not None:
+                previous.stop()
+            autoscaler = Autoscaler(
+                policy,
+                lambda: self.queue_state(inf_id),
+                current_workers,
+                lambda add, remove: self.scale_infrastructure(inf_id, system, add, remove),
+                interval,
+            )
+            self.autoscalers[inf_id] = autoscaler
+            autoscaler.start()
+            print(
+                f"Autoscaling '{system}' workers of infrastructure {inf_id} between"
+                f" {policy.min_workers} and {policy.max_workers} (now {len(workers)})."
+            )
+            return "Done"
+
+        if count is None and options["vm"] is None:
+            autoscaler = self.autoscalers.get(inf_id)
+            print(f"Infrastructure {inf_id} has {len(workers)} '{system}' worker(s): {', '.join(workers) or 'none'}.")
+            if autoscaler is not None:
+                print(f"Autoscaling: {'running' if autoscaler.running else 'stopped'}.")
+                for when, message in autoscaler.events:
+                    print(f"  {time.strftime('%H:%M:%S', time.localtime(when))} {message}")
+            return "Done"
+
+        add, remove = 0, []
+        if options["vm"] is not None:
+            remove = [vm_id.strip() for vm_id in options["vm"].split(",") if vm_id.strip()]
+            unknown = [vm_id for vm_id in remove if vm_id not in workers]
+            if unknown:
+                print(f"Error: VM(s) {', '.join(unknown)} are not '{system}' workers of infrastructure {inf_id}.")
+                return "Failed"
+        if count is not None:
+            target = len(workers) + int(count) if count[0] in "+-" else int(count)
+            if target < 0:
+                print(f"Error: infrastructure {inf_id} only has {len(workers)} '{system}' worker(s).")
+                return "Failed"
+            change = target - (len(workers) - len(remove))
+            if change > 0:
+                add = change
+            else:
+                # The newest workers go first.
+                remaining = sorted(
+                    (vm_id for vm_id in workers if vm_id not in remove),
+                    key=lambda vm_id: int(vm_id) if vm_id.isdigit() else vm_id,
+                )
+                remove += remaining[len(remaining) + change:]
+
+        if not add and not remove:
+            print(f"Infrastructure {inf_id} already has {len(workers)} '{system}' worker(s).")
+            return "Done"
+
+        try:
+            added = self.scale_infrastructure(inf_id, system, add, remove)
+        except Exception as e:
+            print(f"Error: {e}")
+            return "Failed"
+
+        if add:
+            print(f"Added {add} '{system}' worker(s) to infrastructure {inf_id}: VM(s) {', '.join(map(str, added))}.")
+        if remove:
+            print(f"Removed VM(s) {', '.join(remove)} from infrastructure {inf_id}.")
+        print("The infrastructure is being reconfigured; follow it with `%apricot_wait` or `%apricot_log -f`.")
+        return "Done"
+
+    @line_magic
+    def apricot_stats(self, line):
+        usage = (
+            "Usage: `%apricot_stats [--per-infrastructure] [--json | --openmetrics]"
+            " [--output file] [--reset] [--trace on|off]`"
+        )
+        try:
+            options, args = parse_line_options(
+                line.split(),
+                {
+                    "per-infrastructure": False,
+                    "json": False,
+                    "openmetrics": False,
+                    "output": None,
+                    "reset": False,
+                    "trace": None,
+                },
+            )
+        except ValueError as e:
+            print(f"Error: {e}")
+            print(usage)
+            return "Fail"
+
+        if args or options["trace"] not in (None, "on", "off") or (
+            options["json"] and options["openmetrics"]
+        ):
+            print(usage)
+            return "Fail"
+
+        if options["trace"] is not None:
+            self.stats.tracing = options["trace"] == "on"
+            print(f"Tracing {'enabled' if self.stats.tracing else 'disabled'}.")
+            return
+
+        if options["reset"]:
+            self.stats.reset()
+            print("Statistics reset.")
+            return
+
+        if options["openmetrics"]:
+            report = self.stats.to_openmetrics()
+        elif options["json"] or options["output"]:
+            report = self.stats.to_json()
+        else:
+            report = None
+
+        if options["output"]:
+            try:
+                Path(options["output"]).write_text(report)
+            except OSError as e:
+                print(f"Error: {e}")
+                return "Failed"
+            print(f"Statistics written to {options['output']}.")
+            return
+
+        if report is not None:
+            print(report)
+            return
+
+        def milliseconds(seconds):
+            return "" if seconds is None else f"{seconds * 1000:.1f}"
+
+        def row(operation, summary):
+            return [
+                operation,
+                summary["count"],
+                summary["errors"],
+                f"{summary['error_rate']:.1%}",
+                milliseconds(summary["p50_seconds"]),
+                milliseconds(summary["p95_seconds"]),
+                milliseconds(summary["p99_seconds"]),
+                summary["bytes"] or "",
+            ]
+
+        headers = ["Operation", "Calls", "Errors", "Error rate", "p50 (ms)", "p95 (ms)",
+                   "p99 (ms)", "Bytes"]
+
+        if options["per-infrastructure"]:
+            rows = [
+                [inf_id] + row(operation, summary)
+                for inf_id, operations in self.stats.summary(per_infrastructure=True).items()
+                for operation, summary in operations.items()
+            ]
+            headers = ["Infrastructure ID"] + headers
+        else:
+            rows = [row(operation, summary) for operation, summary in self.stats.summary().items()]
+
+        if not rows:
+            print("No operations recorded yet.")
+            return
+
+        print(tabulate(rows, headers=headers, tablefmt="grid"))
+
+    def run_line_captured(self, line):
+        """Run one cell line, returning `(result, output, seconds)`."""
+        buffer = StringIO()
+        start = time.monotonic()
+        with capture_line_output(buffer):
+            try:
+                result = self.apricot(line)
+            except Exception as e:
+                print(f"Error: {e}")
+                result = "Failed"
+        return result, buffer.getvalue(), time.monotonic() - start
+
+    def run_cell_parallel(self, cell, max_workers):
+        """
+        Run the lines of a `%%apricot --parallel` cell following `plan_cell`.
+
+        Chains of a stage run concurrently, at most `max_workers` at a time.
+        A failing line skips the rest of its chain and every later stage.
+        The output of each line is captured and printed in cell order,
+        prefixed with its line number, as soon as the lines above it finish.
+        """
+        lines = [
+            (number, line.strip())
+            for number, line in enumerate(cell.split("\n"), 1)
+            if line.strip()
+        ]
+        commands = [(number, line) for number, line in lines if line != BARRIER]
+        outcomes = {}
+        printed = 0
+
+        def run_chain(chain):
+            for position, (number, line) in enumerate(chain):
+                outcomes[number] = self.run_line_captured(line)
+                if outcomes[number][0] not in ("Done", None):
+                    for skipped, _ in chain[position + 1:]:
+                        outcomes[skipped] = ("Skipped", "", 0.0)
+                    return False
+            return True
+
+        def print_ready():
+            nonlocal printed
+            while printed < len(commands) and commands[printed][0] in outcomes:
+                number = commands[printed][0]
+                for output_line in output_lines(outcomes[number][1]):
+                    print(f"[{number}] {output_line}")
+                printed += 1
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = RoutedStream(stdout), RoutedStream(stderr)
+        try:
+            for stage in plan_cell(lines):
+                if any(outcome[0] not in ("Done", None) for outcome in outcomes.values()):
+                    for chain in stage:
+                        for number, _ in chain:
+                            outcomes[number] = ("Skipped", "", 0.0)
+                    continue
+
+                for _, _, error in fan_out(
+                    run_chain, stage, max_workers=max_workers, progress=print_ready
+                ):
+                    if error is not None:
+                        print(f"Error: {error}")
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+        print_ready()
+
+        print(
+            tabulate(
+                [
+                    [
+                        number,
+                        line,
+                        outcomes[number][0] or "Done",
+                        f"{outcomes[number][2]:.1f}",
+                    ]
+                    for number, line in commands
+                ],
+                headers=["Line", "Command", "Result", "Time (s)"],
+                tablefmt="grid",
+            )
+        )
+
+        for number, line in commands:
+            if outcomes[number][0] not in ("Done", None, "Skipped"):
+                print("Execution stopped")
+                return f"Fail on line: '{line}'"
+        return "Done"
+
     @line_cell_magic
+    @traced
     def apricot(self, code, cell=None):
         # Check if it's a cell call
         if cell is not None:
+            try:
+                options, _ = parse_line_options(
+                    code.split(), {"parallel": False, "workers": str(DEFAULT_MAX_WORKERS)}
+                )
+                max_workers = int(options["workers"])
+            except ValueError as e:
+                print(f"Error: {e}")
+                print("Usage: `%%apricot [--parallel] [--workers N]`")
+                return "Fail"
+
+            if options["parallel"]:
+                return self.run_cell_parallel(cell, max_workers)
+
             lines = cell.split("\n")
             for line in lines:
                 if len(line) > 0:
@@ -660,8 +2341,27 @@ class Apricot_Magics(Magics):
                 return "Fail"
             else:
                 inf_id = words[1]
-                # vm_id = words[2]
-                cmd_command = words[2:]
+
+                try:
+                    options, cmd_command = parse_exec_options(
+                        words[2:],
+                        {
+                            "vm": "0",
+                            "workers": str(DEFAULT_MAX_WORKERS),
+                            "stream": False,
+                            "tee": None,
+                        },
+                    )
+                    max_workers = int(options["workers"])
+                except ValueError as e:
+                    print(f"Error: {e}")
+                    return "Fail"
+
+                if not cmd_command:
+                    print(
+                        f"Incomplete instruction: '{code}' \n 'exec' format is: 'exec infrastructure-id [--vm selector] cmd-command'"
+                    )
+                    return "Fail"
 
                 try:
                     self.authfile_path
@@ -669,42 +2369,44 @@ class Apricot_Magics(Magics):
                     print(e)
                     return "Failed"
 
-                ssh_user = self.resolve_ssh_user(inf_id)
-                if not ssh_user:
-                    print(
-                        f"Error: Unable to resolve SSH user for infrastructure {inf_id}."
+                try:
+                    vm_ids = self.resolve_vm_selector(
+                        inf_id, options["vm"], max_workers
                     )
+                except Exception as e:
+                    print(f"Error: {e}")
                     return "Failed"
 
-                private_key_content = self.generate_key(inf_id, "0")  # vm_id
-                if not private_key_content:
-                    print(
-                        "Error: Unable to generate private key. Missing infrastructure ID or VM ID."
-                    )
+                if not vm_ids:
+                    print(f"Error: No VM matches '{options['vm']}' in infrastructure {inf_id}.")
                     return "Failed"
 
-                host_ip = self.get_vm_ip(inf_id)
-                if not host_ip:
-                    print(
-                        f"Error: Unable to resolve IP user for infrastructure {inf_id}."
-                    )
+                if len(vm_ids) > 1 or options["vm"] != vm_ids[0]:
+                    if options["stream"]:
+                        print("Error: --stream can only be used with a single VM.")
+                        return "Fail"
+                    return self.exec_on_vms(inf_id, vm_ids, cmd_command, max_workers)
+
+                connection = self.get_ssh_connection(inf_id, vm_ids[0])
+                if connection is None:
                     return "Failed"
 
-                cmd_ssh = [
-                    "ssh",
-                    "-i",
-                    "key.pem",
-                    "-o",
-                    "StrictHostKeyChecking=no",
-                    f"{ssh_user}@{host_ip}",
-                ] + cmd_command
-                output = self.execute_command(cmd_ssh)
+                if options["stream"] or options["tee"]:
+                    with self.stats.span("ssh.exec", inf_id) as command_span:
+                        exit_code = self.stream_command(
+                            connection.ssh_command(cmd_command, tty=True), options["tee"]
+                        )
+                        command_span.error = exit_code != 0
+                    return None if exit_code == 0 else "Failed"
+
+                cmd_ssh = connection.ssh_command(cmd_command)
+                with self.stats.span("ssh.exec", inf_id) as command_span:
+                    output = self.execute_command(cmd_ssh)
+                    command_span.error = output is None
 
                 if output:
                     print(output)
 
-                self.cleanup_files("key.pem")
-
                 return None
 
         elif word1 == "list":
@@ -0,0 +1,218 @@
+from contextlib import contextmanager
+
+import json
+import sqlite3
+import threading
+import time
+
+CACHE_NAME = "cache.db"
+
+# Seconds an IM answer is served as fresh, per kind of data. Only data that
+# rarely changes is cached: the RADL of settled infrastructures, the state
+# and IP of settled infrastructures, and cloud image catalogs.
+CACHE_TTLS = {"radl": 24 * 3600, "status": 3600, "images": 24 * 3600}
+# Entries older than this are never served, not even while revalidating.
+MAX_STALE = 7 * 24 * 3600
+MAX_CACHE_BYTES = 32 * 1024 * 1024
+# Reads only record their access time when the stored one is older than
+# this, so serving an entry is a single SELECT most of the time.
+ACCESS_RESOLUTION = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    infrastructure TEXT,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS responses_infrastructure ON responses (infrastructure);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+
+class ResponseCache:
+    """
+    IM answers kept on disk across kernel restarts.
+
+    Entries are JSON values keyed by `(kind, key)` and tagged with the
+    infrastructure they describe, so everything known about one can be
+    dropped when it is destroyed or changed. Each kind has its own TTL;
+    once the cache grows past `max_bytes` the least recently read entries
+    are evicted. Like the infrastructure store it is a SQLite database in
+    WAL mode shared by the magics and the server extension.
+
+    `fetch` implements stale-while-revalidate: an expired entry is returned
+    right away while a single background call refreshes it.
+
+    Every thread keeps its own connection open for the life of the cache.
+    """
+
+    def __init__(self, path, ttls=CACHE_TTLS, max_bytes=MAX_CACHE_BYTES, timeout=30):
+        self.path = str(path)
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._revalidating = set()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        with self._transaction() as db:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    db.execute(statement)
+
+    def _connection(self):
+        """The connection of the calling thread, opened on its first use."""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def close(self):
+        """Close the connection of the calling thread."""
+        db = getattr(self._local, "db", None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    # Entries
+
+    def get(self, kind, key):
+        """Return `(value, age)` of an entry, or None if it is missing or too old to serve."""
+        now = time.time()
+        db = self._connection()
+        row = db.execute(
+            "SELECT value, fetched, accessed FROM responses WHERE kind = ? AND key = ?",
+            (kind, key),
+        ).fetchone()
+        if row is None:
+            return None
+        value, fetched, accessed = row
+        if now - fetched > MAX_STALE:
+            self.invalidate_entry(kind, key)
+            return None
+        if now - accessed > ACCESS_RESOLUTION:
+            # A single statement: SQLite runs it in its own transaction.
+            db.execute(
+                "UPDATE responses SET accessed = ? WHERE kind = ? AND key = ?", (now, kind, key)
+            )
+        return json.loads(value), now - fetched
+
+    def put(self, kind, key, value, inf_id=None):
+        data = json.dumps(value)
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                """
+                INSERT INTO responses (kind, key, infrastructure, value, size, fetched, accessed)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (kind, key) DO UPDATE SET
+                    infrastructure = excluded.infrastructure, value = excluded.value,
+                    size = excluded.size, fetched = excluded.fetched, accessed = excluded.accessed
+                """,
+                (kind, key, inf_id, data, len(data), now, now),
+            )
+            self._evict(db)
+
+    def _evict(self, db):
+        """Drop the least recently read entries until the cache fits in `max_bytes`."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = db.execute("SELECT kind, key, size FROM responses ORDER BY accessed").fetchall()
+        evicted = []
+        for kind, key, size in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((kind, key))
+            total -= size
+        db.executemany("DELETE FROM responses WHERE kind = ? AND key = ?", evicted)
+
+    def invalidate(self, inf_id=None, kind=None):
+        """Drop the entries of an infrastructure, of a kind, or (with neither) all of them."""
+        query = "DELETE FROM responses"
+        conditions, params = [], []
+        if inf_id is not None:
+            conditions.append("infrastructure = ?")
+            params.append(inf_id)
+        if kind is not None:
+            conditions.append("kind = ?")
+            params.append(kind)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        with self._transaction() as db:
+            return db.execute(query, params).rowcount
+
+    # Read-through
+
+    def fetch(self, kind, key, load, inf_id=None, stale_while_revalidate=True,
+              cacheable=lambda value: True):
+        """
+        Return the cached value of an entry, calling `load()` when needed.
+
+        Fresh entries are returned as they are. Expired ones are returned
+        too when `stale_while_revalidate` is set, with `load` run on a
+        background thread (once per entry) to update them; otherwise `load`
+        is called right away. Loaded values are stored only if
+        `cacheable(value)` holds.
+        """
+        cached = self.get(kind, key)
+        if cached is not None:
+            value, age = cached
+            if age <= self.ttls[kind]:
+                return value
+            if stale_while_revalidate:
+                self.revalidate(kind, key, load, inf_id, cacheable)
+                return value
+
+        return self.update(kind, key, load(), inf_id, cacheable)
+
+    def update(self, kind, key, value, inf_id=None, cacheable=lambda value: True):
+        """Store a freshly loaded value, or drop its entry if it is not `cacheable`."""
+        if cacheable(value):
+            self.put(kind, key, value, inf_id)
+        else:
+            self.invalidate_entry(kind, key)
+        return value
+
+    def revalidate(self, kind, key, load, inf_id=None, cacheable=lambda value: True):
+        with self._lock:
+            if (kind, key) in self._revalidating:
+                return
+            self._revalidating.add((kind, key))
+
+        def run():
+            try:
+                self.update(kind, key, load(), inf_id, cacheable)
+            except Exception:
+                # The stale entry keeps being served; the next read tries again.
+                pass
+            finally:
+                with self._lock:
+                    self._revalidating.discard((kind, key))
+
+        threading.Thread(target=run, name="apricot-cache-revalidate", daemon=True).start()
+
+    def invalidate_entry(self, kind, key):
+        with self._transaction() as db:
+            db.execute("DELETE FROM responses WHERE kind = ? AND key = ?", (kind, key))
@@ -0,0 +1,90 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# A line made of this word waits for every line above it before going on.
+BARRIER = "barrier"
+
+# Commands whose second word is the infrastructure they act on.
+TARGETED_COMMANDS = {"exec", "destroy"}
+
+_line_output = ContextVar("apricot_line_output", default=None)
+
+
+def line_target(line):
+    """Return the infrastructure a cell line acts on, or None."""
+    words = line.split()
+    if len(words) >= 2 and words[0] in TARGETED_COMMANDS:
+        return words[1]
+    return None
+
+
+def plan_cell(lines):
+    """
+    Split the `(number, line)` pairs of a cell into stages of chains.
+
+    Stages run one after the other; the chains of a stage run concurrently
+    and the lines of a chain in order. Lines acting on the same
+    infrastructure form one chain. A barrier ends the current stage, and a
+    line without an infrastructure (e.g. `list`) runs in a stage of its own.
+    """
+    stages = []
+    chains = {}
+
+    def close_stage():
+        if chains:
+            stages.append(list(chains.values()))
+            chains.clear()
+
+    for number, line in lines:
+        if line == BARRIER:
+            close_stage()
+            continue
+
+        target = line_target(line)
+        if target is None:
+            close_stage()
+            stages.append([[(number, line)]])
+        else:
+            chains.setdefault(target, []).append((number, line))
+
+    close_stage()
+    return stages
+
+
+class RoutedStream:
+    """
+    Stand-in for `sys.stdout`/`sys.stderr` that sends what a cell line
+    prints to that line's buffer.
+
+    The buffer is looked up in a context variable, so output from threads
+    a line fans out to (which run in copies of its context) is captured
+    too. Writes outside of any line go to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        buffer = _line_output.get()
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        if _line_output.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def capture_line_output(buffer):
+    token = _line_output.set(buffer)
+    try:
+        yield buffer
+    finally:
+        _line_output.reset(token)
+
+
+def output_lines(text):
+    """Split captured output into lines, keeping only the last state of `\\r`-updated lines."""
+    return [line.rsplit("\r", 1)[-1] for line in text.rstrip("\n").split("\n")] if text else []
@@ -0,0 +1,148 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import contextvars
+import itertools
+import threading
+import time
+
+DEFAULT_MAX_WORKERS = 8
+
+
+def fan_out(func, items, max_workers=DEFAULT_MAX_WORKERS, timeout=None,
+            progress=None, progress_interval=0.5):
+    """
+    Run `func(item)` for every item on a bounded thread pool.
+
+    Returns a list of `(item, result, error)` tuples in the same order as
+    `items`. A call that raises gets its exception as `error`; a call that
+    has been running for longer than `timeout` seconds gets a `TimeoutError`
+    and is abandoned, so one slow item never holds back the others.
+
+    If given, `progress()` is called from the calling thread at least every
+    `progress_interval` seconds while the calls run.
+
+    Calls run in copies of the caller's context, so context variables such
+    as the command trace of `stats` follow the work into the pool.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    started = {}
+    lock = threading.Lock()
+
+    def call(index):
+        with lock:
+            started[index] = time.monotonic()
+        return func(items[index])
+
+    results = [None] * len(items)
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items))))
+
+    try:
+        futures = {
+            executor.submit(contextvars.copy_context().run, call, index): index
+            for index in range(len(items))
+        }
+        pending = set(futures)
+
+        while pending:
+            wait_for = None
+            if timeout is not None:
+                now = time.monotonic()
+                with lock:
+                    deadlines = [
+                        started[futures[f]] + timeout
+                        for f in pending
+                        if futures[f] in started
+                    ]
+                # Tasks still queued have no deadline yet; check back shortly.
+                wait_for = min(deadlines) - now if deadlines else timeout
+                wait_for = max(0.0, min(wait_for, 0.5))
+
+            if progress is not None:
+                wait_for = progress_interval if wait_for is None else min(wait_for, progress_interval)
+
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            if progress is not None:
+                progress()
+
+            for future in done:
+                index = futures[future]
+                error = future.exception()
+                result = None if error else future.result()
+                results[index] = (items[index], result, error)
+
+            if timeout is not None:
+                now = time.monotonic()
+                for future in list(pending):
+                    index = futures[future]
+                    with lock:
+                        start = started.get(index)
+                    if start is not None and now - start >= timeout:
+                        pending.discard(future)
+                        results[index] = (
+                            items[index],
+                            None,
+                            TimeoutError(f"timed out after {timeout:g}s"),
+                        )
+    finally:
+        # Abandoned calls keep running in the background; do not wait for them.
+        executor.shutdown(wait=False)
+
+    return results
+
+
+def map_ordered(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Yield `(item, result, error)` for every item, in order, as soon as it is done.
+
+    Like `fan_out`, calls run on a bounded pool in copies of the caller's
+    context, but at most `max_workers` of them are started ahead of the
+    item being yielded. Callers can so show long answers as they arrive
+    while holding only a few results at a time. Closing the generator
+    cancels the calls not started yet.
+    """
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+    window = deque()
+
+    def submit(item):
+        future = executor.submit(contextvars.copy_context().run, func, item)
+        window.append((item, future))
+
+    try:
+        for item in itertools.islice(items, max(1, max_workers)):
+            submit(item)
+
+        while window:
+            item, future = window.popleft()
+            error = future.exception()
+            result = None if error else future.result()
+            for next_item in itertools.islice(items, 1):
+                submit(next_item)
+            yield item, result, error
+    finally:
+        for _, future in window:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class RateLimiter:
+    """Space out calls from any number of threads to at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next, now)
+            self._next = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,50 @@
+import re
+
+# Characters before the read offset kept to notice when a log is rewritten.
+ANCHOR_SIZE = 64
+
+LOG_MIN_INTERVAL = 2
+LOG_MAX_INTERVAL = 30
+
+RESTART_NOTICE = "[The log was rewritten; showing it again from the start]"
+
+
+class LogCursor:
+    """
+    Read position in a log that the IM only returns whole.
+
+    Only the offset of the last complete line shown and a short anchor
+    before it are kept, never the log itself. `feed` takes the log as
+    fetched again and returns the complete lines added since the previous
+    call that match `pattern`; a trailing partial line is held back until
+    it is complete or `final` is set. If the text before the offset no
+    longer matches the anchor (the IM regenerates the log on reconfigure),
+    reading starts again from the beginning.
+    """
+
+    def __init__(self, pattern=None):
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+        self.offset = 0
+        self.anchor = ""
+
+    def feed(self, text, final=False):
+        lines = []
+
+        if self.offset and (
+            len(text) < self.offset
+            or not text.startswith(self.anchor, self.offset - len(self.anchor))
+        ):
+            self.offset, self.anchor = 0, ""
+            lines.append(RESTART_NOTICE)
+
+        end = len(text) if final else text.rfind("\n", self.offset) + 1
+        if end <= self.offset:
+            return lines
+
+        for line in text[self.offset:end].splitlines():
+            if self.pattern is None or self.pattern.search(line):
+                lines.append(line)
+
+        self.offset = end
+        self.anchor = text[max(0, end - ANCHOR_SIZE):end]
+        return lines
@@ -0,0 +1,416 @@
+from collections import namedtuple, OrderedDict
+from fnmatch import fnmatchcase
+
+import hashlib
+import re
+import threading
+import time
+
+# One pattern matches every RADL token; the lexer makes a single pass over the text.
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+|\#[^\n]*)
+    | (?P<block>@begin.*?@end)
+    | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    | (?P<operator>>=|<=|=|>|<)
+    | (?P<lparen>\()
+    | (?P<rparen>\))
+    | (?P<lbracket>\[)
+    | (?P<rbracket>\])
+    | (?P<comma>,)
+    | (?P<number>-?\d+(?:\.\d+)?(?:[kmgtp]i?b?|b)?(?![\w.]))
+    | (?P<word>[\w.\-/:]+)
+    | (?P<other>\S)
+    """,
+    re.VERBOSE | re.DOTALL | re.IGNORECASE,
+)
+
+SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4, "p": 1024**5}
+MEMORY_UNITS = ("m", "k")
+
+NetworkInterface = namedtuple("NetworkInterface", ["index", "connection", "ip", "public"])
+Disk = namedtuple("Disk", ["index", "size", "image", "device", "mount_path"])
+
+# A VM as described by its `getvminfo` RADL, with the properties used by the magics typed.
+VMInfo = namedtuple(
+    "VMInfo",
+    [
+        "vm_id",
+        "system",
+        "state",
+        "provider",
+        "cpu_count",
+        "memory_size",
+        "gpu_count",
+        "interfaces",
+        "disks",
+        "user",
+        "private_key",
+        "password",
+        "properties",
+    ],
+)
+
+# `skipped` lists the constructs the parser did not understand and left out.
+RADLDocument = namedtuple("RADLDocument", ["networks", "systems", "deploys", "skipped"])
+
+
+class RADLSyntaxError(ValueError):
+    pass
+
+
+def tokenize(text):
+    """
+    Yield `(kind, value)` tokens of a RADL document.
+
+    Characters outside the grammar become `other` tokens so the parser can
+    skip the construct they belong to.
+    """
+    for match in TOKEN_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind != "space":
+            yield kind, match.group()
+
+
+def parse_value(kind, value):
+    """Convert a value token: strings are unquoted and numbers with a size unit become bytes."""
+    if kind == "string":
+        return re.sub(r"\\(.)", r"\1", value[1:-1])
+    if kind == "number":
+        match = re.fullmatch(r"(-?\d+(?:\.\d+)?)([kmgtp]?)i?b?", value, re.IGNORECASE)
+        number, unit = match.group(1), match.group(2).lower()
+        if "." in number:
+            return float(number) * SIZE_UNITS[unit]
+        return int(number) * SIZE_UNITS[unit]
+    return value
+
+
+class _Parser:
+    SECTIONS = {
+        "network", "system", "configure", "contextualize", "deploy", "description", "ansible"
+    }
+
+    def __init__(self, text):
+        self.tokens = list(tokenize(text))
+        self.index = 0
+        self.skipped = []
+
+    def peek(self):
+        return self.tokens[self.index] if self.index < len(self.tokens) else (None, None)
+
+    def next(self, expected=None):
+        kind, value = self.peek()
+        if kind is None or (expected is not None and kind != expected):
+            raise RADLSyntaxError(f"Expected {expected or 'a token'}, found {value!r}")
+        self.index += 1
+        return kind, value
+
+    def properties(self):
+        """
+        Parse `name op value and ...` up to the closing parenthesis.
+
+        A construct that cannot be parsed is skipped up to the next `and` or
+        closing parenthesis, so one unknown property does not lose the rest.
+        """
+        properties = {}
+        while self.peek()[0] not in ("rparen", None):
+            start = self.index
+            try:
+                self.feature(properties)
+            except RADLSyntaxError:
+                self.index = start
+                self.skip_feature()
+        return properties
+
+    def feature(self, properties):
+        """Parse one property, `soft N ( ... )` block or `contains ( ... )` into `properties`."""
+        _, name = self.next("word")
+        if name.lower() == "and":
+            return
+
+        if name.lower() == "soft" and self.peek()[0] == "number":
+            # Soft requirements are preferences: they never override a hard value.
+            self.next()
+            self.next("lparen")
+            for key, value in self.properties().items():
+                properties.setdefault(key, value)
+            self.next("rparen")
+            return
+
+        kind, operator = self.next()
+        if kind == "word" and operator.lower() == "contains":
+            self.next("lparen")
+            properties.setdefault(name, []).append(self.properties())
+            self.next("rparen")
+            return
+        if kind != "operator":
+            raise RADLSyntaxError(f"Expected an operator after {name}, found {operator!r}")
+
+        properties[name] = self.value()
+
+    def value(self):
+        """Parse a value, or a `[value, ...]` list."""
+        kind, value = self.next()
+        if kind != "lbracket":
+            if kind not in ("string", "number", "word", "block"):
+                raise RADLSyntaxError(f"Expected a value, found {value!r}")
+            return parse_value(kind, value)
+
+        values = []
+        while self.peek()[0] != "rbracket":
+            kind, value = self.next()
+            if kind == "comma":
+                continue
+            if kind not in ("string", "number", "word"):
+                raise RADLSyntaxError(f"Expected a list value, found {value!r}")
+            values.append(parse_value(kind, value))
+        self.next("rbracket")
+        return values
+
+    def skip_feature(self):
+        """Skip tokens up to the next `and` or closing parenthesis outside nested groups."""
+        start = self.index
+        depth = 0
+        while True:
+            kind, value = self.peek()
+            if kind is None:
+                break
+            if depth == 0 and self.index > start:
+                if kind == "rparen" or (kind == "word" and value.lower() == "and"):
+                    break
+            step = {"lparen": 1, "rparen": -1, "lbracket": 1, "rbracket": -1}.get(kind, 0)
+            depth = max(depth + step, 0)
+            self.index += 1
+        self.skipped.append(" ".join(value for _, value in self.tokens[start:self.index]))
+
+    def skip_group(self):
+        """Skip a parenthesized group, including nested ones."""
+        self.next("lparen")
+        depth = 1
+        while depth:
+            kind, _ = self.next()
+            depth += {"lparen": 1, "rparen": -1}.get(kind, 0)
+
+    def skip_section(self):
+        """Skip an unknown top-level construct up to the next section keyword."""
+        start = self.index - 1
+        while self.peek()[0] is not None:
+            kind, value = self.peek()
+            if kind == "word" and value.lower() in self.SECTIONS:
+                break
+            if kind == "lparen":
+                self.skip_group()
+            else:
+                self.index += 1
+        self.skipped.append(" ".join(value for _, value in self.tokens[start:self.index]))
+
+    def parse(self):
+        networks, systems, deploys = {}, {}, []
+
+        while self.peek()[0] is not None:
+            kind, keyword = self.next()
+            keyword = keyword.lower()
+            if kind != "word" or keyword not in self.SECTIONS:
+                self.skip_section()
+                continue
+
+            if keyword == "deploy":
+                _, name = self.next("word")
+                _, count = self.next("number")
+                cloud = None
+                kind, value = self.peek()
+                if kind == "word" and value.lower() not in self.SECTIONS:
+                    cloud = self.next()[1]
+                deploys.append((name, int(count), cloud))
+                continue
+
+            name = None
+            if self.peek()[0] in ("word", "number"):
+                name = self.next()[1]
+
+            if keyword in ("network", "system"):
+                self.next("lparen")
+                properties = self.properties()
+                self.next("rparen")
+                target = networks if keyword == "network" else systems
+                target.setdefault(name, {}).update(properties)
+            elif self.peek()[0] == "lparen":
+                self.skip_group()
+
+        return RADLDocument(networks, systems, deploys, self.skipped)
+
+
+def parse_radl(text):
+    """
+    Parse a RADL document into its networks, systems and deploys.
+
+    Unknown constructs are skipped and listed in `skipped`; only a document
+    whose structure is broken (e.g. unbalanced parentheses) raises
+    `RADLSyntaxError`.
+    """
+    return _Parser(text).parse()
+
+
+def _indexed(properties, prefix):
+    """Group `prefix.N.field` properties into `{N: {field: value}}`."""
+    pattern = re.compile(rf"{re.escape(prefix)}\.(\d+)\.(.+)")
+    groups = {}
+    for name, value in properties.items():
+        match = pattern.fullmatch(name)
+        if match:
+            groups.setdefault(int(match.group(1)), {})[match.group(2)] = value
+    return dict(sorted(groups.items()))
+
+
+def parse_vm_info(vm_id, text):
+    """Build the `VMInfo` of a VM from the RADL returned by `getvminfo`."""
+    document = parse_radl(text)
+    system, properties = next(iter(document.systems.items()), (None, {}))
+    public_networks = {
+        name
+        for name, network in document.networks.items()
+        if str(network.get("outbound", "")).lower() == "yes"
+    }
+
+    interfaces = [
+        NetworkInterface(
+            index,
+            fields.get("connection"),
+            fields.get("ip"),
+            fields.get("connection") in public_networks,
+        )
+        for index, fields in _indexed(properties, "net_interface").items()
+    ]
+    disks = [
+        Disk(
+            index,
+            fields.get("size"),
+            fields.get("image.url"),
+            fields.get("device"),
+            fields.get("mount_path"),
+        )
+        for index, fields in _indexed(properties, "disk").items()
+    ]
+
+    return VMInfo(
+        vm_id=str(vm_id),
+        system=system,
+        state=properties.get("state"),
+        provider=properties.get("provider.type"),
+        cpu_count=properties.get("cpu.count"),
+        memory_size=properties.get("memory.size"),
+        gpu_count=properties.get("gpu.count"),
+        interfaces=interfaces,
+        disks=disks,
+        user=properties.get("disk.0.os.credentials.username"),
+        private_key=properties.get("disk.0.os.credentials.private_key"),
+        password=properties.get("disk.0.os.credentials.password"),
+        properties=properties,
+    )
+
+
+def vm_address(vm_info):
+    """
+    Return `(ip, public)` for a VM.
+
+    Prefers the interface connected to an outbound network. If the RADL
+    declares outbound networks but the VM is not attached to any of them,
+    the private IP is returned with `public` set to False.
+    """
+    for interface in vm_info.interfaces:
+        if interface.ip and interface.public:
+            return interface.ip, True
+
+    ips = {interface.index: interface.ip for interface in vm_info.interfaces}
+    has_public_networks = any(interface.public for interface in vm_info.interfaces)
+    return ips.get(1) or ips.get(0), not has_public_networks
+
+
+def format_size(size, units=("p", "t", "g", "m", "k")):
+    """
+    Format a size in bytes as RADL does, e.g. `2048m` or `20g`, in the
+    largest of `units` that divides it. The IM writes memory in megabytes,
+    so it is shown with `MEMORY_UNITS` (`4096m`, not `4g`).
+    """
+    if not isinstance(size, (int, float)):
+        return "N/A" if size is None else str(size)
+    for unit in units:
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{int(size // SIZE_UNITS[unit])}{unit}"
+    return str(size)
+
+
+def is_property_pattern(name):
+    """Return whether a property name given by the user has glob wildcards."""
+    return any(char in name for char in "*?[")
+
+
+def select_properties(properties, patterns):
+    """
+    Return the `(name, value)` pairs of the properties matching any of the
+    glob `patterns` (e.g. `net_interface.*.ip`), in RADL order.
+    """
+    return [
+        (name, value)
+        for name, value in properties.items()
+        if any(fnmatchcase(name, pattern) for pattern in patterns)
+    ]
+
+
+def format_property(name, value):
+    """Format a property value for display, showing sizes as RADL does."""
+    if name in ("memory.size", "memory_size"):
+        return format_size(value, MEMORY_UNITS)
+    if name.endswith(".size") or name.endswith("_size"):
+        return format_size(value)
+    return str(value)
+
+
+class RADLCache:
+    """
+    Parsed `VMInfo` records per infrastructure and VM.
+
+    A RADL text is only parsed again when its content hash changes, so
+    `%apricot_info`, IP lookups and SSH credential resolution share the
+    work. `get` also serves records without any IM call while they are
+    younger than a caller-given age.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def parse(self, inf_id, vm_id, text):
+        key = (inf_id, str(vm_id))
+        digest = hashlib.sha1(text.encode()).hexdigest()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == digest:
+                self._entries[key] = (digest, time.monotonic(), entry[2])
+                self._entries.move_to_end(key)
+                return entry[2]
+
+        vm_info = parse_vm_info(vm_id, text)
+
+        with self._lock:
+            self._entries[key] = (digest, time.monotonic(), vm_info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return vm_info
+
+    def get(self, inf_id, vm_id, max_age):
+        """Return the cached record of a VM if it was fetched less than `max_age` seconds ago."""
+        with self._lock:
+            entry = self._entries.get((inf_id, str(vm_id)))
+        if entry is None or time.monotonic() - entry[1] > max_age:
+            return None
+        return entry[2]
+
+    def invalidate(self, inf_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == inf_id]:
+                del self._entries[key]
@@ -0,0 +1,176 @@
+from collections import deque, namedtuple
+
+import threading
+import time
+
+AUTOSCALE_INTERVAL = 60
+SCALE_UP_COOLDOWN = 300
+SCALE_DOWN_COOLDOWN = 600
+# Seconds a node must stay idle before its VM is removed.
+IDLE_TIME = 600
+MAX_EVENTS = 50
+
+ScalePolicy = namedtuple(
+    "ScalePolicy",
+    ["min_workers", "max_workers", "jobs_per_worker", "up_cooldown", "down_cooldown", "idle_time"],
+    defaults=(1, SCALE_UP_COOLDOWN, SCALE_DOWN_COOLDOWN, IDLE_TIME),
+)
+
+# Pending jobs and names of idle nodes reported by the batch system.
+QueueState = namedtuple("QueueState", ["pending", "idle_nodes"])
+
+IDLE_MARKER = "#idle"
+
+
+def node_name(vm_info):
+    """Batch system name of a VM: the short DNS name of its first interface, or its ID."""
+    dns_name = vm_info.properties.get("net_interface.0.dns_name")
+    return str(dns_name).split(".")[0] if dns_name else vm_info.vm_id
+
+
+def scale_radl(system, count):
+    """RADL that adds `count` VMs of an existing system with `addresource`."""
+    return f"deploy {system} {count}\n"
+
+
+def queue_script():
+    """Shell script printing the pending SLURM jobs and the idle nodes of a cluster."""
+    return "\n".join([
+        'command -v squeue >/dev/null 2>&1 || { echo "squeue not found" >&2; exit 127; }',
+        "squeue -h -r -t PENDING -o %i | wc -l",
+        f"echo '{IDLE_MARKER}'",
+        "sinfo -h -N -t idle -o %N | sort -u",
+    ])
+
+
+def parse_queue(output):
+    lines = output.split(IDLE_MARKER, 1)
+    pending = int(lines[0].split()[0]) if lines[0].split() else 0
+    idle = lines[1].split() if len(lines) == 2 else []
+    return QueueState(pending, set(idle))
+
+
+def plan_scaling(policy, queue, workers, idle_since, now, last_up, last_down):
+    """
+    Decide how to resize a cluster.
+
+    `workers` maps the VM ID of every worker to its node name and
+    `idle_since` maps node names to when they were first seen idle.
+    Returns `(add, remove)`: a number of VMs to add and the IDs of the VMs
+    to remove. With pending jobs the cluster is grown to one worker per
+    `jobs_per_worker` jobs on top of the busy workers (those not reported
+    idle, including ones still booting), so idle workers absorb jobs first;
+    with an empty queue, workers idle for `idle_time` are removed, highest
+    IDs first. Each direction waits for its cooldown after any change, and
+    the worker count is always brought back within the policy bounds.
+    """
+    count = len(workers)
+    if count < policy.min_workers:
+        return policy.min_workers - count, []
+
+    if queue.pending:
+        if now - last_up < policy.up_cooldown:
+            return 0, []
+        busy = sum(1 for node in workers.values() if node not in queue.idle_nodes)
+        target = -(-queue.pending // policy.jobs_per_worker) + busy
+        target = max(policy.min_workers, min(target, policy.max_workers))
+        return max(target - count, 0), []
+
+    if count > policy.max_workers:
+        excess = count - policy.max_workers
+    elif (
+        count > policy.min_workers
+        and now - last_down >= policy.down_cooldown
+        and now - last_up >= policy.up_cooldown
+    ):
+        excess = count - policy.min_workers
+    else:
+        return 0, []
+
+    idle = [
+        vm_id
+        for vm_id, node in workers.items()
+        if node in idle_since and now - idle_since[node] >= policy.idle_time
+    ]
+    idle.sort(key=lambda vm_id: int(vm_id) if vm_id.isdigit() else vm_id, reverse=True)
+    return 0, idle[:excess]
+
+
+class Autoscaler:
+    """
+    Resize a cluster to its queue in the background.
+
+    Every `interval` seconds `queue_state()` is read, `workers()` lists the
+    worker VMs as `{vm_id: node_name}` and `plan_scaling` decides; any
+    change is applied with `scale(add, remove)`. The last decisions and
+    errors are kept in `events` as `(time, message)` pairs.
+    """
+
+    def __init__(self, policy, queue_state, workers, scale, interval=AUTOSCALE_INTERVAL,
+                 clock=time.monotonic):
+        self.policy = policy
+        self.queue_state = queue_state
+        self.workers = workers
+        self.scale = scale
+        self.interval = interval
+        self.clock = clock
+
+        self.events = deque(maxlen=MAX_EVENTS)
+        self.idle_since = {}
+        self.last_up = self.last_down = float("-inf")
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def log(self, message):
+        self.events.append((time.time(), message))
+
+    def step(self):
+        """Evaluate the cluster once and apply the decision; return `(add, remove)`."""
+        queue = self.queue_state()
+        workers = self.workers()
+        now = self.clock()
+
+        self.idle_since = {
+            node: self.idle_since.get(node, now) for node in queue.idle_nodes
+        }
+        add, remove = plan_scaling(
+            self.policy, queue, workers, self.idle_since, now, self.last_up, self.last_down
+        )
+        if not add and not remove:
+            return add, remove
+
+        self.scale(add, remove)
+        if add:
+            self.last_up = now
+            self.log(f"Added {add} worker(s) for {queue.pending} pending job(s).")
+        if remove:
+            self.last_down = now
+            self.log(f"Removed idle worker VM(s) {', '.join(remove)}.")
+        return add, remove
+
+    def run(self):
+        while not self._stop.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                self.log(f"Error: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="apricot-autoscaler", daemon=True)
+        self._thread.start()
+        self.log("Autoscaling started.")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+            self.log("Autoscaling stopped.")
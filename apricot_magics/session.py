@@ -0,0 +1,314 @@
+from .concurrency import fan_out
+from .stats import span, InstrumentedClient
+
+import os
+import threading
+import time
+
+# Set APRICOT_IM_ENDPOINT to use another IM, e.g. a local one for testing.
+IM_ENDPOINT = os.environ.get("APRICOT_IM_ENDPOINT", "https://im.egi.eu/im")
+# Comma-separated list of IMs to spread infrastructures over; the first is the default.
+IM_ENDPOINTS = [
+    endpoint.strip()
+    for endpoint in os.environ.get("APRICOT_IM_ENDPOINTS", IM_ENDPOINT).split(",")
+    if endpoint.strip()
+]
+TOKEN_EXPIRY_MARGIN = 60
+
+# How new infrastructures are given an endpoint when none is named.
+ROUTING_POLICIES = ("round-robin", "latency")
+# Weight of the last call in the moving average of an endpoint's latency.
+LATENCY_WEIGHT = 0.3
+
+
+def get_im_token(auth_data):
+    """Return the access token of the InfrastructureManager entry in parsed auth data."""
+    if isinstance(auth_data, str):
+        return auth_data[7:] if auth_data.startswith("Bearer ") else None
+
+    for entry in auth_data:
+        if entry.get("type") == "InfrastructureManager":
+            return entry.get("token")
+
+    return None
+
+
+def get_token_expiry(token):
+    """Return the `exp` claim of a JWT, or None if it cannot be decoded."""
+    if not token:
+        return None
+
+    import jwt
+
+    try:
+        decoded_token = jwt.decode(
+            token,
+            options={"verify_signature": False},
+            algorithms=["HS256", "RS256"],
+        )
+    except jwt.DecodeError:
+        return None
+
+    return decoded_token.get("exp")
+
+
+class IMSession:
+    """
+    Long-lived IM client bound to an authfile.
+
+    The authfile is only re-read and the client only rebuilt when the file
+    changes on disk or when the access token is about to expire, in which
+    case `refresh` is called first (it is expected to rewrite the authfile).
+    With `stats`, the returned client records every IM call in it.
+    """
+
+    def __init__(self, endpoint, authfile_path, refresh=None,
+                 expiry_margin=TOKEN_EXPIRY_MARGIN, stats=None):
+        self.endpoint = endpoint
+        self.authfile_path = authfile_path
+        self.refresh = refresh
+        self.expiry_margin = expiry_margin
+        self.stats = stats
+
+        self.client = None
+        self.auth_data = None
+        self.token_expiry = None
+        self._mtime = None
+        self._lock = threading.RLock()
+
+    def _authfile_mtime(self):
+        try:
+            return os.stat(self.authfile_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _token_expiring(self):
+        if self.token_expiry is None:
+            return False
+        return self.token_expiry - self.expiry_margin <= time.time()
+
+    def _load(self):
+        from imclient import IMClient
+
+        self._mtime = self._authfile_mtime()
+        self.auth_data = IMClient.read_auth_data(self.authfile_path)
+        self.token_expiry = get_token_expiry(get_im_token(self.auth_data))
+
+    def invalidate(self):
+        """Force the next `get_client` call to re-read the authfile."""
+        with self._lock:
+            self.client = None
+
+    def get_client(self):
+        """Return the cached IMClient, rebuilding it only when needed."""
+        with self._lock:
+            if (
+                self.client is not None
+                and self._mtime == self._authfile_mtime()
+                and not self._token_expiring()
+            ):
+                return self.client
+
+            from imclient import IMClient
+
+            # Re-reading the authfile and checking (or refreshing) its token.
+            with span(self.stats, "im.session_load"):
+                self._load()
+
+                if self._token_expiring() and self.refresh is not None:
+                    self.refresh()
+                    self._load()
+
+            client = IMClient.init_client(self.endpoint, self.auth_data)
+            if self.stats is not None:
+                client = InstrumentedClient(client, self.stats)
+
+            self.client = client
+            return self.client
+
+
+class IMSessionPool:
+    """
+    One `IMSession` per IM endpoint, sharing an authfile.
+
+    Every infrastructure belongs to the endpoint that created it:
+    `lookup(inf_id)` returns the endpoint recorded for it (None for the
+    default one, the first of `endpoints`), and answers are kept in memory.
+    `client` is an IM client that sends each call to the right endpoint, so
+    calls fanned out over infrastructures reach their IMs concurrently.
+
+    New infrastructures go to the endpoint named on `create` or else to
+    one picked by `policy`: `round-robin`, or `latency` for the endpoint
+    with the lowest moving average of the time its calls took. Endpoints
+    never called are timed first with a `getversion` call.
+    """
+
+    def __init__(self, endpoints, authfile_path, refresh=None,
+                 expiry_margin=TOKEN_EXPIRY_MARGIN, stats=None, policy="round-robin",
+                 lookup=None):
+        self.authfile_path = authfile_path
+        self.refresh = refresh
+        self.expiry_margin = expiry_margin
+        self.stats = stats
+        self.lookup = lookup
+        self.endpoints = list(endpoints)
+        self.policy = policy
+
+        self.sessions = {}
+        self.latencies = {}
+        # inf_id -> endpoint, or None for the default one
+        self.bound = {}
+        self.client = RoutedClient(self)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def endpoints(self):
+        return self._endpoints
+
+    @endpoints.setter
+    def endpoints(self, endpoints):
+        if not endpoints:
+            raise ValueError("At least one IM endpoint is needed")
+        self._endpoints = [endpoint.rstrip("/") for endpoint in endpoints]
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy):
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(
+                f"Unknown routing policy '{policy}', use one of: {', '.join(ROUTING_POLICIES)}"
+            )
+        self._policy = policy
+
+    @property
+    def default(self):
+        return self.endpoints[0]
+
+    def session(self, endpoint=None):
+        endpoint = (endpoint or self.default).rstrip("/")
+        with self._lock:
+            session = self.sessions.get(endpoint)
+            if session is None:
+                session = self.sessions[endpoint] = IMSession(
+                    endpoint, self.authfile_path, self.refresh, self.expiry_margin, self.stats
+                )
+        return session
+
+    def get_client(self, endpoint=None):
+        """Return the IMClient of one endpoint (by default, the default one)."""
+        return self.session(endpoint).get_client()
+
+    def invalidate(self):
+        with self._lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            session.invalidate()
+
+    # Infrastructures
+
+    def bind(self, inf_id, endpoint):
+        with self._lock:
+            self.bound[inf_id] = endpoint.rstrip("/") if endpoint else None
+
+    def bind_records(self, records):
+        """Bind infrastructures to the endpoints of already loaded store records."""
+        with self._lock:
+            for record in records:
+                self.bound[record["infrastructureID"]] = record.get("imEndpoint")
+
+    def forget(self, inf_id):
+        with self._lock:
+            self.bound.pop(inf_id, None)
+
+    def endpoint_of(self, inf_id):
+        with self._lock:
+            known = inf_id in self.bound
+            endpoint = self.bound.get(inf_id)
+        if not known and self.lookup is not None:
+            endpoint = self.lookup(inf_id)
+            self.bind(inf_id, endpoint)
+        return endpoint.rstrip("/") if endpoint else self.default
+
+    # Routing
+
+    def observe(self, endpoint, seconds):
+        """Add the duration of a call to the latency average of an endpoint."""
+        with self._lock:
+            previous = self.latencies.get(endpoint)
+            if previous is None or previous == float("inf") or seconds == float("inf"):
+                self.latencies[endpoint] = seconds
+            else:
+                self.latencies[endpoint] = (
+                    LATENCY_WEIGHT * seconds + (1 - LATENCY_WEIGHT) * previous
+                )
+
+    def probe(self, endpoint):
+        start = time.monotonic()
+        try:
+            success, version = self.get_client(endpoint).getversion()
+        except Exception:
+            success = False
+        self.observe(endpoint, time.monotonic() - start if success else float("inf"))
+
+    def choose(self):
+        """Pick the endpoint of a new infrastructure by the routing policy."""
+        if self.policy == "latency" and len(self.endpoints) > 1:
+            unmeasured = [endpoint for endpoint in self.endpoints if endpoint not in self.latencies]
+            if unmeasured:
+                fan_out(self.probe, unmeasured)
+            with self._lock:
+                return min(
+                    self.endpoints, key=lambda endpoint: self.latencies.get(endpoint, float("inf"))
+                )
+
+        with self._lock:
+            endpoint = self.endpoints[self._next % len(self.endpoints)]
+            self._next += 1
+        return endpoint
+
+
+class RoutedClient:
+    """
+    IMClient stand-in that sends every call to the endpoint of its infrastructure.
+
+    As for `InstrumentedClient`, the infrastructure is the first argument
+    of the methods in `INFRASTRUCTURE_METHODS`; other methods go to the
+    default endpoint. `create` takes an optional `endpoint` and binds the
+    new infrastructure to wherever it was created.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        pool = self._pool
+
+        def call(*args, endpoint=None, **kwargs):
+            if endpoint is None:
+                if name in InstrumentedClient.INFRASTRUCTURE_METHODS and args:
+                    endpoint = pool.endpoint_of(args[0])
+                elif name == "create":
+                    endpoint = pool.choose()
+                else:
+                    endpoint = pool.default
+            endpoint = endpoint.rstrip("/")
+
+            method = getattr(pool.get_client(endpoint), name)
+            start = time.monotonic()
+            try:
+                result = method(*args, **kwargs)
+            except Exception:
+                # Unreachable endpoints are avoided until they answer again.
+                pool.observe(endpoint, float("inf"))
+                raise
+            pool.observe(endpoint, time.monotonic() - start)
+
+            if name == "create" and isinstance(result, tuple) and result[0]:
+                pool.bind(result[1], endpoint)
+            return result
+
+        return call
@@ -0,0 +1,323 @@
+from collections import Counter, namedtuple
+
+import os
+import secrets
+import shlex
+import threading
+import time
+
+from .concurrency import fan_out
+from .stats import span
+
+SLURM_MIN_INTERVAL = 5
+SLURM_MAX_INTERVAL = 60
+
+# Job states after which a job never changes again. UNKNOWN is given to
+# jobs that left the queue on clusters without accounting (no `sacct`).
+JOB_SETTLED_STATES = {
+    "COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL",
+    "PREEMPTED", "BOOT_FAIL", "DEADLINE", "REVOKED", "UNKNOWN",
+}
+JOB_FAILED_STATES = JOB_SETTLED_STATES - {"COMPLETED", "UNKNOWN"}
+
+SQUEUE_FORMAT = "%i|%j|%T|%M|%N|%r"
+SACCT_FIELDS = "JobID,JobName,State,ExitCode,Elapsed,NodeList"
+SACCT_MARKER = "#sacct"
+
+Job = namedtuple(
+    "Job", ["inf_id", "job_id", "name", "state", "exit_code", "elapsed", "nodes", "reason"]
+)
+
+
+class JobList(list):
+    """Job records returned by the magics, shown as a one-line summary."""
+
+    def __repr__(self):
+        states = Counter(job.state for job in self)
+        summary = ", ".join(f"{count} {state}" for state, count in sorted(states.items()))
+        return f"<{len(self)} SLURM job(s){': ' + summary if summary else ''}>"
+
+
+def submission_of(job_id):
+    """Return the ID sbatch gave for a job or array task (`123_4` -> `123`)."""
+    return job_id.split("_", 1)[0]
+
+
+def as_user(command, user):
+    """Run a command list as `user` in its home directory, when given."""
+    return ["sudo", "-n", "-u", user, "-i"] + command if user else command
+
+
+def submit_script(scripts, array=None, user=None):
+    """
+    Build one shell script that submits every `(path, content)` script.
+
+    Scripts with content are fed to sbatch on its standard input, so local
+    files need no copy on the cluster; the others are remote paths. For
+    each script a line `OK <index> <sbatch output>` or `ERR <index>
+    <error>` is printed.
+    """
+    delimiter = f"APRICOT_{secrets.token_hex(8)}"
+    lines = []
+    for index, (path, content) in enumerate(scripts):
+        command = ["sbatch", "--parsable"] + (["--array", array] if array else [])
+        command = shlex.join(as_user(command, user))
+        if content is None:
+            lines.append(f"out=$({command} {shlex.quote(path)} 2>&1)")
+        else:
+            if not content.endswith("\n"):
+                content += "\n"
+            lines.append(f"out=$({command} 2>&1 <<'{delimiter}'\n{content}{delimiter}\n)")
+        lines.append(
+            f'if [ $? -eq 0 ]; then echo "OK {index} $(echo "$out" | tail -n 1)";'
+            f' else echo "ERR {index} $(echo "$out" | tr \'\\n\' \' \')"; fi'
+        )
+    return "\n".join(lines)
+
+
+def poll_script(job_ids):
+    """Build one shell script that reports the state of every job in `job_ids`."""
+    ids = shlex.quote(",".join(job_ids))
+    return "\n".join([
+        'command -v squeue >/dev/null 2>&1 || { echo "squeue not found" >&2; exit 127; }',
+        f"squeue -h -r -j {ids} -o '{SQUEUE_FORMAT}' 2>/dev/null",
+        f"echo '{SACCT_MARKER}'",
+        f"sacct -n -P -X -j {ids} -o {SACCT_FIELDS} 2>/dev/null",
+        "true",
+    ])
+
+
+def parse_poll(inf_id, output):
+    """Parse the output of `poll_script` into `{job_id: Job}`."""
+    jobs = {}
+    in_sacct = False
+    for line in output.splitlines():
+        if line == SACCT_MARKER:
+            in_sacct = True
+            continue
+        if line.count("|") < 5:
+            continue
+
+        job_id, rest = line.split("|", 1)
+        if in_sacct:
+            # Jobs still queued are better described by squeue.
+            if job_id in jobs:
+                continue
+            name, state, exit_code, elapsed, nodes = rest.rsplit("|", 4)
+            # e.g. "CANCELLED by 1000"
+            state = state.split()[0] if state else "UNKNOWN"
+            code = exit_code.split(":")[0]
+            jobs[job_id] = Job(
+                inf_id, job_id, name, state, int(code) if code.isdigit() else None,
+                elapsed, nodes, "",
+            )
+        else:
+            name, state, elapsed, nodes, reason = rest.rsplit("|", 4)
+            jobs[job_id] = Job(
+                inf_id, job_id, name, state, None, elapsed, nodes,
+                "" if reason == "None" else reason,
+            )
+    return jobs
+
+
+class SlurmTracker:
+    """
+    SLURM jobs submitted to the front-ends of infrastructures.
+
+    Jobs are tracked per infrastructure by the ID sbatch returned, which
+    stands for every task of a job array. A poll asks each cluster about
+    all of its unsettled jobs with a single remote call (`squeue` for
+    queued jobs and `sacct` for finished ones), so its cost does not grow
+    with the number of jobs; clusters are polled concurrently.
+
+    `run_command(inf_id, command)` runs a command list on the front-end of
+    an infrastructure and returns `(exit_code, stdout, stderr)`.
+    """
+
+    def __init__(self, run_command, stats=None, max_workers=8):
+        self.run_command = run_command
+        self.stats = stats
+        self.max_workers = max_workers
+        # inf_id -> {job_id: Job}
+        self.jobs = {}
+        # inf_id -> IDs returned by sbatch
+        self.submissions = {}
+        self._lock = threading.Lock()
+
+    def track(self, inf_id, job_id, name=""):
+        """Track a submission, with a PENDING placeholder until it is polled."""
+        job_id = submission_of(job_id)
+        with self._lock:
+            submissions = self.submissions.setdefault(inf_id, set())
+            if job_id not in submissions:
+                submissions.add(job_id)
+                self.jobs.setdefault(inf_id, {})[job_id] = Job(
+                    inf_id, job_id, name, "PENDING", None, "", "", ""
+                )
+
+    def forget(self, inf_id):
+        with self._lock:
+            self.jobs.pop(inf_id, None)
+            self.submissions.pop(inf_id, None)
+
+    def get(self, inf_ids=None, job_ids=None):
+        """Return the tracked jobs of some infrastructures, or only those of some submissions."""
+        with self._lock:
+            jobs = [
+                job
+                for inf_id, inf_jobs in self.jobs.items()
+                if inf_ids is None or inf_id in inf_ids
+                for job in inf_jobs.values()
+                if job_ids is None
+                or job.job_id in job_ids
+                or submission_of(job.job_id) in job_ids
+            ]
+        return JobList(jobs)
+
+    # Remote calls
+
+    def submit(self, inf_id, scripts, array=None, user=None):
+        """
+        Submit scripts given as local files or remote paths in one call.
+
+        Returns `[(script, job_id, error)]` in the order of `scripts`.
+        """
+        entries = []
+        for path in scripts:
+            content = None
+            if os.path.isfile(path):
+                with open(path) as f:
+                    content = f.read()
+            entries.append((path, content))
+
+        with span(self.stats, "slurm.submit", inf_id) as submit_span:
+            code, stdout, stderr = self.run_command(
+                inf_id, [submit_script(entries, array, user)]
+            )
+            submit_span.error = code != 0
+        if code != 0 and not stdout:
+            raise RuntimeError(stderr.strip() or f"ssh exited with {code}")
+
+        results = {}
+        for line in stdout.splitlines():
+            words = line.split(" ", 2)
+            if len(words) >= 2 and words[0] in ("OK", "ERR") and words[1].isdigit():
+                results[int(words[1])] = (words[0], words[2] if len(words) == 3 else "")
+
+        submitted = []
+        for index, path in enumerate(scripts):
+            status, output = results.get(index, ("ERR", "no answer from sbatch"))
+            if status == "OK" and output:
+                job_id = output.split(";")[0].strip()
+                self.track(inf_id, job_id, os.path.basename(path))
+                submitted.append((path, job_id, None))
+            else:
+                submitted.append((path, None, RuntimeError(output.strip())))
+        return submitted
+
+    def poll_cluster(self, inf_id):
+        """Refresh every unsettled job of one cluster; return how many changed."""
+        with self._lock:
+            pending = sorted(
+                submitted
+                for submitted in self.submissions.get(inf_id, ())
+                if any(
+                    submission_of(job.job_id) == submitted
+                    and job.state not in JOB_SETTLED_STATES
+                    for job in self.jobs[inf_id].values()
+                )
+            )
+        if not pending:
+            return 0
+
+        with span(self.stats, "slurm.poll", inf_id) as poll_span:
+            code, stdout, stderr = self.run_command(inf_id, [poll_script(pending)])
+            poll_span.error = code != 0
+        if code != 0:
+            raise RuntimeError(stderr.strip() or f"ssh exited with {code}")
+
+        rows = parse_poll(inf_id, stdout)
+        split = {submission_of(job_id) for job_id in rows if "_" in job_id}
+        changed = 0
+        with self._lock:
+            submissions = self.submissions.get(inf_id)
+            jobs = self.jobs.get(inf_id)
+            if submissions is None:
+                return 0
+
+            for job_id, job in list(jobs.items()):
+                submitted = submission_of(job_id)
+                if submitted not in pending or job_id in rows:
+                    continue
+                if "[" in job_id or (job_id == submitted and submitted in split):
+                    # Pending array ranges and placeholders split into tasks.
+                    del jobs[job_id]
+                elif job.state not in JOB_SETTLED_STATES:
+                    jobs[job_id] = job._replace(state="UNKNOWN")
+                    changed += 1
+
+            for job_id, job in rows.items():
+                if submission_of(job_id) not in pending:
+                    continue
+                if jobs.get(job_id) != job:
+                    changed += 1
+                jobs[job_id] = job
+
+        return changed
+
+    def poll(self, inf_ids=None):
+        """
+        Poll clusters concurrently, one remote call each.
+
+        Returns `(changed, errors)` with the number of jobs that changed
+        and `{inf_id: error}`.
+        """
+        with self._lock:
+            inf_ids = [
+                inf_id for inf_id in self.submissions if inf_ids is None or inf_id in inf_ids
+            ]
+
+        changed, errors = 0, {}
+        for inf_id, count, error in fan_out(self.poll_cluster, inf_ids, self.max_workers):
+            if error is not None:
+                errors[inf_id] = error
+            else:
+                changed += count
+        return changed, errors
+
+    def wait(self, inf_ids=None, job_ids=None, timeout=None, progress=None,
+             min_interval=SLURM_MIN_INTERVAL, max_interval=SLURM_MAX_INTERVAL):
+        """
+        Poll until every selected job has settled and return the jobs.
+
+        The interval doubles from `min_interval` up to `max_interval` while
+        nothing changes. `progress(jobs, errors)` is called after each poll.
+        Raises `TimeoutError` after `timeout` seconds.
+        """
+        start = time.monotonic()
+        interval = min_interval
+        while True:
+            changed, errors = self.poll(inf_ids)
+            jobs = self.get(inf_ids, job_ids)
+            if progress is not None:
+                progress(jobs, errors)
+            if all(job.state in JOB_SETTLED_STATES for job in jobs):
+                return jobs
+
+            interval = min_interval if changed else min(interval * 2, max_interval)
+            if timeout is not None:
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise TimeoutError(f"Jobs still running after {timeout:.0f}s")
+                interval = min(interval, remaining)
+            time.sleep(interval)
+
+    def cancel(self, inf_id, job_ids, user=None):
+        """Cancel jobs of one cluster with a single scancel call."""
+        with span(self.stats, "slurm.cancel", inf_id) as cancel_span:
+            code, _, stderr = self.run_command(
+                inf_id, [shlex.join(as_user(["scancel", *job_ids], user))]
+            )
+            cancel_span.error = code != 0
+        if code != 0:
+            raise RuntimeError(stderr.strip() or f"scancel exited with {code}")
@@ -0,0 +1,193 @@
+from subprocess import run, DEVNULL
+
+import atexit
+import hashlib
+import os
+import shlex
+import shutil
+import tempfile
+import threading
+
+from .stats import span
+
+SSH_IDLE_TIMEOUT = 600
+
+SSH_OPTIONS = [
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "UserKnownHostsFile=/dev/null",
+    "-o",
+    "LogLevel=ERROR",
+]
+
+
+class SSHConnection:
+    """
+    Multiplexed SSH connection to a single VM.
+
+    A persistent OpenSSH ControlMaster is started on first use and shared by
+    every ssh/scp command built from this object until it has been idle for
+    `idle_timeout` seconds. The private key lives next to the control socket
+    in a directory only readable by the current user. VMs without a public
+    address are reached through the multiplexed connection of `proxy`.
+
+    Key writes and handshakes are recorded in `stats` under `inf_id`.
+    """
+
+    def __init__(self, base_dir, name, user, host, private_key,
+                 idle_timeout=SSH_IDLE_TIMEOUT, proxy=None, inf_id=None, stats=None):
+        self.user = user
+        self.host = host
+        self.private_key = private_key
+        self.idle_timeout = idle_timeout
+        self.proxy = proxy
+        self.inf_id = inf_id
+        self.stats = stats
+        self.key_path = os.path.join(base_dir, f"{name}.pem")
+        self.control_path = os.path.join(base_dir, name)
+        self.log_path = os.path.join(base_dir, f"{name}.log")
+        self._lock = threading.Lock()
+
+        with span(stats, "ssh.write_key", inf_id):
+            with open(os.open(self.key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                f.write(private_key)
+
+    @property
+    def target(self):
+        return f"{self.user}@{self.host}"
+
+    def options(self):
+        options = [
+            "-i",
+            self.key_path,
+            *SSH_OPTIONS,
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path}",
+        ]
+
+        if self.proxy is not None:
+            proxy_command = ["ssh", *self.proxy.options(), "-W", "%h:%p", self.proxy.target]
+            options += ["-o", "ProxyCommand=" + " ".join(shlex.quote(arg) for arg in proxy_command)]
+
+        return options
+
+    def is_open(self):
+        return os.path.exists(self.control_path)
+
+    def open(self):
+        """Start the background master connection if it is not running."""
+        with self._lock:
+            if self.is_open():
+                return True
+
+            if self.proxy is not None:
+                self.proxy.open()
+
+            with span(self.stats, "ssh.connect", self.inf_id) as handshake:
+                with open(self.log_path, "w") as log:
+                    result = run(
+                        ["ssh", *self.options(), "-o", f"ControlPersist={self.idle_timeout}",
+                         "-M", "-N", "-f", self.target],
+                        stdin=DEVNULL,
+                        stdout=DEVNULL,
+                        stderr=log,
+                    )
+                handshake.error = result.returncode != 0
+
+        # Commands still work without a master; they just pay the handshake.
+        return result.returncode == 0
+
+    def ssh_command(self, remote_command, tty=False):
+        """
+        Build an ssh command line for this VM.
+
+        With `tty` a pseudo-terminal is forced, so remote programs flush
+        line by line and are sent SIGHUP when the local ssh is killed.
+        """
+        self.open()
+        return ["ssh", *self.options(), *(["-tt"] if tty else []), self.target, *remote_command]
+
+    def scp_command(self):
+        self.open()
+        return ["scp", *self.options()]
+
+    def close(self):
+        if self.is_open():
+            run(
+                ["ssh", "-o", f"ControlPath={self.control_path}", "-O", "exit", self.target],
+                stdin=DEVNULL,
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+            )
+
+        # A master that died without cleaning up leaves its socket behind.
+        for path in (self.key_path, self.log_path, self.control_path):
+            if os.path.lexists(path):
+                os.remove(path)
+
+
+class SSHConnectionManager:
+    """Keep one `SSHConnection` per (infrastructure, VM)."""
+
+    def __init__(self, idle_timeout=SSH_IDLE_TIMEOUT, stats=None):
+        self.idle_timeout = idle_timeout
+        self.stats = stats
+        self.connections = {}
+        self._base_dir = None
+        self._lock = threading.Lock()
+        atexit.register(self.close_all)
+
+    @property
+    def base_dir(self):
+        # Unix socket paths are limited to ~100 chars, so stay in the temp dir.
+        if self._base_dir is None:
+            self._base_dir = tempfile.mkdtemp(prefix="apricot-ssh-")
+        return self._base_dir
+
+    def get(self, inf_id, vm_id, user, host, private_key, proxy=None):
+        """Return the connection for a VM, replacing it if its credentials changed."""
+        key = (inf_id, str(vm_id))
+
+        with self._lock:
+            connection = self.connections.get(key)
+            if connection is not None:
+                if (
+                    connection.user,
+                    connection.host,
+                    connection.private_key,
+                    connection.proxy,
+                ) == (user, host, private_key, proxy):
+                    return connection
+                connection.close()
+
+            name = hashlib.sha1(f"{inf_id}/{vm_id}".encode()).hexdigest()[:12]
+            connection = SSHConnection(
+                self.base_dir, name, user, host, private_key, self.idle_timeout, proxy,
+                inf_id, self.stats,
+            )
+            self.connections[key] = connection
+            return connection
+
+    def close(self, inf_id):
+        """Close the connections to every VM of an infrastructure."""
+        with self._lock:
+            keys = [key for key in self.connections if key[0] == inf_id]
+            connections = [self.connections.pop(key) for key in keys]
+
+        for connection in connections:
+            connection.close()
+
+    def close_all(self):
+        with self._lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+
+        for connection in connections:
+            connection.close()
+
+        if self._base_dir is not None:
+            shutil.rmtree(self._base_dir, ignore_errors=True)
+            self._base_dir = None
@@ -0,0 +1,347 @@
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+import bisect
+import json
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120
+)
+# Latest latencies kept per series to compute percentiles.
+SAMPLE_SIZE = 2048
+PERCENTILES = (50, 95, 99)
+
+# Spans of the command being traced, if any. Being a context variable, only
+# work done on behalf of that command (including `fan_out` workers) is traced,
+# not background polling or refreshes started elsewhere.
+_current_trace = ContextVar("apricot_trace", default=None)
+
+
+def percentile(sorted_samples, percent):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_samples:
+        return None
+    rank = max(1, -(-percent * len(sorted_samples) // 100))
+    return sorted_samples[int(rank) - 1]
+
+
+class Series:
+    """Counters and latency histogram of one operation, optionally for one infrastructure."""
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.samples = deque(maxlen=sample_size)
+
+    def add(self, seconds, error, nbytes):
+        self.count += 1
+        self.errors += bool(error)
+        self.seconds += seconds
+        self.bytes += nbytes
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.samples.append(seconds)
+
+    def summary(self):
+        samples = sorted(self.samples)
+        summary = {
+            "count": self.count,
+            "errors": self.errors,
+            "error_rate": self.errors / self.count if self.count else 0.0,
+            "total_seconds": self.seconds,
+            "bytes": self.bytes,
+        }
+        for percent in PERCENTILES:
+            summary[f"p{percent}_seconds"] = percentile(samples, percent)
+        return summary
+
+
+class Span:
+    """
+    A timed operation in progress.
+
+    Callers may set `error` for failures that are not exceptions (e.g. an
+    exit code) and add to `nbytes` while data is moved.
+    """
+
+    __slots__ = ("operation", "infrastructure", "start", "error", "nbytes")
+
+    def __init__(self, operation, infrastructure=None):
+        self.operation = operation
+        self.infrastructure = infrastructure
+        self.start = time.perf_counter()
+        self.error = False
+        self.nbytes = 0
+
+
+class Trace(list):
+    """Spans recorded while tracing a command, with offsets relative to its start."""
+
+    def __init__(self):
+        super().__init__()
+        self.start = time.perf_counter()
+        self.seconds = None
+        self._lock = threading.Lock()
+
+    def append(self, span):
+        with self._lock:
+            super().append(span)
+
+    def breakdown(self):
+        """Aggregate the spans into `{operation: (calls, errors, total_seconds, max_seconds)}`."""
+        breakdown = {}
+        for span in sorted(self, key=lambda span: span["start"]):
+            calls, errors, total, longest = breakdown.get(span["operation"], (0, 0, 0.0, 0.0))
+            breakdown[span["operation"]] = (
+                calls + 1,
+                errors + span["error"],
+                total + span["seconds"],
+                max(longest, span["seconds"]),
+            )
+        return breakdown
+
+
+def span(stats, operation, infrastructure=None):
+    """`stats.span(...)`, or an unrecorded span if `stats` is None."""
+    if stats is None:
+        return nullcontext(Span(operation, infrastructure))
+    return stats.span(operation, infrastructure)
+
+
+def escape_label(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+class Stats:
+    """
+    Call counts, latencies, bytes and errors of IM calls, token refreshes,
+    SSH commands and transfers.
+
+    Every span is recorded twice over: under its operation name and, when it
+    concerns one infrastructure, under `(operation, infrastructure)` as well
+    so per-infrastructure reports need no extra bookkeeping. Recording is a
+    few additions under a lock, cheap enough to stay always on.
+    """
+
+    def __init__(self, sample_size=SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.tracing = False
+        self._series = {}
+        self._lock = threading.Lock()
+
+    # Recording
+
+    def record(self, operation, seconds, infrastructure=None, error=False, nbytes=0,
+               start=None):
+        with self._lock:
+            for key in {(operation, None), (operation, infrastructure)}:
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = Series(self.sample_size)
+                series.add(seconds, error, nbytes)
+
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append(
+                {
+                    "operation": operation,
+                    "infrastructure": infrastructure,
+                    "start": (start if start is not None else time.perf_counter() - seconds)
+                    - trace.start,
+                    "seconds": seconds,
+                    "error": bool(error),
+                    "bytes": nbytes,
+                }
+            )
+
+    @contextmanager
+    def span(self, operation, infrastructure=None):
+        """Time the enclosed block; an exception marks the span as failed and is re-raised."""
+        span = Span(operation, infrastructure)
+        try:
+            yield span
+        except BaseException:
+            span.error = True
+            raise
+        finally:
+            self.record(
+                operation,
+                time.perf_counter() - span.start,
+                infrastructure,
+                span.error,
+                span.nbytes,
+                span.start,
+            )
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    # Tracing
+
+    @contextmanager
+    def trace(self):
+        """Collect the spans recorded by the enclosed block (and the threads it fans out to)."""
+        trace = Trace()
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        finally:
+            trace.seconds = time.perf_counter() - trace.start
+            _current_trace.reset(token)
+
+    @staticmethod
+    def current_trace():
+        return _current_trace.get()
+
+    # Reporting
+
+    def summary(self, per_infrastructure=False):
+        """
+        Return `{operation: summary}`, or `{infrastructure: {operation: summary}}`
+        with `per_infrastructure`.
+        """
+        with self._lock:
+            items = [
+                (key, series.summary())
+                for key, series in sorted(self._series.items(), key=lambda item: str(item[0]))
+            ]
+
+        if not per_infrastructure:
+            return {operation: summary for (operation, inf_id), summary in items if inf_id is None}
+
+        report = {}
+        for (operation, inf_id), summary in items:
+            if inf_id is not None:
+                report.setdefault(inf_id, {})[operation] = summary
+        return report
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "operations": self.summary(),
+                "infrastructures": self.summary(per_infrastructure=True),
+            },
+            indent=2,
+        )
+
+    def to_openmetrics(self):
+        """Export the per-infrastructure series in the OpenMetrics text format."""
+        with self._lock:
+            series = []
+            for (operation, inf_id), values in sorted(
+                self._series.items(), key=lambda item: str(item[0])
+            ):
+                # Operations tied to infrastructures are exported per infrastructure only;
+                # their totals are the sum of those series.
+                if inf_id is None and any(
+                    key[0] == operation and key[1] is not None for key in self._series
+                ):
+                    continue
+                labels = {"operation": operation}
+                if inf_id is not None:
+                    labels["infrastructure"] = inf_id
+                series.append((labels, values.count, values.errors, values.seconds,
+                               values.bytes, list(values.buckets)))
+
+        def label_text(labels, **extra):
+            labels = {**labels, **extra}
+            return ",".join(
+                f'{name}="{escape_label(value)}"' for name, value in labels.items()
+            )
+
+        lines = [
+            "# TYPE apricot_operation_seconds histogram",
+            "# UNIT apricot_operation_seconds seconds",
+            "# HELP apricot_operation_seconds Latency of APRICOT operations.",
+        ]
+        for labels, count, _, seconds, _, buckets in series:
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += bucket
+                lines.append(
+                    f"apricot_operation_seconds_bucket{{{label_text(labels, le=bound)}}} {cumulative}"
+                )
+            lines.append(f"apricot_operation_seconds_count{{{label_text(labels)}}} {count}")
+            lines.append(f"apricot_operation_seconds_sum{{{label_text(labels)}}} {seconds}")
+
+        lines += [
+            "# TYPE apricot_operation_errors counter",
+            "# HELP apricot_operation_errors Failed APRICOT operations.",
+        ]
+        for labels, _, errors, _, _, _ in series:
+            lines.append(f"apricot_operation_errors_total{{{label_text(labels)}}} {errors}")
+
+        lines += [
+            "# TYPE apricot_transferred_bytes counter",
+            "# UNIT apricot_transferred_bytes bytes",
+            "# HELP apricot_transferred_bytes Bytes copied by APRICOT operations.",
+        ]
+        for labels, _, _, _, nbytes, _ in series:
+            if nbytes:
+                lines.append(f"apricot_transferred_bytes_total{{{label_text(labels)}}} {nbytes}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class InstrumentedClient:
+    """
+    Proxy of an `IMClient` recording every call as an `im.<method>` span.
+
+    Calls answering `(False, message)` count as errors. The infrastructure
+    is taken from the first argument of the methods that receive one. The
+    VMs of a `getinfo` are fetched lazily while its result is iterated, so
+    each of them is recorded as an `im.getvminfo` span at that point.
+    """
+
+    INFRASTRUCTURE_METHODS = {
+        "getinfo", "getvminfo", "get_infra_property", "destroy", "addresource",
+        "removeresource", "alter", "reconfigure", "start_infra", "stop_infra",
+        "infra_op", "start_vm", "stop_vm", "reboot_vm", "vm_op", "export_data",
+        "change_auth",
+    }
+
+    def __init__(self, client, stats):
+        self._client = client
+        self._stats = stats
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith("_"):
+            return attribute
+
+        def call(*args, **kwargs):
+            inf_id = args[0] if args and name in self.INFRASTRUCTURE_METHODS else None
+            with self._stats.span(f"im.{name}", inf_id) as span:
+                result = attribute(*args, **kwargs)
+                if isinstance(result, tuple) and result and result[0] is False:
+                    span.error = True
+
+            if name == "getinfo" and not span.error:
+                return result[0], self._record_vms(inf_id, result[1])
+            return result
+
+        return call
+
+    def _record_vms(self, inf_id, items):
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except Exception:
+                self._stats.record("im.getvminfo", time.perf_counter() - start, inf_id, True,
+                                   start=start)
+                raise
+            self._stats.record("im.getvminfo", time.perf_counter() - start, inf_id,
+                               not item[1], start=start)
+            yield item
@@ -0,0 +1,260 @@
+from contextlib import contextmanager
+from pathlib import Path
+
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+STATE_DIR = Path.home() / "apricotlab_state"
+STORE_NAME = "infrastructures.db"
+LEGACY_LIST_NAME = "infrastructuresList.json"
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS infrastructures (
+    position INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    name TEXT,
+    grp TEXT,
+    record TEXT NOT NULL,
+    state TEXT,
+    ip TEXT,
+    created REAL NOT NULL,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS infrastructures_grp ON infrastructures (grp);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Record fields kept in their own columns rather than in the JSON blob.
+COLUMN_FIELDS = {"infrastructureID", "name", "group", "state", "ip", "updated"}
+
+
+class InfrastructureStore:
+    """
+    Infrastructure list and settings kept in a SQLite database.
+
+    The database runs in WAL mode, so the magics and the JupyterLab panel
+    can read while another process writes, and every change is a single
+    transaction instead of a rewrite of the whole list. Records are indexed
+    by infrastructure ID and keep the last known state and IP with the time
+    they were fetched. Fields other than the ID, name and group (e.g. the
+    cloud credentials saved by the panel) are stored as JSON.
+
+    The legacy `infrastructuresList.json` is imported the first time the
+    store is opened; the import is recorded in the settings table so it is
+    never repeated.
+    """
+
+    def __init__(self, path, legacy_path=None, timeout=30):
+        self.path = str(path)
+        self.timeout = timeout
+
+        with self._transaction() as db:
+            # `executescript` would commit the open transaction first.
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    db.execute(statement)
+            db.execute(
+                "INSERT OR IGNORE INTO settings (key, value) VALUES ('schema_version', ?)",
+                (str(SCHEMA_VERSION),),
+            )
+
+        if legacy_path is not None and self.get_setting("legacy_migrated") is None:
+            self.migrate_legacy(legacy_path)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Run a write transaction, taking the write lock up front."""
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+        finally:
+            db.close()
+
+    @contextmanager
+    def _reader(self):
+        db = self._connect()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def _to_record(row):
+        record = {"infrastructureID": row["id"]}
+        for field, column in (("name", "name"), ("group", "grp")):
+            if row[column] is not None:
+                record[field] = row[column]
+        record.update(json.loads(row["record"]))
+        if row["state"] is not None:
+            record["state"] = row["state"]
+            record["ip"] = row["ip"]
+            record["updated"] = row["updated"]
+        return record
+
+    @staticmethod
+    def _insert(db, record):
+        inf_id = record.get("infrastructureID")
+        if not inf_id:
+            raise ValueError(f"Infrastructure record without an ID: {record}")
+
+        extra = {key: value for key, value in record.items() if key not in COLUMN_FIELDS}
+        db.execute(
+            """
+            INSERT INTO infrastructures (id, name, grp, record, created)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                name = excluded.name, grp = excluded.grp, record = excluded.record
+            """,
+            (inf_id, record.get("name"), record.get("group"), json.dumps(extra), time.time()),
+        )
+
+    # Infrastructures
+
+    def list(self, group=None):
+        """Return the infrastructure records in the order they were added."""
+        query = "SELECT * FROM infrastructures"
+        params = ()
+        if group is not None:
+            query += " WHERE grp = ?"
+            params = (group,)
+
+        with self._reader() as db:
+            rows = db.execute(query + " ORDER BY position", params).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def get(self, inf_id):
+        with self._reader() as db:
+            row = db.execute("SELECT * FROM infrastructures WHERE id = ?", (inf_id,)).fetchone()
+        return self._to_record(row) if row is not None else None
+
+    def add(self, *records):
+        """Insert records, or replace the fields of existing ones, in one transaction."""
+        with self._transaction() as db:
+            for record in records:
+                self._insert(db, record)
+
+    def remove(self, *inf_ids):
+        """Delete records by ID and return how many existed."""
+        with self._transaction() as db:
+            return sum(
+                db.execute("DELETE FROM infrastructures WHERE id = ?", (inf_id,)).rowcount
+                for inf_id in inf_ids
+            )
+
+    def update_status(self, statuses):
+        """Store the last known `(state, ip)` of infrastructures, given as a dict by ID."""
+        now = time.time()
+        with self._transaction() as db:
+            db.executemany(
+                "UPDATE infrastructures SET state = ?, ip = ?, updated = ? WHERE id = ?",
+                [(state, ip, now, inf_id) for inf_id, (state, ip) in statuses.items()],
+            )
+
+    # Settings
+
+    def get_setting(self, key, default=None):
+        with self._reader() as db:
+            row = db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row is not None else default
+
+    def set_setting(self, key, value):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO settings (key, value) VALUES (?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (key, value),
+            )
+
+    # Legacy format
+
+    def export(self):
+        """Return the contents in the layout of the legacy JSON file."""
+        return {
+            "refresh_token": self.get_setting("refresh_token", ""),
+            "infrastructures": self.list(),
+        }
+
+    def migrate_legacy(self, legacy_path):
+        """Import a legacy `infrastructuresList.json`, once."""
+        data = {}
+        if os.path.exists(legacy_path):
+            try:
+                with open(legacy_path) as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                raise ValueError(f"Error loading JSON from {legacy_path}: {e}")
+
+        with self._transaction() as db:
+            # Another process may have migrated while this one was waiting.
+            row = db.execute("SELECT 1 FROM settings WHERE key = 'legacy_migrated'").fetchone()
+            if row is not None:
+                return
+
+            for record in data.get("infrastructures", []):
+                if record.get("infrastructureID"):
+                    self._insert(db, record)
+
+            for key in ("refresh_token", "access_token"):
+                if data.get(key):
+                    db.execute(
+                        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                        (key, data[key]),
+                    )
+
+            db.execute(
+                "INSERT INTO settings (key, value) VALUES ('legacy_migrated', ?)",
+                (str(time.time()),),
+            )
+
+
+def copy_legacy_state(state_dir, legacy_dirs):
+    """Copy files missing from `state_dir` out of older, per-directory state folders."""
+    for legacy_dir in legacy_dirs:
+        if legacy_dir.exists() and legacy_dir.resolve() != state_dir.resolve():
+            for legacy_file in legacy_dir.iterdir():
+                target = state_dir / legacy_file.name
+                if legacy_file.is_file() and not target.exists():
+                    shutil.copy2(legacy_file, target)
+
+
+def open_store(state_dir=STATE_DIR, legacy_dirs=None):
+    """
+    Open the store of a state directory.
+
+    The first time, state left by older versions is migrated: files from
+    `apricotlab_state` folders next to the working directory (or in
+    `legacy_dirs`) are copied over and the JSON list is imported. The
+    migration is recorded in the store and never scanned for again.
+    """
+    state_dir = Path(state_dir)
+    state_dir.mkdir(exist_ok=True)
+    store = InfrastructureStore(state_dir / STORE_NAME)
+
+    if store.get_setting("legacy_migrated") is None:
+        if legacy_dirs is None:
+            legacy_dirs = (Path.cwd() / state_dir.name, Path.cwd().parent / state_dir.name)
+        copy_legacy_state(state_dir, legacy_dirs)
+        store.migrate_legacy(state_dir / LEGACY_LIST_NAME)
+
+    return store
@@ -0,0 +1,320 @@
+from concurrent.futures import Future, wait as wait_futures
+
+import contextvars
+import os
+import tempfile
+import threading
+import time
+
+from .session import get_im_token, get_token_expiry
+from .stats import span
+
+TOKEN_ENDPOINT = os.environ.get(
+    "APRICOT_TOKEN_ENDPOINT",
+    "https://aai.egi.eu/auth/realms/egi/protocol/openid-connect/token",
+)
+TOKEN_CLIENT_ID = "token-portal"
+TOKEN_SCOPE = "openid email profile voperson_id eduperson_entitlement"
+
+# Refresh this many seconds before the access token expires.
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REQUEST_TIMEOUT = 10
+# Delay before retrying a failed background refresh, doubled on every
+# consecutive failure up to the maximum.
+TOKEN_RETRY_INTERVAL = 30
+TOKEN_RETRY_MAX_INTERVAL = 600
+
+
+class TokenRefreshError(RuntimeError):
+    """
+    A failed token refresh. `permanent` errors (a rejected or missing
+    refresh token) are not retried until a new refresh token is given.
+    """
+
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+def replace_authfile_token(content, access_token):
+    """Return authfile content with the `token` of every entry that has one replaced."""
+    updated_lines = []
+    for line in content.splitlines(keepends=True):
+        if "token =" in line:
+            parts = [part.strip() for part in line.split(";")]
+            updated_parts = [
+                f"token = {access_token}" if part.startswith("token =") else part
+                for part in parts
+            ]
+            line = "; ".join(updated_parts) + "\n"
+        updated_lines.append(line)
+    return "".join(updated_lines)
+
+
+class TokenManager:
+    """
+    Keep the IM access token of an authfile fresh.
+
+    The token and its `exp` claim are kept in memory and only read again
+    when the authfile changes. A daemon timer refreshes the token
+    `margin` seconds before it expires, so callers normally never wait.
+    Concurrent refreshes share a single in-flight request, made over a
+    pooled HTTP session with a timeout, and the authfile is rewritten
+    atomically once per refresh. Refreshes are recorded in `stats` if given.
+
+    A transient failure is retried in the background with capped
+    exponential backoff; a permanent one stops the background refresh and
+    is kept in `error` until a refresh succeeds.
+    """
+
+    def __init__(self, authfile_path, get_refresh_token, token_url=TOKEN_ENDPOINT,
+                 margin=TOKEN_REFRESH_MARGIN, timeout=TOKEN_REQUEST_TIMEOUT, stats=None):
+        self.authfile_path = str(authfile_path)
+        self.get_refresh_token = get_refresh_token
+        self.token_url = token_url
+        self.margin = margin
+        self.timeout = timeout
+        self.stats = stats
+
+        self.access_token = None
+        self.expiry = None
+        self.error = None
+        self._error_reported = True
+        self._failures = 0
+        self._mtime = None
+        self._inflight = None
+        self._inflight_token = None
+        self._timer = None
+        self._http = None
+        self._lock = threading.Lock()
+
+    @property
+    def http(self):
+        """Pooled HTTP session, created on the first refresh."""
+        if self._http is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            http = requests.Session()
+            http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            self._http = http
+        return self._http
+
+    # Token state
+
+    def _load(self):
+        """Re-read the token from the authfile if it changed on disk."""
+        from imclient import IMClient
+
+        try:
+            mtime = os.stat(self.authfile_path).st_mtime_ns
+        except FileNotFoundError:
+            self.access_token, self.expiry, self._mtime = None, None, None
+            return
+
+        if mtime == self._mtime:
+            return
+
+        self._mtime = mtime
+        try:
+            self.access_token = get_im_token(IMClient.read_auth_data(self.authfile_path))
+        except Exception:
+            self.access_token = None
+        self.expiry = get_token_expiry(self.access_token)
+
+    def seconds_left(self):
+        """Seconds until the current token expires, or None if it has no expiry."""
+        with self._lock:
+            self._load()
+            expiry = self.expiry
+        return None if expiry is None else expiry - time.time()
+
+    # Refreshing
+
+    def refresh(self, refresh_token=None, wait=True):
+        """
+        Exchange a refresh token for a new access token.
+
+        If a refresh with the same refresh token is already running the
+        call joins it instead of starting another. A different one is
+        exchanged once the running refresh ends, so the authfile ends up
+        with its token. With `wait` the new token is returned (or
+        `TokenRefreshError` raised); otherwise the pending future is.
+        """
+        if refresh_token is None:
+            refresh_token = self.get_refresh_token()
+
+        with self._lock:
+            previous = future = self._inflight
+            if future is None or refresh_token != self._inflight_token:
+                future = self._inflight = Future()
+                self._inflight_token = refresh_token
+                # Run in the caller's context so a traced command sees the refresh.
+                threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self._run_refresh, future, refresh_token, previous),
+                    name="apricot-token-refresh",
+                    daemon=True,
+                ).start()
+
+        if not wait:
+            return future
+        return future.result()
+
+    def _run_refresh(self, future, refresh_token, previous=None):
+        if previous is not None:
+            wait_futures([previous])
+
+        try:
+            with span(self.stats, "token.refresh"):
+                access_token = self._request_token(refresh_token)
+                self._save(access_token)
+        except BaseException as e:
+            permanent = isinstance(e, TokenRefreshError) and e.permanent
+            with self._lock:
+                self._clear_inflight(future)
+                self._failures += 1
+                failures = self._failures
+                if permanent:
+                    self.error, self._error_reported = e, False
+            future.set_exception(e)
+            if not permanent:
+                self.schedule(
+                    min(TOKEN_RETRY_INTERVAL * 2 ** (failures - 1), TOKEN_RETRY_MAX_INTERVAL)
+                )
+            return
+
+        with self._lock:
+            self._clear_inflight(future)
+            self._failures = 0
+            self.error = None
+        future.set_result(access_token)
+        self.schedule()
+
+    def _clear_inflight(self, future):
+        # Leave a refresh chained after this one in place.
+        if self._inflight is future:
+            self._inflight = self._inflight_token = None
+
+    def _request_token(self, refresh_token):
+        import requests
+
+        if not refresh_token:
+            raise TokenRefreshError(
+                "No refresh token available. Run `%apricot_token <refresh_token>` first.",
+                permanent=True,
+            )
+
+        try:
+            response = self.http.post(
+                self.token_url,
+                data={
+                    "grant_type": "refresh_token",
+                    "refresh_token": refresh_token,
+                    "client_id": TOKEN_CLIENT_ID,
+                    "scope": TOKEN_SCOPE,
+                },
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            raise TokenRefreshError(f"Error generating access token: {e}") from e
+
+        if response.status_code != 200:
+            # Client errors other than timeouts and rate limits mean the refresh token was
+            # rejected: asking again with it cannot succeed.
+            status = response.status_code
+            raise TokenRefreshError(
+                f"Error generating access token:\n{response.text}",
+                permanent=400 <= status < 500 and status not in (408, 429),
+            )
+
+        access_token = response.json().get("access_token")
+        if not access_token:
+            raise TokenRefreshError("Failed to generate a new access token.")
+        return access_token
+
+    def _save(self, access_token):
+        """Write the new token to the authfile atomically."""
+        with self._lock:
+            with open(self.authfile_path) as f:
+                content = replace_authfile_token(f.read(), access_token)
+
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.authfile_path), suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+                os.chmod(tmp_path, 0o600)
+                os.replace(tmp_path, self.authfile_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+            self._mtime = None
+            self._load()
+
+    # Background scheduling
+
+    def schedule(self, delay=None):
+        """
+        Arm the background refresh.
+
+        By default it fires `margin` seconds before the current token
+        expires (right away if that is already past). Nothing is scheduled
+        for tokens without an expiry or when there is no refresh token.
+        """
+        if delay is None:
+            seconds_left = self.seconds_left()
+            if seconds_left is None:
+                return
+            delay = max(0.0, seconds_left - self.margin)
+
+        if not self.get_refresh_token():
+            return
+
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _background_refresh(self):
+        self.refresh(wait=False)
+
+    def pop_error(self):
+        """Return the error that stopped the background refresh the first time it is asked for."""
+        with self._lock:
+            if self._error_reported:
+                return None
+            self._error_reported = True
+            return self.error
+
+    def ensure_fresh(self, timeout=None):
+        """
+        Make sure an unexpired token is in the authfile.
+
+        Returns immediately while the token is valid, starting a background
+        refresh if it is inside the margin (unless the last one failed for
+        good); only an already expired token makes the caller wait for the
+        (shared) refresh.
+        """
+        seconds_left = self.seconds_left()
+        if seconds_left is None or seconds_left > self.margin:
+            return self.access_token
+
+        if seconds_left > 0:
+            if self.error is None:
+                self.refresh(wait=False)
+            return self.access_token
+        return self.refresh(wait=False).result(timeout)
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if self._http is not None:
+            self._http.close()
@@ -0,0 +1,683 @@
+from subprocess import run, Popen, PIPE, DEVNULL
+from collections import namedtuple
+from shutil import which
+
+import hashlib
+import os
+import posixpath
+import shlex
+import tempfile
+import threading
+import time
+
+from .concurrency import fan_out
+from .stats import span
+
+CHUNK_SIZE = 16 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_STREAMS = 4
+
+TRANSFER_MODES = ("auto", "archive", "files")
+# At least this many files averaging less than SMALL_FILE_SIZE are copied
+# faster as one streamed archive than one by one.
+ARCHIVE_MIN_FILES = 32
+SMALL_FILE_SIZE = 1024 * 1024
+# Tar header and padding per file, on average.
+TAR_HEADER_SIZE = 1024
+ARCHIVE_FAILED = "apricot: tar failed"
+
+# Stream compressors by preference, as `(name, compress, decompress)`
+# commands. The last one stands for an uncompressed archive.
+COMPRESSORS = [
+    ("zstd", ["zstd", "-1", "-T0", "-q", "-c"], ["zstd", "-d", "-q", "-c"]),
+    ("gzip", ["gzip", "-1", "-c"], ["gzip", "-d", "-c"]),
+    ("none", None, None),
+]
+
+# A file to copy between `local` and `remote` over `connection`, as a list
+# of chunk indices still to be sent. `remote_size` is the size of the remote
+# copy before the transfer (-1 if it does not exist).
+FilePlan = namedtuple(
+    "FilePlan", ["connection", "local", "remote", "size", "remote_size", "chunks"]
+)
+
+# Paths copied between the `connection` side and `destination` as one tar
+# stream. With `contents_only`, the single source directory is unpacked as
+# `destination` itself instead of inside it. `files` and `size` are the
+# totals of the sources, used to estimate progress.
+ArchivePlan = namedtuple(
+    "ArchivePlan", ["connection", "sources", "destination", "contents_only", "files", "size"]
+)
+
+
+def quote_remote_path(path):
+    """Quote a remote path for the shell, keeping `~/` relative to the home directory."""
+    if path == "~":
+        return "."
+    if path.startswith("~/"):
+        path = path[2:] or "."
+    return shlex.quote(path)
+
+
+def remote_directory(path):
+    """Quote a remote directory for a `tar -C` that may follow another one."""
+    if path.startswith("/"):
+        return shlex.quote(path)
+    # GNU tar resolves a relative -C against the previous one.
+    return '"$base"/' + quote_remote_path(path)
+
+
+def chunk_count(size, chunk_size=CHUNK_SIZE):
+    return max(1, -(-size // chunk_size))
+
+
+def local_chunk_hash(path, index, chunk_size=CHUNK_SIZE):
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        f.seek(index * chunk_size)
+        remaining = chunk_size
+        while remaining > 0:
+            block = f.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+    return digest.hexdigest()
+
+
+def inspect_remote(connection, paths, chunk_size=CHUNK_SIZE):
+    """
+    Describe remote paths with a single ssh call.
+
+    Returns `{path: (kind, size, chunk_hashes)}` where kind is "file",
+    "dir" or None when the path does not exist.
+    """
+    blocks = chunk_size // BLOCK_SIZE
+    script = f"""
+for f in {" ".join(quote_remote_path(path) for path in paths)}; do
+  if [ -d "$f" ]; then
+    echo D
+  elif [ -f "$f" ]; then
+    size=$(wc -c < "$f")
+    echo "F $size"
+    i=0
+    while [ $((i * {chunk_size})) -lt "$size" ]; do
+      dd if="$f" bs={BLOCK_SIZE} skip=$((i * {blocks})) count={blocks} 2>/dev/null | md5sum | cut -d' ' -f1
+      i=$((i + 1))
+    done
+  else
+    echo N
+  fi
+  echo E
+done
+"""
+    result = run(
+        connection.ssh_command([script]), stdin=DEVNULL, stdout=PIPE, stderr=PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f"ssh exited with {result.returncode}")
+
+    info = {}
+    lines = iter(result.stdout.splitlines())
+    for path in paths:
+        header = next(lines, "N")
+        kind, size, hashes = None, -1, []
+        if header == "D":
+            kind = "dir"
+        elif header.startswith("F "):
+            kind, size = "file", int(header[2:])
+        for line in lines:
+            if line == "E":
+                break
+            hashes.append(line)
+        info[path] = (kind, size, hashes)
+
+    return info
+
+
+def measure_local(path):
+    """Return `(files, size)` of a local file or directory tree."""
+    if not os.path.isdir(path):
+        return 1, os.path.getsize(path)
+
+    files = size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                continue
+            files += 1
+    return files, size
+
+
+def measure_remote(connection, paths):
+    """Return `{path: (files, size)}` of remote directories with a single ssh call."""
+    script = f"""
+for f in {" ".join(quote_remote_path(path) for path in paths)}; do
+  echo "$(find "$f" -type f | wc -l) $(du -sk "$f" | cut -f1)"
+done
+"""
+    result = run(
+        connection.ssh_command([script]), stdin=DEVNULL, stdout=PIPE, stderr=PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip() or f"ssh exited with {result.returncode}")
+
+    sizes = {}
+    for path, line in zip(paths, result.stdout.splitlines()):
+        files, kilobytes = line.split()
+        sizes[path] = (int(files), int(kilobytes) * 1024)
+    return sizes
+
+
+def prefer_archive(files, size):
+    """Whether `files` files of `size` bytes in total copy faster as one archive."""
+    return files >= ARCHIVE_MIN_FILES and size < files * SMALL_FILE_SIZE
+
+
+def choose_compressor(connection):
+    """Return the first entry of `COMPRESSORS` available on both ends."""
+    names = " ".join(name for name, compress, _ in COMPRESSORS if compress)
+    result = run(
+        connection.ssh_command(
+            [f"for c in {names}; do command -v $c >/dev/null 2>&1 && echo $c; done"]
+        ),
+        stdin=DEVNULL, stdout=PIPE, stderr=PIPE, text=True,
+    )
+    remote = set(result.stdout.split()) if result.returncode == 0 else set()
+    for compressor in COMPRESSORS:
+        name, compress, _ = compressor
+        if compress is None or (name in remote and which(compress[0])):
+            return compressor
+
+
+def start_pipeline(commands, stdin, stdout):
+    """
+    Start `commands` with each one's output piped into the next.
+
+    Returns `(process, stderr_file)` pairs; error output goes to temporary
+    files so that a chatty command can never block on a full pipe.
+    """
+    pipeline = []
+    for position, command in enumerate(commands):
+        stderr = tempfile.TemporaryFile()
+        process = Popen(
+            command,
+            stdin=pipeline[-1][0].stdout if pipeline else stdin,
+            stdout=stdout if position == len(commands) - 1 else PIPE,
+            stderr=stderr,
+        )
+        if pipeline:
+            pipeline[-1][0].stdout.close()
+        pipeline.append((process, stderr))
+    return pipeline
+
+
+def finish_pipeline(pipeline):
+    """Wait for a pipeline and return the error output of its failed commands."""
+    errors = []
+    for process, stderr in pipeline:
+        code = process.wait()
+        stderr.seek(0)
+        output = stderr.read().decode(errors="replace").strip()
+        stderr.close()
+        if code != 0 or ARCHIVE_FAILED in output:
+            errors.append(output or f"{process.args[0]} exited with {code}")
+    return errors
+
+
+def pending_chunks(local_path, size, remote_size, remote_hashes, chunk_size=CHUNK_SIZE):
+    """Return the chunk indices whose remote copy is missing or differs."""
+    chunks = []
+    for index in range(chunk_count(size, chunk_size) if size else 0):
+        chunk_end = min((index + 1) * chunk_size, size)
+        if (
+            index < len(remote_hashes)
+            and chunk_end <= remote_size
+            and remote_hashes[index] == local_chunk_hash(local_path, index, chunk_size)
+        ):
+            continue
+        chunks.append(index)
+    return chunks
+
+
+class Progress:
+    """Thread-safe byte counter printed as a single updating line."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.done += count
+
+    def rate(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return self.done / elapsed
+
+    def report(self):
+        percent = 100 * self.done / self.total if self.total else 100
+        print(
+            f"\r{self.done / 1e6:.1f}/{self.total / 1e6:.1f} MB ({percent:.0f}%)"
+            f" {self.rate() / 1e6:.1f} MB/s",
+            end="",
+            flush=True,
+        )
+
+
+class TransferEngine:
+    """
+    Copy files over multiplexed SSH connections in parallel chunks.
+
+    Every file is split into `chunk_size` chunks that are copied as
+    independent streams (at most `max_streams` at a time across all files
+    and VMs) with `dd` at the remote side. Before copying, chunk hashes of
+    both copies are compared so that unchanged files are skipped and
+    interrupted transfers resume with the chunks that are still missing.
+    Inspections and chunk copies are recorded in `stats` if given.
+
+    Directories and sets of many small files are instead streamed as a
+    single tar archive, compressed with zstd or gzip when both ends have
+    it, and unpacked as it arrives. `mode` picks between both ways:
+    "files" copies file by file (directories with `scp -r`), "archive"
+    packs everything that can be packed, and "auto" packs what
+    `prefer_archive` considers worth it.
+    """
+
+    def __init__(self, max_streams=DEFAULT_STREAMS, chunk_size=CHUNK_SIZE, stats=None,
+                 mode="auto"):
+        if mode not in TRANSFER_MODES:
+            raise ValueError(f"Unknown transfer mode '{mode}'")
+        self.max_streams = max_streams
+        self.chunk_size = chunk_size
+        self.stats = stats
+        self.mode = mode
+
+    def inspect(self, connection, paths):
+        with span(self.stats, "transfer.inspect", connection.inf_id):
+            return inspect_remote(connection, paths, self.chunk_size)
+
+    # Planning
+
+    def select_archived(self, sizes, directories, destination_is_dir):
+        """
+        Return the sources to pack into an archive.
+
+        `sizes` maps every source to its `(files, size)`. Directories are
+        packed on their own merits, plain files only as a group. Without a
+        destination directory only a single directory can be packed.
+        """
+        if self.mode == "files":
+            return []
+
+        plain = [source for source in sizes if source not in directories]
+        if not destination_is_dir:
+            plain = []
+
+        if self.mode == "archive":
+            return list(directories) + plain
+
+        archived = [directory for directory in directories if prefer_archive(*sizes[directory])]
+        if prefer_archive(len(plain), sum(sizes[source][1] for source in plain)):
+            archived += plain
+        return archived
+
+    def plan_archive(self, connection, sizes, archived, destination, destination_is_dir):
+        if not archived:
+            return None
+        return ArchivePlan(
+            connection,
+            archived,
+            destination,
+            len(archived) == 1 and not destination_is_dir,
+            sum(sizes[source][0] for source in archived),
+            sum(sizes[source][1] for source in archived),
+        )
+
+    def plan_upload(self, connection, files, destination):
+        """
+        Plan an upload as `(file_plans, directories, archive)`.
+
+        Directories left out of the archive are to be copied with `scp -r`;
+        `archive` is an `ArchivePlan` or None.
+        """
+        candidates = [destination] + [
+            posixpath.join(destination, os.path.basename(os.path.normpath(f))) for f in files
+        ]
+        info = self.inspect(connection, candidates)
+        destination_is_dir = info[destination][0] == "dir" or len(files) > 1
+
+        if destination_is_dir and info[destination][0] is None:
+            result = run(
+                connection.ssh_command([f"mkdir -p {quote_remote_path(destination)}"]),
+                stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, text=True,
+            )
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr.strip())
+
+        local_directories = [f for f in files if os.path.isdir(f)]
+        sizes = {} if self.mode == "files" else {f: measure_local(f) for f in files}
+        archived = self.select_archived(sizes, local_directories, destination_is_dir)
+        archive = self.plan_archive(connection, sizes, archived, destination, destination_is_dir)
+
+        plans, directories = [], []
+        for f in files:
+            if f in archived:
+                continue
+            if os.path.isdir(f):
+                directories.append(f)
+                continue
+
+            remote = (
+                posixpath.join(destination, os.path.basename(os.path.normpath(f)))
+                if destination_is_dir
+                else destination
+            )
+            kind, remote_size, hashes = info.get(remote, (None, -1, []))
+            size = os.path.getsize(f)
+            plans.append(
+                FilePlan(
+                    connection, f, remote, size, remote_size,
+                    pending_chunks(f, size, remote_size, hashes, self.chunk_size),
+                )
+            )
+
+        return plans, directories, archive
+
+    def plan_download(self, connection, files, destination):
+        """Plan a download as `(file_plans, directories, archive)`, like `plan_upload`."""
+        info = self.inspect(connection, files)
+        destination_is_dir = os.path.isdir(destination) or len(files) > 1
+
+        for f in files:
+            if info[f][0] is None:
+                raise FileNotFoundError(f"{connection.host}:{f} does not exist")
+
+        remote_directories = [f for f in files if info[f][0] == "dir"]
+        sizes = {f: (1, info[f][1]) for f in files}
+        if self.mode != "files" and remote_directories:
+            sizes.update(measure_remote(connection, remote_directories))
+        archived = self.select_archived(sizes, remote_directories, destination_is_dir)
+        archive = self.plan_archive(connection, sizes, archived, destination, destination_is_dir)
+
+        plans, directories = [], []
+        for f in files:
+            kind, size, hashes = info[f]
+            if f in archived:
+                continue
+            if kind == "dir":
+                directories.append(f)
+                continue
+
+            local = (
+                os.path.join(destination, posixpath.basename(posixpath.normpath(f)))
+                if destination_is_dir
+                else destination
+            )
+            local_size = os.path.getsize(local) if os.path.isfile(local) else -1
+            chunks = []
+            for index in range(chunk_count(size, self.chunk_size) if size else 0):
+                chunk_end = min((index + 1) * self.chunk_size, size)
+                if (
+                    chunk_end <= local_size
+                    and local_chunk_hash(local, index, self.chunk_size) == hashes[index]
+                ):
+                    continue
+                chunks.append(index)
+            plans.append(FilePlan(connection, local, f, size, local_size, chunks))
+
+        return plans, directories, archive
+
+    # Chunk copies
+
+    def _upload_chunk(self, plan, index, progress):
+        offset = index * self.chunk_size
+        length = min(self.chunk_size, plan.size - offset)
+        remote = quote_remote_path(plan.remote)
+        command = plan.connection.ssh_command(
+            [f"dd of={remote} bs={BLOCK_SIZE} seek={offset // BLOCK_SIZE} conv=notrunc 2>/dev/null"]
+        )
+
+        process = Popen(command, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+        try:
+            with open(plan.local, "rb") as f:
+                f.seek(offset)
+                remaining = length
+                while remaining > 0:
+                    block = f.read(min(BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    process.stdin.write(block)
+                    remaining -= len(block)
+                    progress.add(len(block))
+        finally:
+            process.stdin.close()
+
+        stderr = process.stderr.read().decode(errors="replace")
+        process.stderr.close()
+        if process.wait() != 0:
+            raise RuntimeError(stderr.strip() or f"upload of {plan.local} failed")
+
+        return length
+
+    def _download_chunk(self, plan, index, progress):
+        offset = index * self.chunk_size
+        blocks = self.chunk_size // BLOCK_SIZE
+        remote = quote_remote_path(plan.remote)
+        command = plan.connection.ssh_command(
+            [f"dd if={remote} bs={BLOCK_SIZE} skip={offset // BLOCK_SIZE} count={blocks} 2>/dev/null"]
+        )
+
+        written = 0
+        process = Popen(command, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+        with open(plan.local, "r+b") as f:
+            f.seek(offset)
+            while True:
+                block = process.stdout.read(BLOCK_SIZE)
+                if not block:
+                    break
+                f.write(block)
+                written += len(block)
+                progress.add(len(block))
+
+        stderr = process.stderr.read().decode(errors="replace")
+        process.stdout.close()
+        process.stderr.close()
+        if process.wait() != 0:
+            raise RuntimeError(stderr.strip() or f"download of {plan.remote} failed")
+
+        return written
+
+    # Archive streams
+
+    def _archive_commands(self, archive, transfer_type, compressor):
+        """Return the producer and consumer pipelines of an archive stream."""
+        _, compress, decompress = compressor
+        connection = archive.connection
+
+        if transfer_type == "upload":
+            members = []
+            for source in archive.sources:
+                path = os.path.abspath(source)
+                if archive.contents_only:
+                    members += ["-C", path, "."]
+                else:
+                    members += ["-C", os.path.dirname(path), "./" + os.path.basename(path)]
+
+            destination = quote_remote_path(archive.destination)
+            unpack = f"mkdir -p {destination} && "
+            if decompress:
+                unpack += f"{shlex.join(decompress)} | "
+            unpack += f"tar -C {destination} -xf -"
+
+            producer = [["tar", "-cf", "-"] + members]
+            consumer = ([compress] if compress else []) + [connection.ssh_command([unpack])]
+            return producer, consumer
+
+        members = []
+        for source in archive.sources:
+            path = posixpath.normpath(source)
+            if archive.contents_only:
+                members += ["-C", remote_directory(path), "."]
+            else:
+                members += [
+                    "-C",
+                    remote_directory(posixpath.dirname(path) or "."),
+                    shlex.quote("./" + posixpath.basename(path)),
+                ]
+
+        pack = f'base=$(pwd) && {{ tar -cf - {" ".join(members)} || echo "{ARCHIVE_FAILED}" >&2; }}'
+        if compress:
+            pack += f" | {shlex.join(compress)}"
+
+        producer = [connection.ssh_command([pack])] + ([decompress] if decompress else [])
+        consumer = [["tar", "-C", archive.destination, "-xf", "-"]]
+        return producer, consumer
+
+    def _stream_archive(self, archive, transfer_type, progress):
+        """Pipe the tar stream of an archive from its producer to its consumer."""
+        compressor = choose_compressor(archive.connection)
+        if which("tar") is None:
+            raise RuntimeError("tar is not installed")
+        if transfer_type == "download":
+            os.makedirs(archive.destination, exist_ok=True)
+
+        producer_commands, consumer_commands = self._archive_commands(
+            archive, transfer_type, compressor
+        )
+        consumer = start_pipeline(consumer_commands, PIPE, DEVNULL)
+        producer = start_pipeline(producer_commands, DEVNULL, PIPE)
+
+        # The uncompressed stream goes through this process to count it.
+        copied = 0
+        source, sink = producer[-1][0].stdout, consumer[0][0].stdin
+        try:
+            while True:
+                block = source.read(BLOCK_SIZE)
+                if not block:
+                    break
+                sink.write(block)
+                copied += len(block)
+                progress.add(len(block))
+        except BrokenPipeError:
+            pass
+        finally:
+            source.close()
+            try:
+                sink.close()
+            except BrokenPipeError:
+                pass
+
+        errors = finish_pipeline(producer) + finish_pipeline(consumer)
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        return copied, compressor[0]
+
+    def transfer_archives(self, archives, transfer_type):
+        """
+        Stream every archive, one per connection, in parallel.
+
+        Returns `(progress, compressors, errors)`, where compressors lists
+        the compression used by each archive that was copied.
+        """
+        progress = Progress(
+            sum(archive.size + TAR_HEADER_SIZE * archive.files for archive in archives)
+        )
+
+        def stream(archive):
+            with span(self.stats, "transfer.archive", archive.connection.inf_id) as archive_span:
+                archive_span.nbytes, compressor = self._stream_archive(
+                    archive, transfer_type, progress
+                )
+            return compressor
+
+        results = fan_out(
+            stream,
+            archives,
+            max_workers=self.max_streams,
+            progress=progress.report if archives else None,
+        )
+        if archives:
+            # Sizes were estimates; a finished stream is complete.
+            if all(error is None for _, _, error in results):
+                progress.total = progress.done
+            progress.report()
+            print()
+
+        compressors = [result for _, result, error in results if error is None]
+        errors = [
+            (archive.connection.host, error) for archive, _, error in results if error is not None
+        ]
+        return progress, compressors, errors
+
+    # Public API
+
+    def transfer(self, plans, transfer_type):
+        """
+        Copy the pending chunks of every plan and fix up file sizes.
+
+        Returns `(progress, errors)` where errors is a list of `(path, error)`.
+        """
+        tasks = [(plan, index) for plan in plans for index in plan.chunks]
+        total = sum(
+            min(self.chunk_size, plan.size - index * self.chunk_size) for plan, index in tasks
+        )
+        progress = Progress(total)
+
+        if transfer_type == "download":
+            for plan in plans:
+                os.makedirs(os.path.dirname(os.path.abspath(plan.local)), exist_ok=True)
+                with open(plan.local, "ab"):
+                    pass
+                os.truncate(plan.local, plan.size)
+            copy_chunk = self._download_chunk
+        else:
+            copy_chunk = self._upload_chunk
+
+        def copy(task):
+            plan, index = task
+            with span(self.stats, f"transfer.{transfer_type}", plan.connection.inf_id) as chunk:
+                chunk.nbytes = copy_chunk(plan, index, progress)
+            return chunk.nbytes
+
+        results = fan_out(
+            copy,
+            tasks,
+            max_workers=self.max_streams,
+            progress=progress.report if tasks else None,
+        )
+        if tasks:
+            progress.report()
+            print()
+
+        errors = [(task[0].local, error) for task, _, error in results if error is not None]
+
+        if transfer_type == "upload":
+            errors += self._finish_uploads(plans)
+
+        return progress, errors
+
+    def _finish_uploads(self, plans):
+        """Create empty files and truncate remote copies that were longer than the source."""
+        errors = []
+        by_connection = {}
+        for plan in plans:
+            if plan.remote_size != plan.size:
+                by_connection.setdefault(plan.connection, []).append(plan)
+
+        for connection, connection_plans in by_connection.items():
+            script = "\n".join(
+                f"truncate -s {plan.size} {quote_remote_path(plan.remote)}"
+                for plan in connection_plans
+            )
+            result = run(
+                connection.ssh_command([script]), stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, text=True
+            )
+            if result.returncode != 0:
+                errors.append((connection.host, RuntimeError(result.stderr.strip())))
+
+        return errors
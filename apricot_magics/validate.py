@@ -0,0 +1,371 @@
+from collections import OrderedDict, namedtuple
+from pathlib import Path
+
+import hashlib
+import json
+import re
+import threading
+
+from .radl import RADLSyntaxError, parse_radl
+from .stats import span
+
+# Shipped next to the packages, both in the source tree and in the wheel.
+TEMPLATES_DIR = Path(__file__).parent.parent / "resources" / "deployable_templates"
+VALIDATION_CACHE_SIZE = 256
+
+TOSCA_VERSIONS = {
+    "tosca_simple_yaml_1_0", "tosca_simple_yaml_1_1", "tosca_simple_yaml_1_2",
+    "tosca_simple_yaml_1_3",
+}
+# Names TOSCA functions accept in place of a node template.
+TOSCA_KEYWORDS = {"SELF", "SOURCE", "TARGET", "HOST"}
+TOSCA_FUNCTIONS = {"get_input", "get_attribute", "get_property"}
+SCALAR_SIZE = re.compile(r"\d+(\.\d+)?\s*(B|kB|KB|KiB|MB|MiB|GB|GiB|TB|TiB)", re.IGNORECASE)
+
+JSON_CLASSES = {
+    "network", "system", "configure", "contextualize", "deploy", "description", "ansible"
+}
+
+Validation = namedtuple("Validation", ["desc_type", "errors", "warnings"])
+
+
+class RecipeValidationError(ValueError):
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("Invalid recipe:\n" + "\n".join(f"  - {error}" for error in errors))
+
+
+def load_yaml(text):
+    """`yaml.safe_load`, with the libyaml parser when PyYAML was built with it."""
+    import yaml
+
+    return yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def load_templates(directory=TEMPLATES_DIR):
+    """Return the inputs of the bundled TOSCA templates as `{template_name: inputs}`."""
+    import yaml
+
+    templates = {}
+    for path in sorted(Path(directory).glob("*.y*ml")):
+        try:
+            data = load_yaml(path.read_text())
+        except (OSError, yaml.YAMLError):
+            continue
+        if not isinstance(data, dict):
+            continue
+        name = (data.get("metadata") or {}).get("template_name")
+        inputs = (data.get("topology_template") or {}).get("inputs")
+        if name and isinstance(inputs, dict):
+            templates[name] = inputs
+    return templates
+
+
+def same_value(a, b):
+    """Compare input values as TOSCA does, ignoring spaces in sizes like `4 GB`."""
+    if a == b:
+        return True
+    return re.sub(r"\s+", "", str(a)).lower() == re.sub(r"\s+", "", str(b)).lower()
+
+
+def check_type(name, input_type, value):
+    """Return an error if `value` cannot be an input of `input_type`, or None."""
+    if input_type == "integer":
+        valid = (isinstance(value, int) and not isinstance(value, bool)) or (
+            isinstance(value, str) and value.strip().lstrip("-").isdigit()
+        )
+    elif input_type == "float":
+        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif input_type == "boolean":
+        valid = isinstance(value, bool)
+    elif input_type == "scalar-unit.size":
+        valid = isinstance(value, str) and SCALAR_SIZE.fullmatch(value.strip()) is not None
+    elif input_type == "map":
+        valid = isinstance(value, dict)
+    elif input_type == "list":
+        valid = isinstance(value, list)
+    else:
+        return None
+
+    if valid:
+        return None
+    return f"Input '{name}' must be of type {input_type}, got {value!r}"
+
+
+def check_constraints(name, constraints, value):
+    errors = []
+    for constraint in constraints or []:
+        if not isinstance(constraint, dict):
+            continue
+        for kind, bound in constraint.items():
+            if kind == "valid_values" and isinstance(bound, list):
+                if not any(same_value(value, allowed) for allowed in bound):
+                    choices = ", ".join(str(allowed) for allowed in bound)
+                    errors.append(f"Input '{name}' is {value!r}; valid values are: {choices}")
+            elif kind in ("greater_or_equal", "less_or_equal", "in_range"):
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                low, high = {
+                    "greater_or_equal": (bound, None),
+                    "less_or_equal": (None, bound),
+                    "in_range": tuple(bound) if isinstance(bound, list) and len(bound) == 2
+                    else (None, None),
+                }[kind]
+                if (low is not None and value < low) or (high is not None and value > high):
+                    errors.append(f"Input '{name}' is {value!r}, outside its {kind} {bound}")
+    return errors
+
+
+def check_input(name, definition, reference=None):
+    """
+    Check the value of a TOSCA input against its own definition and, when
+    the recipe comes from a bundled template, against the template's.
+    """
+    errors, warnings = [], []
+    reference = reference if isinstance(reference, dict) else {}
+    input_type = definition.get("type") or reference.get("type")
+
+    if reference.get("type") and definition.get("type") not in (None, reference["type"]):
+        errors.append(
+            f"Input '{name}' is declared as {definition['type']}, but its template expects"
+            f" {reference['type']}"
+        )
+
+    if "default" not in definition or definition["default"] is None:
+        return errors, warnings
+
+    value = definition["default"]
+    error = check_type(name, input_type, value)
+    if error is not None:
+        errors.append(error)
+    elif input_type == "string" and not isinstance(value, str):
+        warnings.append(f"Input '{name}' is a string but its value {value!r} is not quoted")
+
+    errors.extend(check_constraints(name, definition.get("constraints"), value))
+    if "constraints" not in definition:
+        errors.extend(check_constraints(name, reference.get("constraints"), value))
+    return errors, warnings
+
+
+def tosca_functions(value, path):
+    """Yield `(path, function, arguments)` for every TOSCA function call in a value."""
+    if isinstance(value, dict):
+        if len(value) == 1:
+            function, arguments = next(iter(value.items()))
+            if function in TOSCA_FUNCTIONS:
+                yield path, function, arguments
+                return
+        for key, item in value.items():
+            yield from tosca_functions(item, f"{path}.{key}")
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            yield from tosca_functions(item, f"{path}[{index}]")
+
+
+def check_tosca(text, templates):
+    import yaml
+
+    errors, warnings = [], []
+    try:
+        data = load_yaml(text)
+    except yaml.YAMLError as e:
+        mark = getattr(e, "problem_mark", None)
+        where = f" at line {mark.line + 1}, column {mark.column + 1}" if mark is not None else ""
+        return [f"Invalid YAML{where}: {getattr(e, 'problem', None) or e}"], warnings
+
+    if not isinstance(data, dict):
+        return ["A TOSCA template must be a YAML mapping"], warnings
+
+    version = data.get("tosca_definitions_version")
+    if version not in TOSCA_VERSIONS:
+        errors.append(f"Unsupported tosca_definitions_version {version!r}")
+
+    topology = data.get("topology_template")
+    if not isinstance(topology, dict):
+        errors.append("Missing topology_template")
+        return errors, warnings
+
+    inputs = topology.get("inputs") or {}
+    nodes = topology.get("node_templates") or {}
+    outputs = topology.get("outputs") or {}
+    if not isinstance(inputs, dict):
+        errors.append("topology_template.inputs must be a mapping")
+        inputs = {}
+    if not isinstance(nodes, dict) or not nodes:
+        errors.append("topology_template has no node_templates")
+        nodes = {}
+    if not isinstance(outputs, dict):
+        errors.append("topology_template.outputs must be a mapping")
+        outputs = {}
+
+    template_inputs = templates.get((data.get("metadata") or {}).get("template_name")) or {}
+    for name, definition in inputs.items():
+        if not isinstance(definition, dict):
+            errors.append(f"Input '{name}' must be a mapping")
+            continue
+        input_errors, input_warnings = check_input(name, definition, template_inputs.get(name))
+        errors.extend(input_errors)
+        warnings.extend(input_warnings)
+
+    for name, node in nodes.items():
+        if not isinstance(node, dict) or not node.get("type"):
+            errors.append(f"Node template '{name}' has no type")
+            continue
+        for requirement in node.get("requirements") or []:
+            if not isinstance(requirement, dict):
+                continue
+            for requirement_name, target in requirement.items():
+                target_node = target.get("node") if isinstance(target, dict) else target
+                if isinstance(target_node, str) and target_node not in nodes:
+                    errors.append(
+                        f"Requirement '{requirement_name}' of '{name}' refers to unknown node"
+                        f" template '{target_node}'"
+                    )
+
+    for name, output in outputs.items():
+        if not isinstance(output, dict) or "value" not in output:
+            errors.append(f"Output '{name}' has no value")
+
+    used_inputs = set()
+    for path, function, arguments in tosca_functions(topology, "topology_template"):
+        target = arguments[0] if isinstance(arguments, list) and arguments else arguments
+        if function == "get_input":
+            used_inputs.add(target)
+            if target not in inputs:
+                errors.append(f"{path}: get_input of undeclared input '{target}'")
+            elif (
+                isinstance(inputs[target], dict)
+                and inputs[target].get("default") is None
+                and inputs[target].get("required", True)
+            ):
+                errors.append(f"Input '{target}' has no value")
+        elif target not in nodes and target not in TOSCA_KEYWORDS:
+            errors.append(f"{path}: {function} of unknown node template '{target}'")
+
+    for name in inputs:
+        if name not in used_inputs:
+            warnings.append(f"Input '{name}' is not used")
+
+    return errors, warnings
+
+
+def check_radl(text):
+    """
+    Cross-check the deploys, systems and networks of a RADL recipe.
+
+    The local parser does not cover the whole RADL grammar, so what it
+    cannot read is only warned about and left for the IM to judge; just
+    references to undefined systems or networks are errors.
+    """
+    errors, warnings = [], []
+    try:
+        document = parse_radl(text)
+    except RADLSyntaxError as e:
+        return errors, [f"Could not check the RADL locally ({e}); the IM will validate it"]
+
+    for construct in document.skipped:
+        warnings.append(f"Could not check `{construct}` locally; the IM will validate it")
+    if not document.deploys:
+        warnings.append("The recipe deploys nothing: add a `deploy <system> <count>` line")
+    for system, count, _ in document.deploys:
+        if system not in document.systems:
+            errors.append(f"`deploy {system}` refers to an undefined system")
+        elif count < 1:
+            warnings.append(f"`deploy {system} {count}` creates no VMs")
+
+    for system, properties in document.systems.items():
+        for name, value in properties.items():
+            if re.fullmatch(r"net_interface\.\d+\.connection", name) and value not in document.networks:
+                errors.append(f"System '{system}': {name} refers to an undefined network '{value}'")
+
+    return errors, warnings
+
+
+def check_json(text):
+    errors, warnings = [], []
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        return [f"Invalid JSON at line {e.lineno}, column {e.colno}: {e.msg}"], warnings
+
+    items = data if isinstance(data, list) else [data]
+    systems = set()
+    deploys = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or item.get("class") not in JSON_CLASSES:
+            errors.append(f"Item {index} has no valid `class` ({', '.join(sorted(JSON_CLASSES))})")
+            continue
+        if item["class"] == "system":
+            systems.add(item.get("id"))
+        elif item["class"] == "deploy":
+            deploys.append(item)
+
+    if not deploys and not errors:
+        errors.append("The recipe deploys nothing: add an item of class `deploy`")
+    for deploy in deploys:
+        if deploy.get("system") not in systems:
+            errors.append(f"Deploy refers to an undefined system {deploy.get('system')!r}")
+
+    return errors, warnings
+
+
+class RecipeValidator:
+    """
+    Local checks run on recipes before they are sent to the IM.
+
+    TOSCA templates are checked for their structure, for references to
+    inputs and node templates, and for input values against their types
+    and constraints, including those of the bundled template they were
+    made from (matched by `metadata.template_name`). RADL and JSON recipes
+    are parsed and their deploys, systems and networks cross-checked.
+
+    Results are kept by content hash, so a recipe is only checked once
+    while it does not change.
+    """
+
+    def __init__(self, templates_dir=TEMPLATES_DIR, max_entries=VALIDATION_CACHE_SIZE, stats=None):
+        self.templates_dir = templates_dir
+        self.max_entries = max_entries
+        self.stats = stats
+        self._templates = None
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def templates(self):
+        if self._templates is None:
+            self._templates = load_templates(self.templates_dir)
+        return self._templates
+
+    def validate(self, recipe, desc_type):
+        """Return the `Validation` of a recipe of type `yaml`, `radl` or `json`."""
+        key = hashlib.sha256(f"{desc_type}\0{recipe}".encode()).hexdigest()
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                return result
+
+        with span(self.stats, "recipe.validate"):
+            if desc_type == "yaml":
+                errors, warnings = check_tosca(recipe, self.templates)
+            elif desc_type == "radl":
+                errors, warnings = check_radl(recipe)
+            elif desc_type == "json":
+                errors, warnings = check_json(recipe)
+            else:
+                errors, warnings = [f"Unknown recipe format '{desc_type}'"], []
+        result = Validation(desc_type, errors, warnings)
+
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        return result
+
+    def check(self, recipe, desc_type):
+        """Validate a recipe, raising `RecipeValidationError` if it has errors."""
+        result = self.validate(recipe, desc_type)
+        if result.errors:
+            raise RecipeValidationError(result.errors)
+        return result
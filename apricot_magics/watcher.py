@@ -0,0 +1,189 @@
+from collections import namedtuple
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import asyncio
+import re
+import threading
+import time
+
+# IM states after which an infrastructure is not expected to change on its own.
+SETTLED_STATES = {"configured", "unconfigured", "failed", "stopped", "off", "deleted"}
+FAILED_STATES = {"unconfigured", "failed", "deleted"}
+
+InfrastructureStatus = namedtuple(
+    "InfrastructureStatus", ["state", "ip", "updated", "error"]
+)
+
+
+def parse_duration(value):
+    """Parse durations such as `90`, `90s`, `30m` or `2h` into seconds."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smh]?)\s*", value)
+    if not match:
+        raise ValueError(f"Invalid duration: '{value}'")
+    return float(match.group(1)) * {"": 1, "s": 1, "m": 60, "h": 3600}[match.group(2)]
+
+
+class InfrastructureWatcher:
+    """
+    Track the state of infrastructures in the background.
+
+    Each watched infrastructure is polled by its own asyncio task with an
+    adaptive interval: `min_interval` right after it is (re)watched, doubling
+    up to `max_interval` while it is changing. Once it reaches a settled state
+    and nobody waits on it, its task ends and its status is dropped; settled
+    statuses are cached on disk by `fetch_status` instead. The latest status
+    of every infrastructure still changing is kept in memory for listings.
+
+    Magics run synchronously on the kernel's own event loop, so a blocking
+    `wait_until` there would starve any task scheduled on it; the watcher
+    therefore runs its loop on a daemon thread.
+    """
+
+    def __init__(self, fetch_status, min_interval=5, max_interval=60):
+        self.fetch_status = fetch_status
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.statuses = {}
+        self._tasks = {}
+        self._wakeups = {}
+        self._waiters = {}
+        self._condition = None
+        self._loop = None
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="apricot-watcher", daemon=True
+                ).start()
+        return self._loop
+
+    # Called from any thread
+
+    def get(self, inf_id):
+        with self._lock:
+            return self.statuses.get(inf_id)
+
+    def record(self, inf_id, state, ip=None, error=None):
+        """Store a status fetched elsewhere (e.g. by a listing)."""
+        with self._lock:
+            self.statuses[inf_id] = InfrastructureStatus(state, ip, time.time(), error)
+
+    def watch(self, inf_id, fast=False):
+        """Start watching an infrastructure; `fast` restarts its backoff."""
+        loop = self._ensure_loop()
+        loop.call_soon_threadsafe(self._start, inf_id, fast)
+
+    def unwatch(self, inf_id):
+        with self._lock:
+            self.statuses.pop(inf_id, None)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop, inf_id)
+
+    def wait_until(self, inf_id, states, timeout=None):
+        """
+        Block until an infrastructure reaches one of `states` or fails.
+
+        Only statuses fetched after the call count, so a stale cached state
+        never satisfies the wait. Returns the last `InfrastructureStatus`;
+        raises `TimeoutError`.
+        """
+        since = time.time()
+        self.watch(inf_id, fast=True)
+        future = asyncio.run_coroutine_threadsafe(
+            self._wait_until(inf_id, set(states), since), self._loop
+        )
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise TimeoutError(f"timed out after {timeout:g}s")
+        except BaseException:
+            future.cancel()
+            raise
+
+    # Running in the watcher loop
+
+    def _start(self, inf_id, fast):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        task = self._tasks.get(inf_id)
+        if task is not None and not task.done():
+            if fast:
+                self._wakeups[inf_id].set()
+            return
+
+        self._wakeups[inf_id] = asyncio.Event()
+        self._tasks[inf_id] = self._loop.create_task(self._watch(inf_id))
+
+    def _stop(self, inf_id):
+        task = self._tasks.pop(inf_id, None)
+        self._wakeups.pop(inf_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _watch(self, inf_id):
+        interval = self.min_interval
+
+        while True:
+            wakeup = self._wakeups[inf_id]
+            wakeup.clear()
+
+            try:
+                state, ip = await self._loop.run_in_executor(
+                    None, self.fetch_status, inf_id
+                )
+                self.record(inf_id, state, ip)
+            except Exception as e:
+                previous = self.get(inf_id)
+                self.record(
+                    inf_id,
+                    previous.state if previous else "unknown",
+                    previous.ip if previous else None,
+                    str(e),
+                )
+                state = None
+
+            async with self._condition:
+                self._condition.notify_all()
+
+            # Settled infrastructures are not expected to change on their own.
+            if (
+                state in SETTLED_STATES
+                and not self._waiters.get(inf_id)
+                and not wakeup.is_set()
+            ):
+                with self._lock:
+                    self.statuses.pop(inf_id, None)
+                if self._tasks.get(inf_id) is asyncio.current_task():
+                    del self._tasks[inf_id]
+                    del self._wakeups[inf_id]
+                return
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=interval)
+                interval = self.min_interval
+            except asyncio.TimeoutError:
+                interval = min(interval * 2, self.max_interval)
+
+    async def _wait_until(self, inf_id, states, since):
+        def reached():
+            status = self.get(inf_id)
+            return (
+                status is not None
+                and status.updated >= since
+                and (status.state in states or status.state in FAILED_STATES)
+            )
+
+        self._waiters[inf_id] = self._waiters.get(inf_id, 0) + 1
+        try:
+            async with self._condition:
+                await self._condition.wait_for(reached)
+        finally:
+            self._waiters[inf_id] -= 1
+
+        return self.get(inf_id)
@@ -0,0 +1,230 @@
+"""
+Drive the magics against a local mock IM and record how they scale.
+
+For every combination of infrastructure and VM counts, each scenario runs
+in a fresh interpreter with an empty home directory, talking to a
+`MockIM` served from this process:
+
+    ls      `%apricot_ls --refresh` over every infrastructure
+    info    `%apricot_info` of one infrastructure with all its VMs
+    create  one `%apricot_create` per infrastructure
+    cell    a `%%apricot` cell with one `destroy` line per infrastructure
+
+Wall time, IM calls made by the command, failed calls and peak memory are
+written as JSON. With `--baseline`, the run fails if a scenario got slower
+than the tolerance allows or makes more IM calls than before.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --infrastructures 10,100 --vms 1,16 --baseline results.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+from mock_im import MockIM
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ["ls", "info", "create", "cell"]
+
+# Differences below this many seconds are noise, whatever the tolerance.
+NOISE_FLOOR = 0.05
+
+RECIPE = """network public ( outbound = 'yes' )
+system node ( cpu.count >= 1 and memory.size >= 1g )
+deploy node 1
+"""
+
+
+def run_scenario(scenario, infrastructures, vms):
+    """Run one scenario in this (fresh) interpreter and return its measurements."""
+    from contextlib import redirect_stdout
+    from io import StringIO
+    import resource
+    import time
+
+    from IPython.core.interactiveshell import InteractiveShell
+
+    from apricot_magics.apricot_magics import Apricot_Magics
+    from apricot_magics.store import open_store
+
+    shell = InteractiveShell.instance()
+    magics = Apricot_Magics(shell)
+    shell.register_magics(magics)
+
+    inf_ids = [f"inf-{index:05d}" for index in range(infrastructures)]
+    store = open_store(magics.state_dir)
+    store.add(*[{"infrastructureID": inf_id, "name": f"bench-{inf_id}"} for inf_id in inf_ids])
+    magics.authfile_path.write_text("id = im; type = InfrastructureManager; token = benchmark\n")
+
+    if scenario == "ls":
+        commands = [lambda: shell.run_line_magic("apricot_ls", "--refresh")]
+    elif scenario == "info":
+        commands = [lambda: shell.run_line_magic("apricot_info", f"{inf_ids[0]} --page-size 0")]
+    elif scenario == "create":
+        commands = [lambda: shell.run_line_magic("apricot_create", RECIPE)] * infrastructures
+    elif scenario == "cell":
+        cell = "\n".join(f"destroy {inf_id}" for inf_id in inf_ids)
+        commands = [lambda: shell.run_cell_magic("apricot", "", cell)]
+    else:
+        raise ValueError(f"Unknown scenario '{scenario}'")
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    failed = 0
+    with magics.stats.trace() as trace, redirect_stdout(StringIO()):
+        start = time.perf_counter()
+        for command in commands:
+            failed += command() in ("Fail", "Failed")
+        seconds = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    im_spans = [
+        span for span in trace
+        if span["operation"].startswith("im.") and span["operation"] != "im.session_load"
+    ]
+    return {
+        "seconds": seconds,
+        "im_calls": len(im_spans),
+        "im_errors": sum(span["error"] for span in im_spans),
+        "failed_commands": failed,
+        "max_rss_kb": rss_after,
+        "rss_growth_kb": rss_after - rss_before,
+    }
+
+
+def spawn(endpoint, scenario, infrastructures, vms):
+    with tempfile.TemporaryDirectory() as home:
+        env = dict(
+            os.environ,
+            HOME=home,
+            APRICOT_IM_ENDPOINT=endpoint,
+            PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])),
+        )
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-scenario", scenario,
+             "--infrastructures", str(infrastructures), "--vms", str(vms)],
+            env=env,
+            cwd=home,
+            capture_output=True,
+            text=True,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"{scenario} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of `results` with respect to a previous run."""
+    previous = {
+        (entry["scenario"], entry["infrastructures"], entry["vms"]): entry
+        for entry in baseline["results"]
+    }
+    regressions = []
+    for entry in results:
+        key = (entry["scenario"], entry["infrastructures"], entry["vms"])
+        before = previous.get(key)
+        if before is None:
+            continue
+        label = f"{entry['scenario']} ({entry['infrastructures']} infrastructures, {entry['vms']} VMs)"
+        slower = entry["seconds"] - before["seconds"]
+        if slower > NOISE_FLOOR and entry["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(
+                f"{label}: {entry['seconds']:.3f}s, was {before['seconds']:.3f}s"
+            )
+        if entry["im_calls"] > before["im_calls"]:
+            regressions.append(
+                f"{label}: {entry['im_calls']} IM calls, was {before['im_calls']}"
+            )
+    return regressions
+
+
+def parse_counts(value):
+    return [int(count) for count in value.split(",") if count]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--infrastructures", default="10,100,1000")
+    parser.add_argument("--vms", default="1,16,64")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown over the baseline (default 0.25 = 25%%)")
+    parser.add_argument("--run-scenario", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.run_scenario, int(args.infrastructures), int(args.vms))))
+        return 0
+
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    mock = MockIM(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        failure_rate=args.failure_rate,
+    )
+    endpoint = mock.start()
+
+    results = []
+    try:
+        for infrastructures in parse_counts(args.infrastructures):
+            for vms in parse_counts(args.vms):
+                for scenario in scenarios:
+                    mock.reset(infrastructures, vms)
+                    entry = {"scenario": scenario, "infrastructures": infrastructures, "vms": vms}
+                    entry.update(spawn(endpoint, scenario, infrastructures, vms))
+                    entry["server_requests"] = mock.calls
+                    results.append(entry)
+                    print(
+                        f"{scenario:7} {infrastructures:5} inf {vms:3} VMs "
+                        f"{entry['seconds']:8.3f}s {entry['im_calls']:6} IM calls "
+                        f"{entry['im_errors']:4} errors {entry['max_rss_kb'] / 1024:7.1f} MB",
+                        flush=True,
+                    )
+    finally:
+        mock.stop()
+
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency_ms": args.latency_ms,
+        "jitter_ms": args.jitter_ms,
+        "failure_rate": args.failure_rate,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+Measure how long `%load_ext apricot_magics` takes in a fresh interpreter.
+
+Each run starts a new Python process with an empty home directory, creates
+an IPython shell and times loading the extension. The run fails if the
+median load time exceeds the budget, if loading touched the state
+directory, or if it imported modules that should only load on first use.
+
+    python benchmarks/startup.py [--budget-ms 150] [--runs 5]
+"""
+
+import argparse
+import json
+import statistics
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must not be imported until a magic needs them.
+DEFERRED_MODULES = ["imclient", "requests", "jwt", "tabulate", "yaml"]
+
+PROBE = """
+import json, os, sys, time
+from IPython.core.interactiveshell import InteractiveShell
+
+shell = InteractiveShell.instance()
+start = time.perf_counter()
+shell.run_line_magic("load_ext", "apricot_magics")
+elapsed = time.perf_counter() - start
+
+print(json.dumps({
+    "seconds": elapsed,
+    "imported": [m for m in %(deferred)r if m in sys.modules],
+    "state_dir_created": os.path.exists(os.path.join(os.path.expanduser("~"), "apricotlab_state")),
+}))
+"""
+
+
+def run_once():
+    with tempfile.TemporaryDirectory() as home:
+        env = {
+            "HOME": home,
+            "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+            "PYTHONPATH": REPO_ROOT,
+            # A token refresh at load time would hang here instead of failing fast.
+            "APRICOT_TOKEN_ENDPOINT": "http://10.255.255.1/token",
+        }
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE % {"deferred": DEFERRED_MODULES}],
+            env=env,
+            cwd=home,
+            capture_output=True,
+            text=True,
+            timeout=60,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=150.0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    times = [run["seconds"] * 1000 for run in runs]
+    median = statistics.median(times)
+
+    print(
+        f"load_ext apricot_magics: median {median:.1f} ms, "
+        f"min {min(times):.1f} ms, max {max(times):.1f} ms ({args.runs} runs)"
+    )
+
+    failures = []
+    if median > args.budget_ms:
+        failures.append(f"median load time {median:.1f} ms exceeds the {args.budget_ms:g} ms budget")
+    imported = sorted({module for run in runs for module in run["imported"]})
+    if imported:
+        failures.append(f"modules imported at load time: {', '.join(imported)}")
+    if any(run["state_dir_created"] for run in runs):
+        failures.append("loading the extension created the state directory")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
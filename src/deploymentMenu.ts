@@ -4,16 +4,12 @@ import { ServerConnection } from '@jupyterlab/services';
 import { Widget } from '@lumino/widgets';
 import { Dialog, Notification } from '@jupyterlab/apputils';
 
+import { requestAPI } from './handler';
 import {
-  appendInfrastructureToList,
-  executeKernelCommand,
-  getIMClientPath,
   getDeployedTemplatePath,
-  getAuthFilePath,
   getAccessTokenFromShareManager,
   persistAuthFile,
   writeTextFile,
-  getStateFilePath,
   createButton
 } from './utils';
 
@@ -73,6 +69,7 @@ interface IInfrastructureData {
   accessTokenSource: 'auto' | 'manual';
   name: string;
   infrastructureID: string;
+  imEndpoint?: string;
   id: string;
   type: string;
   host: string;
@@ -85,6 +82,13 @@ interface IInfrastructureData {
   custom: string;
 }
 
+// Outcome of a deployment: `infId` is empty when the recipe was rejected.
+interface IDeployResult {
+  infId: string;
+  imEndpoint?: string;
+  message: string;
+}
+
 const deployInfo: IDeployInfo = {
   accessToken: '',
   accessTokenSource: 'manual',
@@ -169,8 +173,6 @@ let imageOptions: { uri: string; name: string }[] = [];
 
 let deploying = false; // Flag to prevent multiple deployments at the same time
 
-const imEndpoint = 'https://im.egi.eu/im';
-
 //*****************//
 //* Aux functions *//
 //*****************//
@@ -584,8 +586,7 @@ async function createImageDropdown(
   dropdownContainer.appendChild(loader);
 
   try {
-    const cmdImageNames = await selectImage(deployInfo);
-    const outputText = await executeKernelCommand(cmdImageNames);
+    const outputText = await selectImage(deployInfo);
     dropdownContainer.removeChild(loader);
 
     await createImagesDropdown(outputText, dropdownContainer);
@@ -595,6 +596,12 @@ async function createImageDropdown(
     }
   } catch (error) {
     console.error('Error loading image dropdown:', error);
+    Notification.error(
+      'No OS images found. Bad provider credentials or expired token.',
+      {
+        autoClose: 5000
+      }
+    );
     dropdownContainer.removeChild(loader);
   }
 }
@@ -668,90 +675,74 @@ async function collectUserInputsFromForm(
   };
 }
 
-//*********************//
-//*  Kernel commands  *//
-//*********************//
+//*****************//
+//*  IM requests  *//
+//*****************//
 
 async function selectImage(obj: IDeployInfo): Promise<string> {
-  const imClientPath = await getIMClientPath();
-  const authFilePath = await getAuthFilePath();
-
   await persistAuthFile(obj);
 
-  const cmd = `
-from pathlib import Path
-import subprocess
-
-auth_file = Path(${JSON.stringify(authFilePath)})
-cmd = [
-    "python3",
-    ${JSON.stringify(imClientPath)},
-    "-q",
-    "-a",
-    str(auth_file),
-    "-r",
-    ${JSON.stringify(imEndpoint)},
-    "cloudimages",
-    ${JSON.stringify(obj.id)},
-]
-result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-print(result.stdout)
-if result.returncode != 0:
-    raise RuntimeError(result.stdout)
-          `;
-
-  // console.log('Get cloud images:', cmd);
   console.log('Getting cloud images...');
-  return cmd;
+  const data = await requestAPI<{ images: { uri: string; name: string }[] }>(
+    `images/${encodeURIComponent(obj.id)}`
+  );
+  return JSON.stringify(data.images);
 }
 
-async function deployIMCommand(
+async function deployInfrastructure(
   obj: IDeployInfo,
   mergedTemplate: string
-): Promise<string> {
+): Promise<IDeployResult> {
   const format = detectRecipeFormat(mergedTemplate);
   console.log('Detected format:', format);
 
+  // Keep a copy of the last deployed recipe in the state directory.
   const deployedTemplatePath = await getDeployedTemplatePath(format);
-  const imClientPath = await getIMClientPath();
-  const authFilePath = await getAuthFilePath();
-
   await writeTextFile(deployedTemplatePath, mergedTemplate);
-  const deployedTemplateKernelPath = await getStateFilePath(
-    `deployed-template.${format}`
-  );
 
-  const cmd = `
-from pathlib import Path
-import subprocess
-
-auth_file = Path(${JSON.stringify(authFilePath)})
-template_file = Path(${JSON.stringify(deployedTemplateKernelPath)})
-cmd = [
-    "python3",
-    ${JSON.stringify(imClientPath)},
-    "-a",
-    str(auth_file),
-    "create",
-    str(template_file),
-    "-r",
-    ${JSON.stringify(imEndpoint)},
-]
-result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-print(result.stdout)
-if result.returncode != 0:
-    raise RuntimeError(result.stdout)
-`;
-
-  console.log('TOSCA recipe deployed:', cmd);
-  return cmd;
-}
+  // The server records the new infrastructure with these details, its ID
+  // and the IM it was routed to, which serves all its later calls.
+  const record: Omit<IInfrastructureData, 'infrastructureID' | 'imEndpoint'> =
+    {
+      accessToken: obj.accessToken,
+      accessTokenSource: obj.accessTokenSource,
+      name: obj.infName,
+      id: obj.id,
+      type: obj.deploymentType,
+      host: obj.host,
+      tenant: obj.tenant,
+      user: obj.username,
+      pass: obj.password,
+      authVersion: obj.authVersion,
+      domain: obj.domain,
+      vo: obj.vo,
+      custom: obj.custom
+    };
 
-async function saveToInfrastructureList(
-  obj: IInfrastructureData
-): Promise<void> {
-  await appendInfrastructureToList(obj);
-  console.log('Data saved to infrastructuresList.json:', obj);
+  let data: IInfrastructureData;
+  try {
+    data = await requestAPI<IInfrastructureData>('infrastructures', {
+      method: 'POST',
+      body: JSON.stringify({ recipe: mergedTemplate, format, record })
+    });
+  } catch (error) {
+    // Recipes rejected by the server's local validation never reach the IM.
+    if (
+      error instanceof ServerConnection.ResponseError &&
+      error.response.status === 400
+    ) {
+      return { infId: '', message: `Error: ${error.message}` };
+    }
+    throw error;
+  }
+
+  console.log('Recipe deployed:', data.infrastructureID, data.imEndpoint);
+  const endpoint = data.imEndpoint ? ` on IM ${data.imEndpoint}` : '';
+  return {
+    infId: data.infrastructureID,
+    imEndpoint: data.imEndpoint,
+    message: `Infrastructure successfully created with ID: ${data.infrastructureID}${endpoint}`
+  };
 }
 
 //****************//
@@ -893,13 +884,11 @@ const customRecipe = async (dialogBody: HTMLElement): Promise<void> => {
     deployInfo.custom = 'true';
 
     try {
-      const cmdDeploy = await deployIMCommand(deployInfo, recipe);
-
       dialogBody.innerHTML =
         '<div class="loader-container"><div class="loader"></div></div>';
 
-      const outputText = await executeKernelCommand(cmdDeploy);
-      handleFinalDeployOutput(outputText, dialogBody);
+      const result = await deployInfrastructure(deployInfo, recipe);
+      handleFinalDeployOutput(result, dialogBody);
     } catch (error) {
       Notification.error(`Deployment failed: ${error || 'Unknown error'}`, {
         autoClose: 5000
@@ -1423,10 +1412,8 @@ async function deployFinalRecipe(
     );
     const mergedYamlContent = jsyaml.dump(mergedTemplate);
 
-    const cmdDeploy = await deployIMCommand(deployInfo, mergedYamlContent);
-
-    const outputText = await executeKernelCommand(cmdDeploy);
-    handleFinalDeployOutput(outputText, dialogBody);
+    const result = await deployInfrastructure(deployInfo, mergedYamlContent);
+    handleFinalDeployOutput(result, dialogBody);
   } catch (error) {
     console.error('Error during deployment:', error);
   } finally {
@@ -1435,17 +1422,17 @@ async function deployFinalRecipe(
 }
 
 const handleFinalDeployOutput = async (
-  output: string | undefined,
+  result: IDeployResult | undefined,
   dialogBody: HTMLElement
 ): Promise<void> => {
-  if (!output) {
+  if (!result) {
     return;
   }
 
   dialogBody.innerHTML = '';
 
-  if (output.toLowerCase().includes('error')) {
-    console.error('Error deploying infrastructure:', output);
+  if (!result.infId) {
+    console.error('Error deploying infrastructure:', result.message);
     Notification.error(
       'Error deploying infrastructure. Check the console for more details.',
       {
@@ -1469,39 +1456,10 @@ const handleFinalDeployOutput = async (
           <p>Infrastructure successfully deployed</p>
         </div>
       `;
-    console.log('Infrastructure deployed:', output);
-    Notification.success(output, {
+    console.log('Infrastructure deployed:', result.message);
+    Notification.success(result.message, {
       autoClose: 5000
     });
-
-    // Extract infrastructure ID
-    const idMatch = output.match(/ID: ([\w-]+)/);
-    const infrastructureID = idMatch ? idMatch[1] : '';
-
-    // Create a JSON object for infrastructure data
-    const infrastructureData: IInfrastructureData = {
-      accessToken: deployInfo.accessToken,
-      accessTokenSource: deployInfo.accessTokenSource,
-      name: deployInfo.infName,
-      infrastructureID,
-      id: deployInfo.id,
-      type: deployInfo.deploymentType,
-      host: deployInfo.host,
-      tenant: deployInfo.tenant,
-      user: deployInfo.username,
-      pass: deployInfo.password,
-      authVersion: deployInfo.authVersion,
-      domain: deployInfo.domain,
-      vo: deployInfo.vo,
-      custom: deployInfo.custom
-    };
-
-    try {
-      await saveToInfrastructureList(infrastructureData);
-    } catch (error) {
-      console.error('Error saving infrastructure data:', error);
-      deploying = false;
-    }
     resetDeployInfo();
   }
 };
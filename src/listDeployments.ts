@@ -1,15 +1,11 @@
 import { Dialog, Notification } from '@jupyterlab/apputils';
 import { Widget } from '@lumino/widgets';
+import { requestAPI } from './handler';
 import {
-  getIMClientPath,
   createButton,
-  getAuthFilePath,
-  executeKernelCommand,
   getAccessTokenFromShareManager,
   persistAuthFile,
-  writeAuthFile,
-  readInfrastructuresList,
-  removeInfrastructureFromList
+  writeAuthFile
 } from './utils';
 
 interface IInfrastructure {
@@ -19,6 +15,7 @@ interface IInfrastructure {
   accessTokenSource?: 'auto' | 'manual';
   name: string;
   infrastructureID: string;
+  imEndpoint?: string;
   id: string;
   type: string;
   host: string;
@@ -31,8 +28,6 @@ interface IInfrastructure {
   custom: string;
 }
 
-const imEndpoint = 'https://im.egi.eu/im';
-
 async function openListDeploymentsDialog(): Promise<void> {
   try {
     // Create a loader container
@@ -108,20 +103,8 @@ async function deleteButton(
 
     try {
       await refreshAndPersistListAuth([infrastructure]);
-      const cmdDeploy = await destroyInfrastructure(infrastructureId);
-
-      const outputText = await executeKernelCommand(cmdDeploy);
-
-      if (outputText?.toLowerCase().includes('error')) {
-        Notification.error(
-          'Error destroying infrastructure. Check the console for more details.',
-          {
-            autoClose: 5000
-          }
-        );
-        console.error('Error destroying infrastructure:', outputText);
-        return;
-      }
+      // The server extension also removes it from the infrastructure list.
+      await destroyInfrastructure(infrastructureId);
 
       row.remove();
 
@@ -131,9 +114,6 @@ async function deleteButton(
           autoClose: 5000
         }
       );
-      console.log(outputText);
-
-      await removeInfrastructureFromList(infrastructureId);
     } catch (error) {
       Notification.error(
         'Error destroying infrastructure. Check the console for more details.',
@@ -159,12 +139,14 @@ async function deleteButton(
 async function populateTable(table: HTMLTableElement): Promise<void> {
   let infrastructures: IInfrastructure[] = [];
   try {
-    const data = await readInfrastructuresList();
+    const data = await requestAPI<{ infrastructures: IInfrastructure[] }>(
+      'infrastructures'
+    );
     infrastructures = data.infrastructures;
   } catch (error) {
-    console.error('Error reading or parsing infrastructuresList.json:', error);
+    console.error('Error reading the infrastructure list:', error);
     Notification.error(
-      'Error reading or parsing infrastructuresList.json. Check the console for more details.',
+      'Error reading the infrastructure list. Check the console for more details.',
       {
         autoClose: 5000
       }
@@ -254,132 +236,34 @@ async function refreshAndPersistListAuth(
   });
 }
 
-async function getInfrastructureInfo(
-  infrastructure: IInfrastructure,
-  dataType: 'state' | 'ip'
-): Promise<string> {
-  const infrastructureID = infrastructure.infrastructureID;
-
-  const imClientPath = await getIMClientPath();
-  const authFilePath = await getAuthFilePath();
-
-  const imArgs =
-    dataType === 'state'
-      ? ['getstate', infrastructureID]
-      : ['getvminfo', infrastructureID, '0', 'net_interface.1.ip'];
-
-  const cmd = `
-from pathlib import Path
-import subprocess
-
-auth_file = Path(${JSON.stringify(authFilePath)})
-cmd = [
-    "python3",
-    ${JSON.stringify(imClientPath)},
-    "-q",
-    *${JSON.stringify(imArgs)},
-    "-r",
-    ${JSON.stringify(imEndpoint)},
-    "-a",
-    str(auth_file),
-]
-result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-print(result.stdout)
-if result.returncode != 0:
-    raise RuntimeError(result.stdout)
-              `;
-
-  console.log(`Get ${dataType} command: `, cmd);
-  return cmd;
-}
-
-function extractIpAddress(output: string): string {
-  const ipv4Matches = output.match(/\b(?:\d{1,3}\.){3}\d{1,3}\b/g) || [];
-  const validIps = ipv4Matches.filter(ip =>
-    ip.split('.').every(octet => Number(octet) <= 255)
-  );
-
-  return validIps[validIps.length - 1] || 'N/A';
-}
-
-function extractInfrastructureState(output: string): string {
-  try {
-    const parsedOutput = JSON.parse(output);
-    if (typeof parsedOutput?.state === 'string') {
-      return parsedOutput.state;
-    }
-  } catch {
-    // Fall back to parsing older, non-JSON IM client output.
-  }
-
-  const stateMatch = output.match(/\bstate\b\s*[:=]\s*"?([A-Za-z_-]+)"?/);
-  return stateMatch?.[1] || 'Error';
-}
-
 async function fetchInfrastructureData(
   infrastructure: IInfrastructure,
   dataType: 'state' | 'ip'
 ): Promise<string> {
-  try {
-    const cmd = await getInfrastructureInfo(infrastructure, dataType);
-    const outputData = await executeKernelCommand(cmd);
-
-    if (!outputData || outputData.trim() === '') {
-      return dataType === 'ip' ? 'N/A' : 'No Output';
-    }
-
-    console.log(`Received output for ${dataType}:`, outputData);
+  const infrastructureID = encodeURIComponent(infrastructure.infrastructureID);
 
-    let result: string;
+  try {
+    const data = await requestAPI<{ state?: string; ip?: string }>(
+      `infrastructures/${infrastructureID}/${dataType}`
+    );
+    console.log(`Received ${dataType}:`, data);
 
-    if (outputData.toLowerCase().includes('error')) {
-      result = dataType === 'ip' ? 'N/A' : outputData;
-    } else {
-      if (dataType === 'state') {
-        result = extractInfrastructureState(outputData);
-      } else {
-        result = extractIpAddress(outputData);
-      }
+    if (dataType === 'state') {
+      return data.state || 'No Output';
     }
-
-    return result;
+    return data.ip || 'N/A';
   } catch (error) {
     console.error(`Error fetching ${dataType}:`, error);
     return dataType === 'ip' ? 'N/A' : 'Error';
   }
 }
 
-async function destroyInfrastructure(
-  infrastructureID: string
-): Promise<string> {
-  const imClientPath = await getIMClientPath();
-  const authFilePath = await getAuthFilePath();
-
-  const cmd = `
-from pathlib import Path
-import subprocess
-
-auth_file = Path(${JSON.stringify(authFilePath)})
-cmd = [
-    "python3",
-    ${JSON.stringify(imClientPath)},
-    "-q",
-    "destroy",
-    "-y",
-    ${JSON.stringify(infrastructureID)},
-    "-a",
-    str(auth_file),
-    "-r",
-    ${JSON.stringify(imEndpoint)},
-]
-result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-print(result.stdout)
-if result.returncode != 0:
-    raise RuntimeError(result.stdout)
-          `;
-
-  console.log(cmd);
-  return cmd;
+async function destroyInfrastructure(infrastructureID: string): Promise<void> {
+  await requestAPI<{ infrastructureID: string }>(
+    `infrastructures/${encodeURIComponent(infrastructureID)}`,
+    { method: 'DELETE' }
+  );
+  console.log(`Infrastructure ${infrastructureID} destroyed`);
 }
 
 export { openListDeploymentsDialog };
@@ -1,11 +1,7 @@
 import { KernelManager } from '@jupyterlab/services';
-import { Notification } from '@jupyterlab/apputils';
 
 const infrastructuresStateDir = 'apricotlab_state';
-const infrastructuresStatePath = `${infrastructuresStateDir}/infrastructuresList.json`;
 const authFileStatePath = `${infrastructuresStateDir}/authfile`;
-const defaultAuthFileContent =
-  'id = im; type = InfrastructureManager; token = <token>\n';
 
 let kernelManager: KernelManager | null = null;
 let kernel: any | null = null;
@@ -61,21 +57,6 @@ export async function executeKernelCommand(command: string): Promise<string> {
   });
 }
 
-async function getPath(
-  command: string,
-  notificationMessage: string
-): Promise<string> {
-  try {
-    return await executeKernelCommand(command);
-  } catch (error) {
-    Notification.error(notificationMessage, {
-      autoClose: 5000
-    });
-    console.error((error as Error).message);
-    throw error;
-  }
-}
-
 async function ensureInfrastructuresStateDir(): Promise<void> {
   const cmd = `
 from pathlib import Path
@@ -95,69 +76,6 @@ for legacy_dir in (Path.cwd() / state_name, Path.cwd().parent / state_name):
   await executeKernelCommand(cmd);
 }
 
-async function writeInfrastructuresList(data: any): Promise<void> {
-  await ensureInfrastructuresStateDir();
-  const cmd = `
-from pathlib import Path
-
-path = Path.home() / ${JSON.stringify(infrastructuresStatePath)}
-path.write_text(${JSON.stringify(JSON.stringify(data, null, 2))})
-  `;
-  await executeKernelCommand(cmd);
-}
-
-export async function readInfrastructuresList(): Promise<any> {
-  try {
-    await ensureInfrastructuresStateDir();
-    const cmd = `
-from pathlib import Path
-import json
-
-path = Path.home() / ${JSON.stringify(infrastructuresStatePath)}
-if not path.exists():
-    path.write_text(json.dumps({"refresh_token": "", "infrastructures": []}, indent=2))
-print(path.read_text())
-    `;
-    const content = await executeKernelCommand(cmd);
-    const data = JSON.parse(content);
-
-    return {
-      refresh_token: data?.refresh_token || '',
-      infrastructures: data?.infrastructures || []
-    };
-  } catch (error) {
-    console.warn(
-      `${infrastructuresStatePath} not found or unreadable. Creating an empty list.`,
-      error
-    );
-    const initialData = {
-      refresh_token: '',
-      infrastructures: []
-    };
-    await writeInfrastructuresList(initialData);
-    return initialData;
-  }
-}
-
-export async function appendInfrastructureToList(
-  infrastructure: any
-): Promise<void> {
-  const data = await readInfrastructuresList();
-  data.infrastructures = [...(data.infrastructures || []), infrastructure];
-  await writeInfrastructuresList(data);
-}
-
-export async function removeInfrastructureFromList(
-  infrastructureID: string
-): Promise<void> {
-  const data = await readInfrastructuresList();
-  data.infrastructures = (data.infrastructures || []).filter(
-    (infrastructure: any) =>
-      infrastructure.infrastructureID !== infrastructureID
-  );
-  await writeInfrastructuresList(data);
-}
-
 export async function writeAuthFile(content: string): Promise<void> {
   await ensureInfrastructuresStateDir();
   const cmd = `
@@ -183,28 +101,6 @@ path.write_text(${JSON.stringify(content)})
   await executeKernelCommand(cmd);
 }
 
-export async function readAuthFile(): Promise<string> {
-  try {
-    await ensureInfrastructuresStateDir();
-    const cmd = `
-from pathlib import Path
-
-path = Path.home() / ${JSON.stringify(authFileStatePath)}
-print(path.read_text() if path.exists() else "")
-    `;
-    const content = await executeKernelCommand(cmd);
-
-    if (content) {
-      return content;
-    }
-  } catch {
-    // Missing authfile is expected on a fresh workspace.
-  }
-
-  await writeAuthFile(defaultAuthFileContent);
-  return defaultAuthFileContent;
-}
-
 export function getBrowserToken(): string {
   const jupyterConfigElement = document.querySelector('#jupyter-config-data');
   const jupyterConfig = jupyterConfigElement
@@ -322,38 +218,6 @@ export async function persistAuthFile(obj: {
   await writeAuthFile(buildAuthFileContent(obj));
 }
 
-function getStatePathCommand(statePath: string): string {
-  return `
-from pathlib import Path
-
-state = Path(${JSON.stringify(statePath)})
-print(Path.home() / state)
-  `;
-}
-
-export async function getIMClientPath(): Promise<string> {
-  const cmdIMClientPath = `
-from pathlib import Path
-import shutil
-
-candidates = [
-    shutil.which("im_client.py"),
-    shutil.which("im_client"),
-]
-
-for candidate in candidates:
-    if candidate and Path(candidate).exists():
-        print(candidate)
-        break
-else:
-    raise FileNotFoundError("Could not find im_client.py")
-  `;
-  return getPath(
-    cmdIMClientPath,
-    'Failed to find im_client.py path. Maybe IM-client is not installed. Check the console for more details.'
-  );
-}
-
 export async function getDeployedTemplatePath(
   ext: 'yaml' | 'json' | 'radl'
 ): Promise<string> {
@@ -361,31 +225,10 @@ export async function getDeployedTemplatePath(
   return `${infrastructuresStateDir}/deployed-template.${ext}`;
 }
 
-export async function getStateFilePath(fileName: string): Promise<string> {
-  await ensureInfrastructuresStateDir();
-  const cmdStateFilePath = getStatePathCommand(
-    `${infrastructuresStateDir}/${fileName}`
-  );
-  return getPath(
-    cmdStateFilePath,
-    `Failed to find ${infrastructuresStateDir}/${fileName}. Check the console for more details.`
-  );
-}
-
-export async function getInfrastructuresListPath(): Promise<string> {
-  await readInfrastructuresList();
-  return getStateFilePath('infrastructuresList.json');
-}
-
 export async function getDeployableTemplatesPath(): Promise<string> {
   return 'resources/deployable_templates';
 }
 
-export async function getAuthFilePath(): Promise<string> {
-  await readAuthFile();
-  return getStateFilePath('authfile');
-}
-
 export const createButton = (
   label: string,
   onClick: () => void
@@ -0,0 +1,27 @@
+import pytest
+
+from benchmarks.mock_im import MockIM
+
+
+@pytest.fixture
+def mock_im():
+    mock = MockIM(infrastructures=0, vms=2)
+    mock.start()
+    yield mock
+    mock.stop()
+
+
+@pytest.fixture
+def magics(tmp_path, monkeypatch, mock_im):
+    """The magics with their state in a temporary home, talking to `mock_im`."""
+    from IPython.testing.globalipapp import get_ipython
+
+    from apricot_magics.apricot_magics import Apricot_Magics
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    magics = Apricot_Magics(get_ipython())
+    magics.store
+    magics.authfile_path.write_text("id = im; type = InfrastructureManager; token = x\n")
+    magics.set_im_endpoints([mock_im.url()])
+    yield magics
+    magics.tokens.close()
@@ -0,0 +1,100 @@
+import pytest
+import yaml
+
+from apricot_magics.apricot_magics import expand_parameter_matrix, render_tosca_template
+
+TEMPLATE = """tosca_definitions_version: tosca_simple_yaml_1_0
+topology_template:
+  inputs:
+    wn_num:
+      type: integer
+      default: 1
+    mem_size:
+      type: string
+      default: 2 GB
+  node_templates: {}
+"""
+
+
+def inputs_of(template):
+    return yaml.safe_load(template)["topology_template"]["inputs"]
+
+
+def test_matrix_is_the_cartesian_product():
+    assert expand_parameter_matrix(["wn_num=1,2", "mem_size=2 GB,4 GB"]) == [
+        {"wn_num": 1, "mem_size": "2 GB"},
+        {"wn_num": 1, "mem_size": "4 GB"},
+        {"wn_num": 2, "mem_size": "2 GB"},
+        {"wn_num": 2, "mem_size": "4 GB"},
+    ]
+
+
+def test_matrix_values_are_yaml_scalars():
+    assert expand_parameter_matrix(["public=true", "ratio=0.5", "name=front"]) == [
+        {"public": True, "ratio": 0.5, "name": "front"}
+    ]
+
+
+@pytest.mark.parametrize("assignment", ["wn_num", "wn_num=", "=1,2"])
+def test_invalid_assignments_are_rejected(assignment):
+    with pytest.raises(ValueError):
+        expand_parameter_matrix([assignment])
+
+
+def test_render_replaces_input_defaults():
+    rendered = render_tosca_template(TEMPLATE, {"wn_num": 3})
+    inputs = inputs_of(rendered)
+    assert inputs["wn_num"] == {"type": "integer", "default": 3}
+    assert inputs["mem_size"]["default"] == "2 GB"
+    # The template keeps its key order.
+    assert rendered.index("wn_num") < rendered.index("mem_size")
+
+
+def test_render_rejects_unknown_inputs():
+    with pytest.raises(ValueError, match="Unknown input 'cpus'"):
+        render_tosca_template(TEMPLATE, {"cpus": 2})
+
+
+def test_bulk_recipes_from_a_template(magics, tmp_path):
+    template = tmp_path / "cluster.yaml"
+    template.write_text(TEMPLATE)
+
+    recipes = magics.load_bulk_recipes(str(template), ["wn_num=1,2,3"], "cluster")
+    assert [name for name, _, _ in recipes] == ["cluster-0", "cluster-1", "cluster-2"]
+    assert [inputs_of(recipe)["wn_num"]["default"] for _, _, recipe in recipes] == [1, 2, 3]
+
+    # Without --set the template is submitted as written.
+    assert magics.load_bulk_recipes(str(template), [], "cluster") == [("cluster-0", {}, TEMPLATE)]
+
+
+def test_bulk_recipes_from_a_directory(magics, tmp_path):
+    (tmp_path / "b.radl").write_text("system b ( cpu.count >= 1 ) deploy b 1")
+    (tmp_path / "a.yaml").write_text(TEMPLATE)
+    (tmp_path / "notes.txt").write_text("not a recipe")
+
+    recipes = magics.load_bulk_recipes(str(tmp_path), [], "set")
+    assert [name for name, _, _ in recipes] == ["set-a", "set-b"]
+
+    with pytest.raises(ValueError):
+        magics.load_bulk_recipes(str(tmp_path), ["wn_num=1"], "set")
+
+
+def test_set_needs_a_tosca_template(magics, tmp_path):
+    recipe = tmp_path / "node.radl"
+    recipe.write_text("system node ( cpu.count >= 1 ) deploy node 1")
+    with pytest.raises(ValueError, match="TOSCA"):
+        magics.load_bulk_recipes(str(recipe), ["wn_num=1,2"], "node")
+
+
+def test_bulk_create_submits_every_combination(magics, mock_im, tmp_path, capsys):
+    template = tmp_path / "cluster.yaml"
+    template.write_text(TEMPLATE)
+
+    result = magics.apricot_bulk_create(
+        f"{template} --set wn_num=1,2 --set mem_size=2GB,4GB --rate 100 --no-validate"
+    )
+    out = capsys.readouterr().out
+    assert result == "Done"
+    assert "4 of 4 infrastructures submitted (group 'cluster')" in out
+    assert len(mock_im.infrastructures) == 4
+    assert {record["group"] for record in magics.store.list()} == {"cluster"}
@@ -0,0 +1,73 @@
+import threading
+
+from apricot_magics import cache
+from apricot_magics.cache import ResponseCache
+
+
+def test_put_get_and_invalidate(tmp_path):
+    responses = ResponseCache(tmp_path / "cache.db")
+    responses.put("radl", "inf-1", {"vms": 2}, inf_id="inf-1")
+    value, age = responses.get("radl", "inf-1")
+    assert value == {"vms": 2}
+    assert age >= 0
+    assert responses.invalidate(inf_id="inf-1") == 1
+    assert responses.get("radl", "inf-1") is None
+
+
+def test_reads_only_record_old_access_times(tmp_path, monkeypatch):
+    responses = ResponseCache(tmp_path / "cache.db")
+    responses.put("images", "site", ["ubuntu"])
+    statements = []
+    responses._connection().set_trace_callback(statements.append)
+
+    responses.get("images", "site")
+    assert not any(statement.startswith("UPDATE") for statement in statements)
+
+    monkeypatch.setattr(cache, "ACCESS_RESOLUTION", -1)
+    responses.get("images", "site")
+    assert any(statement.startswith("UPDATE") for statement in statements)
+
+
+def test_connection_per_thread(tmp_path):
+    responses = ResponseCache(tmp_path / "cache.db")
+    connections = []
+
+    def read():
+        responses.get("images", "site")
+        connections.append(responses._connection())
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    thread.join()
+    assert responses._connection() is responses._connection()
+    assert connections[0] is not responses._connection()
+
+
+def test_fetch_serves_stale_entries_while_revalidating(tmp_path):
+    responses = ResponseCache(tmp_path / "cache.db", ttls={"status": -1})
+    responses.put("status", "inf-1", "running")
+    loaded = threading.Event()
+
+    def load():
+        loaded.set()
+        return "stopped"
+
+    assert responses.fetch("status", "inf-1", load) == "running"
+    assert loaded.wait(5)
+
+
+def settled(state):
+    return state == "configured"
+
+
+def test_update_stores_only_cacheable_values(tmp_path):
+    responses = ResponseCache(tmp_path / "cache.db")
+
+    responses.update("status", "inf-1", "configured", cacheable=settled)
+    assert responses.get("status", "inf-1")[0] == "configured"
+
+    # A value that may still change also drops the entry it replaces.
+    responses.update("status", "inf-1", "running", cacheable=settled)
+    assert responses.get("status", "inf-1") is None
+    assert responses.fetch("status", "inf-1", lambda: "pending", cacheable=settled) == "pending"
+    assert responses.get("status", "inf-1") is None
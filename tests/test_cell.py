@@ -0,0 +1,99 @@
+import io
+import random
+import threading
+import time
+
+from apricot_magics.cell import RoutedStream, capture_line_output, output_lines, plan_cell
+from apricot_magics.concurrency import fan_out
+
+
+def numbered(*lines):
+    return list(enumerate(lines, 1))
+
+
+def test_lines_of_one_infrastructure_form_a_chain():
+    stages = plan_cell(numbered("exec inf-1 hostname", "exec inf-2 uptime", "exec inf-1 date"))
+    assert stages == [[[(1, "exec inf-1 hostname"), (3, "exec inf-1 date")],
+                       [(2, "exec inf-2 uptime")]]]
+
+
+def test_barrier_ends_a_stage():
+    stages = plan_cell(numbered("exec inf-1 a", "barrier", "exec inf-1 b", "barrier", "barrier"))
+    assert stages == [[[(1, "exec inf-1 a")]], [[(3, "exec inf-1 b")]]]
+
+
+def test_lines_without_infrastructure_run_alone():
+    stages = plan_cell(numbered("exec inf-1 a", "list", "exec inf-2 b", "destroy inf-2"))
+    assert stages == [
+        [[(1, "exec inf-1 a")]],
+        [[(2, "list")]],
+        [[(3, "exec inf-2 b"), (4, "destroy inf-2")]],
+    ]
+
+
+def test_output_is_routed_to_the_buffer_of_each_line():
+    target = io.StringIO()
+    stream = RoutedStream(target)
+    buffers = {number: io.StringIO() for number in range(4)}
+
+    def line(number):
+        with capture_line_output(buffers[number]):
+            stream.write(f"line {number}\n")
+            # Threads a line fans out to run in copies of its context.
+            fan_out(lambda item: stream.write(f"{number}.{item}\n"), range(2))
+
+    threads = [threading.Thread(target=line, args=(number,)) for number in buffers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stream.write("outside\n")
+
+    for number, buffer in buffers.items():
+        assert buffer.getvalue() == f"line {number}\n{number}.0\n{number}.1\n"
+    assert target.getvalue() == "outside\n"
+
+
+def test_output_lines_keep_the_last_progress_update():
+    assert output_lines("10%\r50%\r100%\ndone\n") == ["100%", "done"]
+    assert output_lines("") == []
+
+
+def test_parallel_cell_keeps_each_infrastructure_in_order(magics, capsys):
+    runs = []
+    lock = threading.Lock()
+
+    def apricot(line):
+        _, inf_id, step = line.split()
+        time.sleep(random.uniform(0, 0.02))
+        with lock:
+            runs.append((inf_id, int(step)))
+        print(f"{inf_id} step {step}")
+        return "Done"
+
+    magics.apricot = apricot
+    cell = "\n".join(f"exec inf-{inf} {step}" for step in range(5) for inf in range(3))
+    assert magics.run_cell_parallel(cell, 3) == "Done"
+
+    for inf in range(3):
+        assert [step for inf_id, step in runs if inf_id == f"inf-{inf}"] == list(range(5))
+
+    # Output is printed in cell order, prefixed with the line number.
+    printed = [line for line in capsys.readouterr().out.splitlines() if line.startswith("[")]
+    assert printed[:3] == ["[1] inf-0 step 0", "[2] inf-1 step 0", "[3] inf-2 step 0"]
+    assert len(printed) == 15
+
+
+def test_parallel_cell_stops_after_a_failure(magics, capsys):
+    ran = []
+
+    def apricot(line):
+        ran.append(line)
+        return "Failed" if line == "exec inf-1 fail" else "Done"
+
+    magics.apricot = apricot
+    cell = "exec inf-1 fail\nexec inf-1 after\nexec inf-2 other\nbarrier\nexec inf-2 later"
+    assert magics.run_cell_parallel(cell, 2) == "Fail on line: 'exec inf-1 fail'"
+    assert "exec inf-1 after" not in ran
+    assert "exec inf-2 later" not in ran
+    assert "Skipped" in capsys.readouterr().out
@@ -0,0 +1,113 @@
+import contextvars
+import threading
+import time
+
+from apricot_magics.concurrency import RateLimiter, fan_out, map_ordered
+
+request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def slow_square(item):
+    # Later items finish first, so ordering comes from fan_out, not from timing.
+    time.sleep(0.05 * (5 - item))
+    return item * item
+
+
+def test_results_keep_the_order_of_the_items():
+    results = fan_out(slow_square, range(5), max_workers=5)
+    assert results == [(item, item * item, None) for item in range(5)]
+
+
+def test_exceptions_stay_with_their_item():
+    def check(item):
+        if item == 2:
+            raise ValueError("bad item")
+        return item
+
+    results = fan_out(check, range(4))
+    assert [result for _, result, _ in results] == [0, 1, None, 3]
+    assert isinstance(results[2][2], ValueError)
+    assert sum(error is not None for _, _, error in results) == 1
+
+
+def test_timeout_returns_partial_results():
+    release = threading.Event()
+
+    def call(item):
+        if item == "slow":
+            release.wait(5)
+        return item
+
+    start = time.monotonic()
+    results = fan_out(call, ["a", "slow", "b"], timeout=0.2)
+    release.set()
+    assert time.monotonic() - start < 2
+    assert results[0] == ("a", "a", None)
+    assert results[2] == ("b", "b", None)
+    assert results[1][:2] == ("slow", None)
+    assert isinstance(results[1][2], TimeoutError)
+
+
+def test_progress_is_reported():
+    calls = []
+    fan_out(lambda item: time.sleep(0.2), [1], progress=lambda: calls.append(1),
+            progress_interval=0.05)
+    assert len(calls) >= 2
+
+
+def test_context_variables_follow_the_calls():
+    request_id.set("req-1")
+    assert {result for _, result, _ in fan_out(lambda item: request_id.get(), range(4))} == {
+        "req-1"
+    }
+    assert [result for _, result, _ in map_ordered(lambda item: request_id.get(), range(3))] == [
+        "req-1"
+    ] * 3
+
+
+def test_map_ordered_yields_in_order_with_a_bounded_window():
+    started = []
+
+    def call(item):
+        started.append(item)
+        return slow_square(item)
+
+    results = map_ordered(call, range(5), max_workers=2)
+    assert next(results) == (0, 0, None)
+    # Only the window ahead of the yielded item has been started.
+    assert len(started) <= 3
+    assert list(results) == [(item, item * item, None) for item in range(1, 5)]
+
+
+def test_map_ordered_keeps_errors_per_item():
+    def call(item):
+        if item == 1:
+            raise KeyError(item)
+        return item
+
+    results = list(map_ordered(call, range(3)))
+    assert [result for _, result, _ in results] == [0, None, 2]
+    assert isinstance(results[1][2], KeyError)
+
+
+def test_rate_limiter_spaces_out_calls():
+    limiter = RateLimiter(20)
+    times = []
+
+    def call(item):
+        limiter.acquire()
+        times.append(time.monotonic())
+
+    fan_out(call, range(6), max_workers=6)
+    times.sort()
+    gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+    assert min(gaps) >= 0.04
+    assert times[-1] - times[0] >= 0.24
+
+
+def test_rate_limiter_without_rate_does_not_wait():
+    limiter = RateLimiter(0)
+    start = time.monotonic()
+    for _ in range(100):
+        limiter.acquire()
+    assert time.monotonic() - start < 0.1
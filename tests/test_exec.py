@@ -0,0 +1,173 @@
+import sys
+import time
+
+import pytest
+
+from apricot_magics.apricot_magics import STREAM_CHUNK_SIZE, select_vm_ids
+
+INF_ID = "inf-00000"
+VM_IDS = ["0", "1", "2", "3", "10"]
+
+
+@pytest.fixture
+def infrastructure(mock_im):
+    """One infrastructure of 4 VMs: a front-end (VM 0) and three `wn` nodes."""
+    mock_im.reset(infrastructures=1, vms=4)
+    return INF_ID
+
+
+@pytest.fixture
+def commands(magics, monkeypatch):
+    """Record the commands run on each VM instead of opening SSH connections."""
+    calls = []
+
+    def run_remote_command(inf_id, vm_id, command):
+        calls.append((vm_id, command))
+        if vm_id == "2":
+            return 1, "", "no such file\n"
+        return 0, f"host-{vm_id}\n", ""
+
+    monkeypatch.setattr(magics, "run_remote_command", run_remote_command)
+    return calls
+
+
+@pytest.mark.parametrize("selector, selected", [
+    ("all", VM_IDS),
+    ("1", ["1"]),
+    ("3,1", ["1", "3"]),
+    ("0,2-3", ["0", "2", "3"]),
+    ("1-3, 10", ["1", "2", "3", "10"]),
+    ("01", ["1"]),
+    ("4-9", []),
+])
+def test_select_vm_ids(selector, selected):
+    assert select_vm_ids(selector, VM_IDS) == selected
+
+
+@pytest.mark.parametrize("selector", ["a", "1-b", "1,,x"])
+def test_select_vm_ids_rejects_invalid_selectors(selector):
+    with pytest.raises(ValueError):
+        select_vm_ids(selector, VM_IDS)
+
+
+def test_resolve_vm_selector(magics, infrastructure, mock_im):
+    calls = mock_im.calls
+    # Plain IDs need no IM call.
+    assert magics.resolve_vm_selector(infrastructure, "3,1") == ["3", "1"]
+    assert mock_im.calls == calls
+
+    assert magics.resolve_vm_selector(infrastructure, "all") == ["0", "1", "2", "3"]
+    assert magics.resolve_vm_selector(infrastructure, "1-2") == ["1", "2"]
+    assert magics.resolve_vm_selector(infrastructure, "role:wn") == ["1", "2", "3"]
+    assert magics.resolve_vm_selector(infrastructure, "role:front") == ["0"]
+    assert magics.resolve_vm_selector(infrastructure, "role:other") == []
+
+
+def test_exec_on_several_vms(magics, infrastructure, commands, capsys):
+    assert magics.apricot(f"exec {infrastructure} --vm 0,1,3 hostname") is None
+    out = capsys.readouterr().out
+    assert sorted(commands) == [("0", ["hostname"]), ("1", ["hostname"]), ("3", ["hostname"])]
+    # Output comes back in VM order, each line tagged with its VM.
+    lines = [line for line in out.splitlines() if ": host-" in line]
+    assert [line.split()[0] for line in lines] == ["0", "1", "3"]
+    assert "host-3" in lines[2]
+
+
+def test_exec_fails_if_any_vm_fails(magics, infrastructure, commands, capsys):
+    assert magics.apricot(f"exec {infrastructure} --vm role:wn ls /missing") == "Failed"
+    out = capsys.readouterr().out
+    assert len(commands) == 3
+    assert "2 (" in out and "no such file" in out
+    assert "Exit code" in out
+
+
+def test_exec_without_matching_vms(magics, infrastructure, commands, capsys):
+    assert magics.apricot(f"exec {infrastructure} --vm role:db hostname") == "Failed"
+    assert "No VM matches 'role:db'" in capsys.readouterr().out
+    assert commands == []
+
+
+class Recorder:
+    """A text stream recording each write and when it happened."""
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, text):
+        self.writes.append((time.monotonic(), text))
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return "".join(text for _, text in self.writes)
+
+
+class LocalConnection:
+    """Runs "remote" commands in a local shell."""
+
+    inf_id = INF_ID
+
+    def __init__(self):
+        self.ttys = []
+
+    def ssh_command(self, remote_command, tty=False):
+        self.ttys.append(tty)
+        return ["sh", "-c", " ".join(remote_command)]
+
+
+def capture(monkeypatch):
+    # Called from the test itself: pytest restores its own capture before the call phase.
+    stdout, stderr = Recorder(), Recorder()
+    monkeypatch.setattr(sys, "stdout", stdout)
+    monkeypatch.setattr(sys, "stderr", stderr)
+    return stdout, stderr
+
+
+def test_stream_forwards_output_as_it_arrives(magics, monkeypatch):
+    stdout, stderr = capture(monkeypatch)
+    exit_code = magics.stream_command(
+        ["sh", "-c", "echo first; echo oops >&2; sleep 0.5; echo second; exit 3"]
+    )
+    assert exit_code == 3
+    assert stdout.getvalue() == "first\nsecond\n"
+    assert stderr.getvalue() == "oops\n"
+    # The first line was shown before the command finished.
+    assert stdout.writes[-1][0] - stdout.writes[0][0] >= 0.4
+
+
+def test_stream_reads_bounded_chunks(magics, monkeypatch):
+    stdout, _ = capture(monkeypatch)
+    size = 5 * STREAM_CHUNK_SIZE
+    assert magics.stream_command(["sh", "-c", f"head -c {size} /dev/zero | tr '\\0' a"]) == 0
+    assert len(stdout.getvalue()) == size
+    assert max(len(text) for _, text in stdout.writes) <= STREAM_CHUNK_SIZE
+
+
+def test_stream_tees_the_raw_output(magics, monkeypatch, tmp_path):
+    stdout, _ = capture(monkeypatch)
+    tee = tmp_path / "output.log"
+    tee.write_bytes(b"earlier\n")
+    magics.stream_command(["sh", "-c", "printf 'one\\r\\ntwo\\r\\n'"], str(tee))
+    assert stdout.getvalue() == "one\ntwo\n"
+    assert tee.read_bytes() == b"earlier\none\r\ntwo\r\n"
+
+
+def test_exec_stream_uses_a_tty(magics, infrastructure, monkeypatch, tmp_path):
+    stdout, _ = capture(monkeypatch)
+    connection = LocalConnection()
+    monkeypatch.setattr(magics, "get_ssh_connection", lambda inf_id, vm_id: connection)
+    tee = tmp_path / "exec.log"
+
+    result = magics.apricot(f"exec {infrastructure} --vm 1 --stream --tee {tee} echo streamed")
+    assert result is None
+    assert connection.ttys == [True]
+    assert "streamed\n" in stdout.getvalue()
+    assert tee.read_text() == "streamed\n"
+
+
+def test_exec_stream_needs_a_single_vm(magics, infrastructure, commands, monkeypatch):
+    stdout, _ = capture(monkeypatch)
+    assert magics.apricot(f"exec {infrastructure} --vm 1,2 --stream hostname") == "Fail"
+    assert "--stream can only be used with a single VM" in stdout.getvalue()
+    assert commands == []
@@ -0,0 +1,33 @@
+import pytest
+
+from apricot.handlers import IMService
+
+RECIPE = "system node (cpu.count >= 1) deploy node 1"
+
+
+@pytest.fixture
+def service(tmp_path, mock_im):
+    (tmp_path / "authfile").write_text("id = im; type = InfrastructureManager; token = x\n")
+    service = IMService(endpoints=[mock_im.url()], state_dir=tmp_path)
+    yield service
+    service.tokens.close()
+
+
+def test_create_records_the_infrastructure(service, mock_im):
+    record = service.create(RECIPE, "radl", record={"name": "cluster", "type": "OpenStack"})
+    inf_id = record["infrastructureID"]
+    assert inf_id in mock_im.infrastructures
+    assert record["imEndpoint"] == mock_im.url()
+
+    stored = service.store.get(inf_id)
+    assert stored["name"] == "cluster"
+    assert stored["type"] == "OpenStack"
+    assert stored["imEndpoint"] == mock_im.url()
+    assert [item["infrastructureID"] for item in service.list_infrastructures()] == [inf_id]
+
+
+def test_destroy_removes_the_record(service, mock_im):
+    inf_id = service.create(RECIPE, "radl")["infrastructureID"]
+    service.destroy(inf_id)
+    assert inf_id not in mock_im.infrastructures
+    assert service.store.get(inf_id) is None
@@ -0,0 +1,90 @@
+import pytest
+
+INF_ID = "inf-00000"
+
+
+@pytest.fixture
+def infrastructure(mock_im):
+    """One infrastructure of 5 VMs: a front-end (VM 0) and four `wn` nodes."""
+    mock_im.reset(infrastructures=1, vms=5)
+    return INF_ID
+
+
+def vm_ids_of(radl_output):
+    return [line for line in radl_output.splitlines() if line.isdigit()]
+
+
+def test_radl_pages(magics, infrastructure, capsys):
+    magics.apricot_radl(f"{infrastructure} --page-size 2")
+    out = capsys.readouterr().out
+    assert vm_ids_of(out) == ["0", "1"]
+    assert "VMs 1-2 of 5. Use `--page 2` for more." in out
+
+    magics.apricot_radl(f"{infrastructure} --page-size 2 --page 3")
+    out = capsys.readouterr().out
+    assert vm_ids_of(out) == ["4"]
+    assert "VMs 5-5 of 5." in out
+    assert "--page 4" not in out
+
+    magics.apricot_radl(f"{infrastructure} --page-size 2 --page 4")
+    assert "No VMs on page 4; 5 VM(s) selected." in capsys.readouterr().out
+
+
+def test_only_the_page_is_fetched(magics, infrastructure, mock_im, capsys):
+    magics.apricot_radl(infrastructure)
+    capsys.readouterr()
+    calls = mock_im.calls
+
+    # A partial answer is not cached, so the next call asks the IM again.
+    magics.apricot_radl(f"{infrastructure} --refresh --page-size 1")
+    assert vm_ids_of(capsys.readouterr().out) == ["0"]
+    # The VM list and a single VM.
+    assert mock_im.calls - calls == 2
+
+
+def test_settled_answers_are_served_from_the_cache(magics, infrastructure, mock_im, capsys):
+    magics.apricot_radl(infrastructure)
+    assert vm_ids_of(capsys.readouterr().out) == ["0", "1", "2", "3", "4"]
+    calls = mock_im.calls
+
+    magics.apricot_radl(f"{infrastructure} --vm 1-2,4")
+    assert vm_ids_of(capsys.readouterr().out) == ["1", "2", "4"]
+    magics.apricot_info(f"{infrastructure} --vm role:wn --page-size 3")
+    out = capsys.readouterr().out
+    assert "VMs 1-3 of 4." in out
+    assert mock_im.calls == calls
+
+
+def test_vm_selector(magics, infrastructure, capsys):
+    magics.apricot_radl(f"{infrastructure} --vm 3,0-1")
+    assert vm_ids_of(capsys.readouterr().out) == ["0", "1", "3"]
+
+
+def test_property_filter(magics, infrastructure, capsys):
+    magics.apricot_radl(f"{infrastructure} --vm 0,1 --prop provider.type --prop cpu.count")
+    assert capsys.readouterr().out.splitlines() == [
+        "0: provider.type = OpenStack",
+        "0: cpu.count = 2",
+        "1: provider.type = OpenStack",
+        "1: cpu.count = 2",
+    ]
+
+
+def test_property_patterns(magics, infrastructure, capsys):
+    magics.apricot_radl(f"{infrastructure} --vm 0 --prop net_interface.*.ip")
+    assert capsys.readouterr().out.splitlines() == [
+        "0: net_interface.0.ip = 10.0.0.0",
+        "0: net_interface.1.ip = 192.0.0.0",
+    ]
+
+    magics.apricot_info(f"{infrastructure} --vm 1 --prop memory.size")
+    out = capsys.readouterr().out
+    assert "memory.size" in out
+    assert "4096m" in out
+    assert "OpenStack" not in out
+
+
+@pytest.mark.parametrize("options", ["--page 0", "--page-size -1", "--page x"])
+def test_invalid_paging_options(magics, infrastructure, options, capsys):
+    assert magics.apricot_info(f"{infrastructure} {options}") == "Failed"
+    assert "Usage" in capsys.readouterr().out
@@ -0,0 +1,60 @@
+import re
+
+from apricot_magics.logs import ANCHOR_SIZE, RESTART_NOTICE, LogCursor
+
+
+def test_only_new_lines_are_returned():
+    cursor = LogCursor()
+    assert cursor.feed("one\ntwo\n") == ["one", "two"]
+    assert cursor.feed("one\ntwo\n") == []
+    assert cursor.feed("one\ntwo\nthree\n") == ["three"]
+
+
+def test_partial_lines_wait_until_complete_or_final():
+    cursor = LogCursor()
+    assert cursor.feed("one\ntw") == ["one"]
+    assert cursor.feed("one\ntwo\nthr") == ["two"]
+    assert cursor.feed("one\ntwo\nthree", final=True) == ["three"]
+    assert cursor.feed("one\ntwo\nthree", final=True) == []
+
+
+def test_empty_log():
+    cursor = LogCursor()
+    assert cursor.feed("") == []
+    assert cursor.feed("", final=True) == []
+    assert cursor.offset == 0
+    assert cursor.feed("first\n") == ["first"]
+
+
+def test_pattern_filters_new_lines():
+    cursor = LogCursor(r"ERROR")
+    assert cursor.feed("ok\nERROR one\n") == ["ERROR one"]
+    assert cursor.feed("ok\nERROR one\nok again\nERROR two\n") == ["ERROR two"]
+
+    compiled = LogCursor(re.compile(r"^task", re.IGNORECASE))
+    assert compiled.feed("TASK [a]\nskipping\n") == ["TASK [a]"]
+
+
+def test_truncated_log_restarts_from_the_beginning():
+    cursor = LogCursor()
+    cursor.feed("one\ntwo\nthree\n")
+    # The log is shorter than the offset already read.
+    assert cursor.feed("new\n") == [RESTART_NOTICE, "new"]
+    assert cursor.feed("new\nmore\n") == ["more"]
+
+
+def test_rewritten_log_of_the_same_length_restarts():
+    cursor = LogCursor()
+    cursor.feed("aaaa\nbbbb\n")
+    assert cursor.feed("cccc\ndddd\neeee\n") == [RESTART_NOTICE, "cccc", "dddd", "eeee"]
+
+
+def test_only_the_anchor_is_compared():
+    cursor = LogCursor()
+    head = "x" * 200 + "\n"
+    cursor.feed(head + "tail\n")
+    assert len(cursor.anchor) == ANCHOR_SIZE
+
+    # Text before the anchor may change without restarting.
+    changed = "y" + head[1:] + "tail\n"
+    assert cursor.feed(changed + "next\n") == ["next"]
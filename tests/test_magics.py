@@ -0,0 +1,78 @@
+RECIPE = (
+    "network public (outbound = 'yes') "
+    "system node (cpu.count >= 1 and net_interface.0.connection = 'public') "
+    "deploy node 2"
+)
+
+
+def create(magics, capsys):
+    magics.apricot_create(RECIPE)
+    out = capsys.readouterr().out
+    assert "successfully created" in out
+    return out.split("ID ")[1].split()[0]
+
+
+def test_create_and_list(magics, mock_im, capsys):
+    inf_id = create(magics, capsys)
+    assert inf_id in mock_im.infrastructures
+    assert magics.store.get(inf_id) is not None
+
+    magics.apricot_ls("")
+    out = capsys.readouterr().out
+    assert inf_id in out
+    assert "configured" in out
+
+
+def test_info_and_radl(magics, capsys):
+    inf_id = create(magics, capsys)
+
+    magics.apricot_info(inf_id)
+    out = capsys.readouterr().out
+    assert "OpenStack" in out
+    assert "10.0.0.1" in out
+    # Memory is shown in megabytes as the IM writes it; disks in the largest unit.
+    assert "4096m" in out
+    assert "20g" in out
+
+    magics.apricot_radl(f"{inf_id} --vm 1 --prop cpu.count")
+    assert capsys.readouterr().out.strip() == "1: cpu.count = 2"
+
+
+def test_invalid_recipe_is_not_submitted(magics, mock_im, capsys):
+    calls = mock_im.calls
+    assert magics.apricot_create("system node (cpu.count >= 1) deploy other 1") == "Failed"
+    assert "refers to an undefined system" in capsys.readouterr().out
+    assert mock_im.calls == calls
+    assert mock_im.infrastructures == {}
+
+
+def test_radl_the_parser_skips_is_still_submitted(magics, mock_im, capsys):
+    magics.apricot_create(
+        "system node (cpu.count > 1 and soft 10 (memory.size >= 2g) and "
+        "disk.0.image.url = ['one://a/1', 'one://b/2']) deploy node 1"
+    )
+    assert "successfully created" in capsys.readouterr().out
+    assert len(mock_im.infrastructures) == 1
+
+
+def test_destroy(magics, mock_im, capsys):
+    inf_id = create(magics, capsys)
+    magics.apricot_destroy(inf_id)
+    assert "successfully destroyed" in capsys.readouterr().out
+    assert inf_id not in mock_im.infrastructures
+    assert magics.store.get(inf_id) is None
+
+
+def test_unknown_infrastructure(magics, capsys):
+    magics.apricot_info("inf-missing")
+    assert "Error" in capsys.readouterr().out
+
+
+def test_only_settled_statuses_are_cached(magics, monkeypatch, capsys):
+    inf_id = create(magics, capsys)
+    assert magics.fetch_infrastructure_status(inf_id)[0] == "configured"
+    assert magics.cache.get("status", inf_id)[0][0] == "configured"
+
+    monkeypatch.setattr("benchmarks.mock_im.VM_STATE", "running")
+    assert magics.fetch_infrastructure_status(inf_id)[0] == "running"
+    assert magics.cache.get("status", inf_id) is None
@@ -0,0 +1,99 @@
+import pytest
+
+from apricot_magics.radl import (
+    MEMORY_UNITS, RADLSyntaxError, format_property, format_size, parse_radl, parse_vm_info,
+    vm_address,
+)
+
+RECIPE = """
+network public (outbound = 'yes')
+network private ()
+system node (
+    cpu.count >= 2 and
+    memory.size >= 4g and
+    net_interface.0.connection = 'public' and
+    net_interface.0.ip = '10.0.0.1' and
+    disk.0.os.credentials.username = 'cloudadm'
+)
+deploy node 2
+"""
+
+
+def test_parse_document():
+    document = parse_radl(RECIPE)
+    assert set(document.networks) == {"public", "private"}
+    assert document.systems["node"]["cpu.count"] == 2
+    assert document.systems["node"]["memory.size"] == 4 * 1024**3
+    assert document.deploys == [("node", 2, None)]
+    assert document.skipped == []
+
+
+def test_list_values():
+    document = parse_radl(
+        "system node ( disk.0.image.url = ['one://a/1', 'one://b/2'] and cpu.count = 1 )"
+    )
+    assert document.systems["node"]["disk.0.image.url"] == ["one://a/1", "one://b/2"]
+    assert document.systems["node"]["cpu.count"] == 1
+
+
+def test_soft_block_does_not_override_hard_values():
+    document = parse_radl(
+        "system node ( memory.size = 1g and soft 10 ( memory.size >= 2g and gpu.count >= 1 ) )"
+    )
+    assert document.systems["node"]["memory.size"] == 1024**3
+    assert document.systems["node"]["gpu.count"] == 1
+
+
+@pytest.mark.parametrize("operator", [">", "<", ">=", "<=", "="])
+def test_comparison_operators(operator):
+    document = parse_radl(f"system node ( cpu.count {operator} 1 )")
+    assert document.systems["node"]["cpu.count"] == 1
+
+
+def test_contains():
+    document = parse_radl(
+        "system node ( disk.0.applications contains (name = 'ansible.modules.grycap.slurm') )"
+    )
+    assert document.systems["node"]["disk.0.applications"] == [
+        {"name": "ansible.modules.grycap.slurm"}
+    ]
+
+
+def test_unknown_constructs_are_skipped():
+    document = parse_radl(
+        "system node ( cpu.count = 1 and weird { thing } (x) and memory.size = 1g )\n"
+        "frobnicate foo ( bar = 1 )\n"
+        "deploy node 1"
+    )
+    assert document.systems["node"] == {"cpu.count": 1, "memory.size": 1024**3}
+    assert document.deploys == [("node", 1, None)]
+    assert len(document.skipped) == 2
+
+
+def test_unbalanced_document_raises():
+    with pytest.raises(RADLSyntaxError):
+        parse_radl("system node ( cpu.count = 1")
+
+
+def test_vm_info_with_lists_and_soft_blocks():
+    vm_info = parse_vm_info(
+        0,
+        "network public (outbound = 'yes')\n"
+        "system node ( state = 'running' and cpu.count > 1 and "
+        "disk.0.image.url = ['one://a/1', 'one://b/2'] and "
+        "soft 10 ( memory.size >= 2g ) and "
+        "net_interface.0.connection = 'public' and net_interface.0.ip = '1.2.3.4' )",
+    )
+    assert vm_info.state == "running"
+    assert vm_info.memory_size == 2 * 1024**3
+    assert vm_info.disks[0].image == ["one://a/1", "one://b/2"]
+    assert vm_address(vm_info) == ("1.2.3.4", True)
+
+
+def test_sizes_are_formatted_as_radl_writes_them():
+    assert format_size(20 * 1024**3) == "20g"
+    assert format_size(1536 * 1024**2) == "1536m"
+    assert format_size(None) == "N/A"
+    assert format_size(4 * 1024**3, MEMORY_UNITS) == "4096m"
+    assert format_property("memory.size", 4 * 1024**3) == "4096m"
+    assert format_property("disk.0.size", 20 * 1024**3) == "20g"
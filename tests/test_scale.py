@@ -0,0 +1,85 @@
+from apricot_magics.scale import Autoscaler, QueueState, ScalePolicy, parse_queue, plan_scaling
+
+POLICY = ScalePolicy(min_workers=1, max_workers=5, jobs_per_worker=2, up_cooldown=100,
+                     down_cooldown=200, idle_time=50)
+
+
+def workers(count):
+    return {str(index): f"node{index}" for index in range(count)}
+
+
+def plan(queue, count, idle_since=None, now=1000, last_up=float("-inf"), last_down=float("-inf")):
+    return plan_scaling(POLICY, queue, workers(count), idle_since or {}, now, last_up, last_down)
+
+
+def test_grows_to_the_pending_jobs_on_top_of_busy_workers():
+    # Two busy workers and five pending jobs need three more.
+    assert plan(QueueState(5, set()), 2) == (3, [])
+
+
+def test_idle_workers_absorb_pending_jobs():
+    assert plan(QueueState(2, {"node1"}), 2) == (0, [])
+    assert plan(QueueState(4, {"node1"}), 2) == (1, [])
+
+
+def test_growth_is_capped_by_max_workers():
+    assert plan(QueueState(100, set()), 4) == (1, [])
+    assert plan(QueueState(100, set()), 5) == (0, [])
+
+
+def test_growth_waits_for_the_cooldown():
+    assert plan(QueueState(5, set()), 2, last_up=950) == (0, [])
+
+
+def test_brought_up_to_min_workers():
+    assert plan(QueueState(0, set()), 0) == (1, [])
+
+
+def test_idle_workers_are_removed_highest_first():
+    idle_since = {"node1": 900, "node2": 900, "node3": 990}
+    assert plan(QueueState(0, {"node1", "node2", "node3"}), 4, idle_since) == (0, ["2", "1"])
+
+
+def test_parse_queue():
+    assert parse_queue("3\n#idle\nnode1\nnode2\n") == QueueState(3, {"node1", "node2"})
+    assert parse_queue("") == QueueState(0, set())
+
+
+class Cluster:
+    def __init__(self, count):
+        self.workers = workers(count)
+        self.queue = QueueState(0, set())
+        self.calls = []
+
+    def scale(self, add, remove):
+        self.calls.append((add, remove))
+        for vm_id in remove:
+            del self.workers[vm_id]
+        for index in range(len(self.workers), len(self.workers) + add):
+            self.workers[str(index)] = f"node{index}"
+
+
+def test_autoscaler_step_with_a_fake_clock():
+    cluster = Cluster(1)
+    now = [0.0]
+    autoscaler = Autoscaler(POLICY, lambda: cluster.queue, lambda: dict(cluster.workers),
+                            cluster.scale, clock=lambda: now[0])
+
+    cluster.queue = QueueState(6, set())
+    assert autoscaler.step() == (3, [])
+    assert len(cluster.workers) == 4
+
+    # The new workers are still booting: nothing more until the cooldown has passed.
+    now[0] = 50
+    assert autoscaler.step() == (0, [])
+    now[0] = 150
+    assert autoscaler.step() == (1, [])
+
+    # Queue drained: workers are removed once idle for idle_time and past both cooldowns.
+    cluster.queue = QueueState(0, {"node3", "node4"})
+    now[0] = 200
+    assert autoscaler.step() == (0, [])
+    now[0] = 300
+    assert autoscaler.step() == (0, ["4", "3"])
+    assert cluster.calls == [(3, []), (1, []), (0, ["4", "3"])]
+    assert len(autoscaler.events) == 3
@@ -0,0 +1,118 @@
+import inspect
+
+import pytest
+from imclient import IMClient
+
+from apricot_magics.session import IMSessionPool
+from apricot_magics.stats import InstrumentedClient
+from benchmarks.mock_im import MockIM
+
+RECIPE = "system node (cpu.count >= 1) deploy node 1"
+
+
+@pytest.fixture
+def mock_ims():
+    # The first IM starts empty; the second already has inf-00000 to inf-00099.
+    mocks = [MockIM(infrastructures=0), MockIM(infrastructures=100)]
+    for mock in mocks:
+        mock.start()
+    yield mocks
+    for mock in mocks:
+        mock.stop()
+
+
+@pytest.fixture
+def authfile(tmp_path):
+    path = tmp_path / "authfile"
+    path.write_text("id = im; type = InfrastructureManager; token = x\n")
+    return path
+
+
+def make_pool(mock_ims, authfile, **kwargs):
+    return IMSessionPool([mock.url() for mock in mock_ims], str(authfile), **kwargs)
+
+
+def test_infrastructure_methods_exist_on_the_client():
+    methods = {name for name, _ in inspect.getmembers(IMClient, inspect.isfunction)}
+    assert InstrumentedClient.INFRASTRUCTURE_METHODS <= methods
+
+
+def test_calls_go_to_the_endpoint_of_the_infrastructure(mock_ims, authfile):
+    first, second = mock_ims
+    pool = make_pool(mock_ims, authfile)
+    pool.bind("inf-00099", second.url())
+
+    success, state = pool.client.get_infra_property("inf-00099", "state")
+    assert success and state["state"] == "configured"
+    assert (first.calls, second.calls) == (0, 1)
+
+    # Unknown infrastructures go to the default endpoint.
+    success, _ = pool.client.get_infra_property("inf-00007", "state")
+    assert not success
+    assert (first.calls, second.calls) == (1, 1)
+
+    pool.client.start_infra("inf-00099")
+    pool.client.stop_infra("inf-00099")
+    assert (first.calls, second.calls) == (1, 3)
+
+
+def test_create_on_a_named_endpoint_binds_the_infrastructure(mock_ims, authfile):
+    first, second = mock_ims
+    pool = make_pool(mock_ims, authfile)
+
+    success, inf_id = pool.client.create(RECIPE, "radl", endpoint=second.url() + "/")
+    assert success
+    assert inf_id in second.infrastructures
+    assert pool.endpoint_of(inf_id) == second.url()
+
+    pool.client.destroy(inf_id)
+    assert inf_id not in second.infrastructures
+    assert first.calls == 0
+
+
+def test_endpoints_are_looked_up_once(mock_ims, authfile):
+    lookups = []
+
+    def lookup(inf_id):
+        lookups.append(inf_id)
+        return mock_ims[1].url()
+
+    pool = make_pool(mock_ims, authfile, lookup=lookup)
+    assert pool.endpoint_of("inf-00099") == mock_ims[1].url()
+    assert pool.endpoint_of("inf-00099") == mock_ims[1].url()
+    assert lookups == ["inf-00099"]
+
+    pool.forget("inf-00099")
+    pool.endpoint_of("inf-00099")
+    assert lookups == ["inf-00099", "inf-00099"]
+
+
+def test_round_robin_spreads_new_infrastructures(mock_ims, authfile):
+    pool = make_pool(mock_ims, authfile)
+
+    created = [pool.client.create(RECIPE, "radl")[1] for _ in range(4)]
+    assert [pool.endpoint_of(inf_id) for inf_id in created] == [
+        mock.url() for mock in mock_ims * 2
+    ]
+    assert [len(mock.infrastructures) for mock in mock_ims] == [2, 102]
+
+
+def test_latency_policy_picks_the_fastest_endpoint(mock_ims, authfile):
+    first, second = mock_ims
+    first.latency = 0.2
+    pool = make_pool(mock_ims, authfile, policy="latency")
+
+    success, inf_id = pool.client.create(RECIPE, "radl")
+    assert success
+    assert pool.endpoint_of(inf_id) == second.url()
+    # Both endpoints were probed first.
+    assert set(pool.latencies) == {first.url(), second.url()}
+
+    # An endpoint that stops answering is avoided.
+    pool.observe(second.url(), float("inf"))
+    assert pool.choose() == first.url()
+
+
+def test_unknown_policy_is_rejected(mock_ims, authfile):
+    with pytest.raises(ValueError):
+        make_pool(mock_ims, authfile, policy="random")
@@ -0,0 +1,44 @@
+from apricot_magics.slurm import Job, SlurmTracker, parse_poll
+
+POLL_OUTPUT = """\
+12|train|RUNNING|1:02|wn1|None
+13_[2-4]|sweep|PENDING|0:00||Resources
+#sacct
+11|prepare|COMPLETED|0:00|00:10|wn1
+12|train|RUNNING|0:0|00:01|wn1
+14|broken|CANCELLED by 1000|1:0|00:00|
+"""
+
+
+def test_parse_poll():
+    jobs = parse_poll("inf-1", POLL_OUTPUT)
+    assert jobs["12"] == Job("inf-1", "12", "train", "RUNNING", None, "1:02", "wn1", "")
+    assert jobs["13_[2-4]"].reason == "Resources"
+    assert jobs["11"] == Job("inf-1", "11", "prepare", "COMPLETED", 0, "00:10", "wn1", "")
+    assert jobs["14"].state == "CANCELLED"
+    assert jobs["14"].exit_code == 1
+
+
+def test_parse_poll_ignores_noise():
+    assert parse_poll("inf-1", "squeue: error: Invalid job id\n#sacct\n") == {}
+
+
+def test_poll_updates_tracked_jobs_with_one_call_per_cluster():
+    commands = []
+
+    def run_command(inf_id, command):
+        commands.append((inf_id, command))
+        return 0, "#sacct\n7|job|COMPLETED|0:0|00:05|wn1\n8|job|FAILED|2:0|00:01|wn2\n", ""
+
+    tracker = SlurmTracker(run_command)
+    tracker.track("inf-1", "7", "a.sh")
+    tracker.track("inf-1", "8", "b.sh")
+
+    changed, errors = tracker.poll()
+    assert (changed, errors) == (2, {})
+    assert len(commands) == 1
+    assert {job.job_id: job.state for job in tracker.get()} == {"7": "COMPLETED", "8": "FAILED"}
+
+    # Settled jobs are not asked about again.
+    assert tracker.poll() == (0, {})
+    assert len(commands) == 1
@@ -0,0 +1,125 @@
+import json
+import os
+import stat
+import sys
+
+import pytest
+
+from apricot_magics.ssh import SSHConnection, SSHConnectionManager
+
+# Stands in for the OpenSSH client: logs its arguments, creates the control
+# socket when asked to start a master and removes it on `-O exit`.
+FAKE_SSH = """#!{python}
+import json, os, sys
+args = sys.argv[1:]
+with open({log!r}, "a") as log:
+    log.write(json.dumps(args) + "\\n")
+control_path = next(arg.split("=", 1)[1] for arg in args if arg.startswith("ControlPath="))
+if "-M" in args:
+    open(control_path, "w").close()
+elif "-O" in args and os.path.exists(control_path):
+    os.remove(control_path)
+"""
+
+
+@pytest.fixture
+def ssh_calls(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log = tmp_path / "ssh.log"
+    script = bin_dir / "ssh"
+    script.write_text(FAKE_SSH.format(python=sys.executable, log=str(log)))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    def calls():
+        if not log.exists():
+            return []
+        return [json.loads(line) for line in log.read_text().splitlines()]
+
+    return calls
+
+
+@pytest.fixture
+def manager():
+    manager = SSHConnectionManager(idle_timeout=30)
+    yield manager
+    manager.close_all()
+
+
+def option(args, name):
+    return next(arg.split("=", 1)[1] for arg in args if arg.startswith(f"{name}="))
+
+
+def test_master_options(tmp_path, ssh_calls):
+    connection = SSHConnection(str(tmp_path), "vm", "cloudadm", "192.0.2.1", "KEY",
+                               idle_timeout=30)
+    command = connection.ssh_command(["hostname"])
+
+    master = ssh_calls()[0]
+    assert {"-M", "-N", "-f"} <= set(master)
+    assert option(master, "ControlMaster") == "auto"
+    assert option(master, "ControlPath") == connection.control_path
+    assert option(master, "ControlPersist") == "30"
+    assert master[-1] == "cloudadm@192.0.2.1"
+
+    assert command[0] == "ssh"
+    assert option(command, "ControlPath") == connection.control_path
+    assert command[-2:] == ["cloudadm@192.0.2.1", "hostname"]
+    assert stat.S_IMODE(os.stat(connection.key_path).st_mode) == 0o600
+
+
+def test_proxy_through_the_front_end(tmp_path, ssh_calls):
+    front = SSHConnection(str(tmp_path), "front", "cloudadm", "192.0.2.1", "KEY")
+    node = SSHConnection(str(tmp_path), "node", "cloudadm", "10.0.0.2", "KEY", proxy=front)
+    node.ssh_command(["true"])
+
+    # The front-end master is started first, then the node's through it.
+    masters = [args for args in ssh_calls() if "-M" in args]
+    assert [args[-1] for args in masters] == ["cloudadm@192.0.2.1", "cloudadm@10.0.0.2"]
+    proxy_command = option(masters[1], "ProxyCommand")
+    assert f"ControlPath={front.control_path}" in proxy_command
+    assert proxy_command.endswith("-W %h:%p cloudadm@192.0.2.1")
+
+
+def test_reuse_returns_the_same_master(manager, ssh_calls):
+    connection = manager.get("inf-1", 0, "cloudadm", "192.0.2.1", "KEY")
+    connection.ssh_command(["true"])
+    assert manager.get("inf-1", "0", "cloudadm", "192.0.2.1", "KEY") is connection
+    connection.ssh_command(["true"])
+    connection.scp_command()
+    assert sum("-M" in args for args in ssh_calls()) == 1
+
+
+def test_close_removes_the_key_and_socket(manager, ssh_calls):
+    connection = manager.get("inf-1", 0, "cloudadm", "192.0.2.1", "KEY")
+    connection.open()
+    assert os.path.exists(connection.control_path)
+
+    manager.close("inf-1")
+    assert ["-O", "exit"] == ssh_calls()[-1][2:4]
+    assert not os.path.exists(connection.key_path)
+    assert not os.path.exists(connection.control_path)
+    assert manager.connections == {}
+
+
+def test_close_removes_a_stale_socket(tmp_path, ssh_calls):
+    connection = SSHConnection(str(tmp_path), "vm", "cloudadm", "192.0.2.1", "KEY")
+    open(connection.control_path, "w").close()
+    os.chmod(tmp_path / "bin" / "ssh", 0o644)  # the exit request cannot remove it
+    connection.close()
+    assert not os.path.lexists(connection.control_path)
+
+
+@pytest.mark.parametrize(
+    "changed", [("root", "192.0.2.1", "KEY"), ("cloudadm", "192.0.2.9", "KEY"),
+                ("cloudadm", "192.0.2.1", "OTHER")]
+)
+def test_changed_credentials_replace_the_connection(manager, ssh_calls, changed):
+    connection = manager.get("inf-1", 0, "cloudadm", "192.0.2.1", "KEY")
+    connection.open()
+    replacement = manager.get("inf-1", 0, *changed)
+    assert replacement is not connection
+    # The old master was asked to exit and the key on disk is the new one.
+    assert any("-O" in args for args in ssh_calls())
+    assert open(replacement.key_path).read() == changed[2]
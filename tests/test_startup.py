@@ -0,0 +1,63 @@
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks.startup import DEFERRED_MODULES, REPO_ROOT, run_once
+
+# Loads the extension in a fresh interpreter, recording the file, directory
+# and socket operations it makes under the (empty) home directory.
+PROBE = """
+import json, os, sys
+from IPython.core.interactiveshell import InteractiveShell
+
+shell = InteractiveShell.instance()
+home = os.path.expanduser("~")
+events = []
+
+def audit(event, args):
+    if event in ("socket.connect", "socket.getaddrinfo"):
+        events.append([event, repr(args)])
+    elif event in ("open", "os.mkdir", "os.listdir", "os.scandir", "sqlite3.connect"):
+        path = args[0] if args else None
+        if isinstance(path, (str, os.PathLike)) and str(path).startswith(home):
+            if ".ipython" not in str(path):
+                events.append([event, str(path)])
+
+sys.addaudithook(audit)
+shell.run_line_magic("load_ext", "apricot_magics")
+print(json.dumps({"events": events, "magics": sorted(shell.magics_manager.magics["line"])}))
+"""
+
+
+def run_probe(home):
+    env = {
+        "HOME": str(home),
+        "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+        "PYTHONPATH": REPO_ROOT,
+    }
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        env=env,
+        # Not the home directory: the import system lists the working directory.
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_loading_does_no_disk_or_network_work(tmp_path):
+    probe = run_probe(tmp_path)
+    assert probe["events"] == []
+    assert "apricot_ls" in probe["magics"]
+    assert not (tmp_path / "apricotlab_state").exists()
+
+
+def test_loading_defers_heavy_imports():
+    run = run_once()
+    assert run["imported"] == []
+    assert not run["state_dir_created"]
+    assert set(DEFERRED_MODULES) >= {"imclient", "requests", "yaml"}
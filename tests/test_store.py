@@ -0,0 +1,109 @@
+import json
+import threading
+
+from apricot_magics.store import InfrastructureStore, LEGACY_LIST_NAME, STORE_NAME, open_store
+
+LEGACY = {
+    "refresh_token": "refresh-1",
+    "infrastructures": [
+        {"infrastructureID": "inf-1", "name": "one", "type": "OpenStack", "host": "cloud"},
+        {"infrastructureID": "inf-2", "name": "two", "custom": "true"},
+        {"name": "no id"},
+    ],
+}
+
+
+def write_legacy(state_dir, data=LEGACY):
+    state_dir.mkdir(parents=True, exist_ok=True)
+    path = state_dir / LEGACY_LIST_NAME
+    path.write_text(json.dumps(data))
+    return path
+
+
+def test_legacy_list_is_imported_once(tmp_path):
+    state_dir = tmp_path / "apricotlab_state"
+    legacy = write_legacy(state_dir)
+    content = legacy.read_text()
+
+    store = open_store(state_dir, legacy_dirs=())
+    assert [record["infrastructureID"] for record in store.list()] == ["inf-1", "inf-2"]
+    assert store.get("inf-1")["type"] == "OpenStack"
+    assert store.get_setting("refresh_token") == "refresh-1"
+    # The legacy file is left as it was, for older versions still reading it.
+    assert legacy.read_text() == content
+
+    store.remove("inf-2")
+    write_legacy(state_dir, {"infrastructures": [{"infrastructureID": "inf-3"}]})
+    store = open_store(state_dir, legacy_dirs=())
+    assert [record["infrastructureID"] for record in store.list()] == ["inf-1"]
+
+
+def test_legacy_state_is_copied_from_older_folders(tmp_path):
+    old_dir = tmp_path / "old" / "apricotlab_state"
+    write_legacy(old_dir)
+    (old_dir / "authfile").write_text("token")
+
+    store = open_store(tmp_path / "apricotlab_state", legacy_dirs=(old_dir,))
+    assert (tmp_path / "apricotlab_state" / "authfile").read_text() == "token"
+    assert len(store.list()) == 2
+
+
+def test_export_matches_the_legacy_layout(tmp_path):
+    state_dir = tmp_path / "apricotlab_state"
+    write_legacy(state_dir)
+    store = open_store(state_dir, legacy_dirs=())
+    assert store.export() == {
+        "refresh_token": "refresh-1",
+        "infrastructures": LEGACY["infrastructures"][:2],
+    }
+
+
+def test_records_keep_their_fields_and_status(tmp_path):
+    store = InfrastructureStore(tmp_path / STORE_NAME)
+    store.add({"infrastructureID": "inf-1", "name": "one", "group": "sweep", "imEndpoint": "x"})
+    store.update_status({"inf-1": ("configured", "192.0.2.1")})
+
+    record = store.get("inf-1")
+    assert record["group"] == "sweep"
+    assert record["imEndpoint"] == "x"
+    assert (record["state"], record["ip"]) == ("configured", "192.0.2.1")
+    assert store.list(group="sweep") == [record]
+    assert store.list(group="other") == []
+
+    store.add({"infrastructureID": "inf-1", "name": "renamed"})
+    assert store.get("inf-1")["name"] == "renamed"
+    assert store.remove("inf-1", "inf-missing") == 1
+
+
+def test_settings_round_trip(tmp_path):
+    store = InfrastructureStore(tmp_path / STORE_NAME)
+    assert store.get_setting("im_routing", "round-robin") == "round-robin"
+    store.set_setting("im_routing", "latency")
+    store.set_setting("im_routing", "round-robin")
+    assert InfrastructureStore(tmp_path / STORE_NAME).get_setting("im_routing") == "round-robin"
+
+
+def test_concurrent_writers(tmp_path):
+    path = tmp_path / STORE_NAME
+    stores = [InfrastructureStore(path), InfrastructureStore(path)]
+    errors = []
+
+    def write(index):
+        store = stores[index]
+        try:
+            for number in range(50):
+                store.add({"infrastructureID": f"inf-{index}-{number}"})
+                if number % 2:
+                    store.remove(f"inf-{index}-{number - 1}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    ids = {record["infrastructureID"] for record in InfrastructureStore(path).list()}
+    assert ids == {f"inf-{index}-{number}" for index in range(2) for number in range(1, 50, 2)}
@@ -0,0 +1,149 @@
+import threading
+import time
+
+import jwt
+import pytest
+
+from apricot_magics import tokens
+from apricot_magics.tokens import TokenManager, TokenRefreshError
+
+
+def make_token(seconds_left):
+    return jwt.encode({"exp": int(time.time() + seconds_left)}, "a-secret-long-enough-for-hmac-sha256", algorithm="HS256")
+
+
+@pytest.fixture
+def manager(tmp_path):
+    authfile = tmp_path / "authfile"
+    authfile.write_text(f"id = im; type = InfrastructureManager; token = {make_token(3600)}\n")
+    manager = TokenManager(authfile, lambda: "refresh-token")
+    manager.delays = []
+    manager.schedule = lambda delay=None: manager.delays.append(delay)
+    yield manager
+    manager.close()
+
+
+def fail_with(manager, error):
+    def request_token(refresh_token):
+        raise error
+
+    manager._request_token = request_token
+
+
+def test_refresh_writes_the_authfile(manager):
+    token = make_token(7200)
+    manager._request_token = lambda refresh_token: token
+    assert manager.refresh() == token
+    assert token in open(manager.authfile_path).read()
+    assert manager.seconds_left() > 3600
+    assert manager.delays == [None]
+
+
+def test_concurrent_refreshes_share_one_request(manager):
+    release = threading.Event()
+    calls = []
+
+    def request_token(refresh_token):
+        calls.append(refresh_token)
+        release.wait(5)
+        return make_token(7200)
+
+    manager._request_token = request_token
+    futures = [manager.refresh(wait=False) for _ in range(8)]
+    release.set()
+    results = {future.result(5) for future in futures}
+    assert len(calls) == 1
+    assert len(results) == 1
+    assert all(future is futures[0] for future in futures)
+
+
+
+def test_a_new_refresh_token_is_not_joined_to_the_running_refresh(manager):
+    release = threading.Event()
+    calls = []
+
+    def request_token(refresh_token):
+        calls.append(refresh_token)
+        if refresh_token == "refresh-token":
+            release.wait(5)
+        return make_token(7200 if refresh_token == "refresh-token" else 9000)
+
+    manager._request_token = request_token
+    running = manager.refresh(wait=False)
+    joined = manager.refresh("refresh-token", wait=False)
+    replaced = manager.refresh("new-refresh-token", wait=False)
+    assert joined is running
+    assert replaced is not running
+    assert manager.refresh("new-refresh-token", wait=False) is replaced
+
+    release.set()
+    running.result(5)
+    token = replaced.result(5)
+    # The new token is exchanged after the running refresh, so it is the one kept.
+    assert calls == ["refresh-token", "new-refresh-token"]
+    assert token in open(manager.authfile_path).read()
+    assert manager._inflight is None
+
+def test_transient_failures_back_off(manager, monkeypatch):
+    monkeypatch.setattr(tokens, "TOKEN_RETRY_MAX_INTERVAL", 100)
+    fail_with(manager, TokenRefreshError("timeout"))
+    for _ in range(4):
+        with pytest.raises(TokenRefreshError):
+            manager.refresh()
+    assert manager.delays == [30, 60, 100, 100]
+    assert manager.error is None
+    assert manager.pop_error() is None
+
+    manager._request_token = lambda refresh_token: make_token(7200)
+    manager.refresh()
+    fail_with(manager, TokenRefreshError("timeout"))
+    with pytest.raises(TokenRefreshError):
+        manager.refresh()
+    assert manager.delays[-1] == 30
+
+
+def test_permanent_failure_stops_retrying(manager):
+    error = TokenRefreshError("invalid_grant", permanent=True)
+    fail_with(manager, error)
+    with pytest.raises(TokenRefreshError):
+        manager.refresh()
+    assert manager.delays == []
+    assert manager.pop_error() is error
+    assert manager.pop_error() is None
+
+
+def test_ensure_fresh_does_not_retry_after_a_permanent_failure(manager):
+    calls = []
+
+    def request_token(refresh_token):
+        calls.append(refresh_token)
+        raise TokenRefreshError("invalid_grant", permanent=True)
+
+    manager._request_token = request_token
+    manager.margin = 7200
+    manager.ensure_fresh()
+    deadline = time.monotonic() + 5
+    while manager.error is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    manager.ensure_fresh()
+    manager.ensure_fresh()
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize("status, permanent", [(400, True), (401, True), (429, False), (503, False)])
+def test_status_codes(manager, status, permanent):
+    class Response:
+        status_code = status
+        text = "error"
+
+    class HTTP:
+        def post(self, *args, **kwargs):
+            return Response()
+
+        def close(self):
+            pass
+
+    manager._http = HTTP()
+    with pytest.raises(TokenRefreshError) as error:
+        manager._request_token("refresh-token")
+    assert error.value.permanent is permanent
@@ -0,0 +1,220 @@
+import os
+import shutil
+
+import pytest
+
+from apricot_magics import transfer
+from apricot_magics.transfer import (
+    ARCHIVE_MIN_FILES, BLOCK_SIZE, COMPRESSORS, SMALL_FILE_SIZE, TransferEngine, chunk_count,
+    choose_compressor, pending_chunks, prefer_archive,
+)
+
+CHUNK = BLOCK_SIZE
+
+
+class LocalConnection:
+    """Runs the "remote" side of a transfer as local shell commands."""
+
+    inf_id = None
+    host = "local"
+
+    def ssh_command(self, remote_command, tty=False):
+        return ["sh", "-c", " ".join(remote_command)]
+
+
+@pytest.fixture
+def engine():
+    return TransferEngine(max_streams=3, chunk_size=CHUNK, mode="files")
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(os.urandom(2 * CHUNK + CHUNK // 2))
+    return path
+
+
+def upload(engine, local, remote):
+    plans, _, _ = engine.plan_upload(LocalConnection(), [str(local)], str(remote))
+    _, errors = engine.transfer(plans, "upload")
+    assert errors == []
+    return plans
+
+
+def test_chunk_count():
+    assert chunk_count(0, CHUNK) == 1
+    assert chunk_count(CHUNK, CHUNK) == 1
+    assert chunk_count(CHUNK + 1, CHUNK) == 2
+
+
+def test_upload_and_download_in_chunks(engine, source, tmp_path):
+    remote = tmp_path / "remote.bin"
+    plans = upload(engine, source, remote)
+    assert plans[0].chunks == [0, 1, 2]
+    assert remote.read_bytes() == source.read_bytes()
+
+    local = tmp_path / "copy.bin"
+    plans, _, _ = engine.plan_download(LocalConnection(), [str(remote)], str(local))
+    assert plans[0].chunks == [0, 1, 2]
+    _, errors = engine.transfer(plans, "download")
+    assert errors == []
+    assert local.read_bytes() == source.read_bytes()
+
+
+def test_unchanged_chunks_are_skipped(engine, source, tmp_path):
+    remote = tmp_path / "remote.bin"
+    upload(engine, source, remote)
+
+    plans, _, _ = engine.plan_upload(LocalConnection(), [str(source)], str(remote))
+    assert plans[0].chunks == []
+
+    data = bytearray(source.read_bytes())
+    data[CHUNK + 10] ^= 0xFF
+    source.write_bytes(bytes(data))
+    assert upload(engine, source, remote)[0].chunks == [1]
+    assert remote.read_bytes() == bytes(data)
+
+
+def test_partial_upload_resumes(engine, source, tmp_path):
+    remote = tmp_path / "remote.bin"
+    remote.write_bytes(source.read_bytes()[:CHUNK + 100])
+    assert upload(engine, source, remote)[0].chunks == [1, 2]
+    assert remote.read_bytes() == source.read_bytes()
+
+
+def test_longer_remote_copy_is_truncated(engine, source, tmp_path):
+    remote = tmp_path / "remote.bin"
+    remote.write_bytes(source.read_bytes() + b"stale tail")
+    # The last chunk's remote hash covers the stale tail too.
+    assert upload(engine, source, remote)[0].chunks == [2]
+    assert remote.read_bytes() == source.read_bytes()
+
+
+def test_partial_download_resumes(engine, source, tmp_path):
+    local = tmp_path / "copy.bin"
+    local.write_bytes(source.read_bytes()[:2 * CHUNK])
+    plans, _, _ = engine.plan_download(LocalConnection(), [str(source)], str(local))
+    assert plans[0].chunks == [2]
+    engine.transfer(plans, "download")
+    assert local.read_bytes() == source.read_bytes()
+
+
+def test_pending_chunks_of_a_missing_copy(source):
+    assert pending_chunks(str(source), source.stat().st_size, -1, [], CHUNK) == [0, 1, 2]
+    assert pending_chunks(str(source), 0, -1, [], CHUNK) == []
+
+
+def test_auto_mode_thresholds():
+    assert prefer_archive(ARCHIVE_MIN_FILES, 0)
+    assert not prefer_archive(ARCHIVE_MIN_FILES - 1, 0)
+    assert prefer_archive(ARCHIVE_MIN_FILES, ARCHIVE_MIN_FILES * SMALL_FILE_SIZE - 1)
+    assert not prefer_archive(ARCHIVE_MIN_FILES, ARCHIVE_MIN_FILES * SMALL_FILE_SIZE)
+
+
+def test_select_archived_by_mode():
+    sizes = {"many": (100, 100 * 1024), "few": (2, 1024), "a.txt": (1, 10), "b.txt": (1, 10)}
+    directories = ["many", "few"]
+
+    auto = TransferEngine(mode="auto")
+    assert auto.select_archived(sizes, directories, True) == ["many"]
+    assert TransferEngine(mode="archive").select_archived(sizes, directories, True) == [
+        "many", "few", "a.txt", "b.txt"
+    ]
+    assert TransferEngine(mode="files").select_archived(sizes, directories, True) == []
+
+    small_files = {f"{index}.txt": (1, 100) for index in range(ARCHIVE_MIN_FILES)}
+    assert auto.select_archived(small_files, [], True) == list(small_files)
+    # Plain files can only be packed into a destination directory.
+    assert auto.select_archived(small_files, [], False) == []
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        TransferEngine(mode="fast")
+
+
+class ToolsConnection:
+    """A remote end with the given compressors installed, or unreachable."""
+
+    inf_id = None
+    host = "tools"
+
+    def __init__(self, names, reachable=True):
+        self.names = names
+        self.reachable = reachable
+
+    def ssh_command(self, remote_command, tty=False):
+        if not self.reachable:
+            return ["sh", "-c", "exit 255"]
+        return ["printf", "%s\\n", *self.names]
+
+
+def local_tools(monkeypatch, *missing):
+    """Make `missing` commands look uninstalled on the local side."""
+    monkeypatch.setattr(
+        transfer, "which", lambda name: None if name in missing else shutil.which(name)
+    )
+
+
+@pytest.mark.parametrize("remote, missing, codec", [
+    (["zstd", "gzip"], [], "zstd"),
+    (["gzip"], [], "gzip"),
+    (["zstd", "gzip"], ["zstd"], "gzip"),
+    (["zstd"], ["zstd"], "none"),
+    ([], [], "none"),
+])
+def test_choose_compressor(monkeypatch, remote, missing, codec):
+    monkeypatch.setattr(transfer, "which", lambda name: None if name in missing else name)
+    assert choose_compressor(ToolsConnection(remote))[0] == codec
+
+
+def test_choose_compressor_when_the_remote_check_fails(monkeypatch):
+    monkeypatch.setattr(transfer, "which", lambda name: name)
+    assert choose_compressor(ToolsConnection(["zstd"], reachable=False)) == COMPRESSORS[-1]
+
+
+def make_tree(root):
+    (root / "sub").mkdir(parents=True)
+    for index in range(5):
+        (root / f"file-{index}.txt").write_text(f"file {index}\n" * 100)
+        (root / "sub" / f"nested-{index}.bin").write_bytes(os.urandom(1000))
+
+
+def tree_of(root):
+    return {
+        path.relative_to(root): path.read_bytes()
+        for path in sorted(root.rglob("*"))
+        if path.is_file()
+    }
+
+
+@pytest.mark.parametrize("codec, missing", [
+    pytest.param(
+        "zstd", [], marks=pytest.mark.skipif(shutil.which("zstd") is None, reason="no zstd")
+    ),
+    ("gzip", ["zstd"]),
+    ("none", ["zstd", "gzip"]),
+])
+def test_directories_are_archived_with_the_best_codec(monkeypatch, tmp_path, codec, missing):
+    local_tools(monkeypatch, *missing)
+    engine = TransferEngine(mode="archive")
+    connection = LocalConnection()
+    tree = tmp_path / "tree"
+    make_tree(tree)
+
+    remote = tmp_path / "remote"
+    remote.mkdir()
+    plans, directories, archive = engine.plan_upload(connection, [str(tree)], str(remote))
+    assert (plans, directories) == ([], [])
+    _, compressors, errors = engine.transfer_archives([archive], "upload")
+    assert errors == []
+    assert compressors == [codec]
+    assert tree_of(remote / "tree") == tree_of(tree)
+
+    local = tmp_path / "local"
+    local.mkdir()
+    _, _, archive = engine.plan_download(connection, [str(remote / "tree")], str(local))
+    _, compressors, errors = engine.transfer_archives([archive], "download")
+    assert errors == []
+    assert compressors == [codec]
+    assert tree_of(local / "tree") == tree_of(tree)
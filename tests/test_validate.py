@@ -0,0 +1,59 @@
+import pytest
+
+from apricot_magics.validate import RecipeValidationError, RecipeValidator
+
+SYSTEM = "network public (outbound = 'yes')\nsystem node ( {properties} )\ndeploy node 1\n"
+
+
+@pytest.fixture
+def validator():
+    return RecipeValidator()
+
+
+@pytest.mark.parametrize(
+    "properties",
+    [
+        "disk.0.image.url = ['one://a/1', 'one://b/2']",
+        "memory.size >= 1g and soft 10 ( memory.size >= 2g )",
+        "cpu.count > 1",
+        "cpu.count < 8 and net_interface.0.connection = 'public'",
+    ],
+)
+def test_valid_radl_constructs(validator, properties):
+    result = validator.check(SYSTEM.format(properties=properties), "radl")
+    assert result.errors == []
+    assert result.warnings == []
+
+
+def test_unparsed_radl_warns_but_passes(validator):
+    result = validator.check(SYSTEM.format(properties="cpu.count = 1 and odd { thing }"), "radl")
+    assert result.errors == []
+    assert len(result.warnings) == 1
+
+
+def test_broken_radl_is_left_to_the_im(validator):
+    result = validator.check("system node ( cpu.count = 1", "radl")
+    assert result.errors == []
+    assert "the IM will validate it" in result.warnings[0]
+
+
+def test_undefined_system_blocks(validator):
+    with pytest.raises(RecipeValidationError) as error:
+        validator.check("system node ( cpu.count = 1 )\ndeploy other 1", "radl")
+    assert error.value.errors == ["`deploy other` refers to an undefined system"]
+
+
+def test_undefined_network_blocks(validator):
+    recipe = "system node ( net_interface.0.connection = 'missing' )\ndeploy node 1"
+    with pytest.raises(RecipeValidationError):
+        validator.check(recipe, "radl")
+
+
+def test_json_deploy_of_undefined_system(validator):
+    recipe = '[{"class": "system", "id": "node"}, {"class": "deploy", "system": "other"}]'
+    assert validator.validate(recipe, "json").errors
+
+
+def test_results_are_cached(validator):
+    recipe = SYSTEM.format(properties="cpu.count = 1")
+    assert validator.validate(recipe, "radl") is validator.validate(recipe, "radl")
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from apricot_magics.watcher import InfrastructureWatcher, parse_duration
+
+
+class FakeStatus:
+    """Return the given states in turn, recording when each fetch happened."""
+
+    def __init__(self, *states):
+        self.states = list(states)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, inf_id):
+        with self.lock:
+            self.calls.append(time.monotonic())
+            state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        return state, "10.0.0.1"
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize("value, seconds", [
+    ("90", 90), ("90s", 90), ("1.5s", 1.5), ("30m", 1800), ("2h", 7200), (" 5 m ", 300),
+])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize("value", ["", "m", "5d", "-5", "five"])
+def test_parse_duration_rejects_invalid_values(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
+
+
+def test_backoff_doubles_while_the_infrastructure_is_changing():
+    fetch = FakeStatus("running")
+    watcher = InfrastructureWatcher(fetch, min_interval=0.05, max_interval=0.2)
+    watcher.watch("inf")
+    wait_for(lambda: len(fetch.calls) >= 5)
+    watcher.unwatch("inf")
+
+    gaps = [later - earlier for earlier, later in zip(fetch.calls, fetch.calls[1:])]
+    assert gaps[0] > 0.04 and gaps[1] > 0.09 and gaps[2] > 0.19
+    assert gaps[0] < gaps[1] < gaps[2]
+    # Capped at max_interval.
+    assert gaps[3] < 0.35
+
+
+def test_watching_stops_once_the_infrastructure_settles():
+    fetch = FakeStatus("pending", "running", "configured")
+    watcher = InfrastructureWatcher(fetch, min_interval=0.01, max_interval=0.01)
+    watcher.watch("inf")
+    wait_for(lambda: len(fetch.calls) == 3 and not watcher._tasks)
+
+    time.sleep(0.1)
+    assert len(fetch.calls) == 3
+    # Settled statuses are left to the disk cache.
+    assert watcher.get("inf") is None
+
+
+def test_wait_until_returns_the_reached_state():
+    fetch = FakeStatus("pending", "running", "configured")
+    watcher = InfrastructureWatcher(fetch, min_interval=0.01, max_interval=0.01)
+
+    status = watcher.wait_until("inf", {"configured"}, timeout=5)
+    assert status.state == "configured"
+    assert status.ip == "10.0.0.1"
+
+
+def test_wait_until_returns_early_on_failure():
+    watcher = InfrastructureWatcher(FakeStatus("pending", "failed"), min_interval=0.01)
+    assert watcher.wait_until("inf", {"configured"}, timeout=5).state == "failed"
+
+
+def test_wait_until_times_out():
+    fetch = FakeStatus("running")
+    watcher = InfrastructureWatcher(fetch, min_interval=0.01, max_interval=0.01)
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        watcher.wait_until("inf", {"configured"}, timeout=0.2)
+    assert time.monotonic() - started < 1
+    watcher.unwatch("inf")
+
+
+def test_errors_keep_the_last_known_state():
+    calls = []
+
+    def fetch(inf_id):
+        calls.append(inf_id)
+        if len(calls) > 1:
+            raise RuntimeError("IM unreachable")
+        return "running", "10.0.0.1"
+
+    watcher = InfrastructureWatcher(fetch, min_interval=0.01, max_interval=0.01)
+    watcher.watch("inf")
+    wait_for(lambda: watcher.get("inf") is not None and watcher.get("inf").error)
+    status = watcher.get("inf")
+    watcher.unwatch("inf")
+
+    assert (status.state, status.ip, status.error) == ("running", "10.0.0.1", "IM unreachable")